@@ -1,11 +1,42 @@
+import os
 import json
 import math
+import pickle
+import hashlib
+import numpy as np
 from opensource.generative_agent_simple.backend.global_methods import *
 from utils import *
+from persona.prompt_modules.path_finder import *
+from nav_graph import *
+
+# 编译后的迷宫缓存格式版本；Maze 的编译结果结构变化时需要递增。
+COMPILED_MAZE_VERSION = 3
+# 编译后的迷宫包含的属性。各层都以 NumPy 数组保存，字符串形式的 collision_maze
+# 在使用时由 collision_layer 得到（见 Maze.collision_maze）。
+COMPILED_MAZE_FIELDS = ["maze_width", "maze_height", "sq_tile_size", "special_constraint",
+                        "world", "collision_layer",
+                        "sector_layer", "sector_names", "arena_layer", "arena_names",
+                        "game_object_layer", "game_object_names",
+                        "spawning_location_layer", "spawning_location_names",
+                        "tile_events", "arena_event_tiles", "address_tiles"]
 
 class Maze:
     def __init__(self, maze_name):
         self.maze_name = maze_name
+
+        # 输入文件没有变化时直接载入编译后的迷宫，否则从 CSV 重新构建并保存。
+        compiled_path = f"{env_matrix}/maze/compiled_maze.pickle"
+        inputs_hash = self.hash_env_matrix()
+        if not self.load_compiled(compiled_path, inputs_hash):
+            self.compile()
+            self.save_compiled(compiled_path, inputs_hash)
+
+        # 每个地址的距离场 {地址: (高, 宽) 数组}，见 enable_distance_fields()。
+        self.distance_fields = None
+        # 分层导航图，见 enable_nav_graph()。
+        self.nav_graph = None
+
+    def compile(self):
         # 加载迷宫元信息
         meta_info = json.load(open(f"{env_matrix}/maze_meta_info.json"))
         self.maze_width = int(meta_info["maze_width"])
@@ -29,20 +60,28 @@ class Maze:
         game_object_maze_raw = read_file_to_list(maze_folder + "/game_object_maze.csv", header=False)[0]
         spawning_location_maze_raw = read_file_to_list(maze_folder + "/spawning_location_maze.csv", header=False)[0]
 
-        self.collision_maze = self.parse_maze(collision_maze_raw, meta_info["maze_width"])
+        collision_maze = self.parse_maze(collision_maze_raw, meta_info["maze_width"])
         sector_maze = self.parse_maze(sector_maze_raw, meta_info["maze_width"])
         arena_maze = self.parse_maze(arena_maze_raw, meta_info["maze_width"])
         game_object_maze = self.parse_maze(game_object_maze_raw, meta_info["maze_width"])
         spawning_location_maze = self.parse_maze(spawning_location_maze_raw, meta_info["maze_width"])
 
-        self.tiles = []
-        for i in range(self.maze_height):
-            row = []
-            for j in range(self.maze_width):
-                tile_details = self.create_tile_details(wb, sb_dict, ab_dict, gob_dict, slb_dict, i, j, sector_maze,
-                                                        arena_maze, game_object_maze, spawning_location_maze)
-                row.append(tile_details)
-            self.tiles.append(row)
+        # 每一层是 (高, 宽) 的整数数组，值为对应名称表中的下标，0 表示空字符串。
+        self.world = wb
+        self.collision_layer = np.array([[j != "0" for j in row]
+                                         for row in collision_maze], dtype=bool)
+        self.sector_layer, self.sector_names = self.create_label_layer(sector_maze, sb_dict)
+        self.arena_layer, self.arena_names = self.create_label_layer(arena_maze, ab_dict)
+        self.game_object_layer, self.game_object_names = self.create_label_layer(
+                                                           game_object_maze, gob_dict)
+        self.spawning_location_layer, self.spawning_location_names = self.create_label_layer(
+                                                                       spawning_location_maze,
+                                                                       slb_dict)
+
+        # 稀疏的事件表 {(x, y): 事件集合}，只包含有事件的瓦片。
+        self.tile_events = dict()
+        # 事件的空间索引 {arena 地址: 有事件的瓦片集合}，随事件表一起维护。
+        self.arena_event_tiles = dict()
 
         # 为方块添加事件
         self.add_tile_events()
@@ -50,49 +89,118 @@ class Maze:
         # 地址和方块的映射
         self.address_tiles = self.map_address_to_tiles()
 
+    @property
+    def collision_maze(self):
+        """
+        path_finder 使用的字符串碰撞地图：碰撞瓦片为 collision_block_id，其余为 "0"。
+        第一次访问时由 <collision_layer> 构建并缓存，不写入编译后的迷宫。
+        """
+        collision_maze = getattr(self, "_collision_maze", None)
+        if collision_maze is None:
+            collision_maze = [[collision_block_id if j else "0" for j in row]
+                              for row in self.collision_layer.tolist()]
+            self._collision_maze = collision_maze
+        return collision_maze
+
+    def hash_env_matrix(self):
+        # 所有输入文件内容的哈希，任一文件变化都会使编译后的迷宫失效
+        blocks_folder = f"{env_matrix}/special_blocks"
+        maze_folder = f"{env_matrix}/maze"
+        files = [f"{env_matrix}/maze_meta_info.json",
+                 blocks_folder + "/world_blocks.csv",
+                 blocks_folder + "/sector_blocks.csv",
+                 blocks_folder + "/arena_blocks.csv",
+                 blocks_folder + "/game_object_blocks.csv",
+                 blocks_folder + "/spawning_location_blocks.csv",
+                 maze_folder + "/collision_maze.csv",
+                 maze_folder + "/sector_maze.csv",
+                 maze_folder + "/arena_maze.csv",
+                 maze_folder + "/game_object_maze.csv",
+                 maze_folder + "/spawning_location_maze.csv"]
+        inputs_hash = hashlib.sha1(str(COMPILED_MAZE_VERSION).encode("utf-8"))
+        for curr_file in files:
+            with open(curr_file, "rb") as f:
+                inputs_hash.update(f.read())
+        return inputs_hash.hexdigest()
+
+    def load_compiled(self, compiled_path, inputs_hash):
+        if not os.path.exists(compiled_path):
+            return False
+        # 缓存只是优化：文件损坏或与当前代码不兼容（例如类或 numpy 版本变化）
+        # 时都重新编译，而不是让迷宫构建失败。
+        try:
+            with open(compiled_path, "rb") as f:
+                compiled = pickle.load(f)
+            if (compiled.get("version") != COMPILED_MAZE_VERSION
+                    or compiled.get("inputs_hash") != inputs_hash):
+                return False
+            fields = {field: compiled["fields"][field]
+                      for field in COMPILED_MAZE_FIELDS}
+        except Exception as e:
+            print(f"Ignoring compiled maze cache {compiled_path}: {e!r}")
+            return False
+        for field, value in fields.items():
+            setattr(self, field, value)
+        return True
+
+    def save_compiled(self, compiled_path, inputs_hash):
+        compiled = {"version": COMPILED_MAZE_VERSION,
+                    "inputs_hash": inputs_hash,
+                    "fields": {field: getattr(self, field)
+                               for field in COMPILED_MAZE_FIELDS}}
+        # 先写入临时文件再替换，避免并发启动的模拟读到不完整的文件。
+        # 迷宫目录不可写时只是不缓存。
+        try:
+            with open(f"{compiled_path}.{os.getpid()}.tmp", "wb") as f:
+                pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{compiled_path}.{os.getpid()}.tmp", compiled_path)
+        except OSError:
+            pass
+
     def parse_maze(self, raw_maze, width):
         return [raw_maze[i:i + width] for i in range(0, len(raw_maze), width)]
 
-    def create_tile_details(self, wb, sb_dict, ab_dict, gob_dict, slb_dict, i, j, sector_maze, arena_maze,
-                            game_object_maze, spawning_location_maze):
-        tile_details = {
-            "world": wb,
-            "sector": sb_dict.get(sector_maze[i][j], ""),
-            "arena": ab_dict.get(arena_maze[i][j], ""),
-            "game_object": gob_dict.get(game_object_maze[i][j], ""),
-            "spawning_location": slb_dict.get(spawning_location_maze[i][j], ""),
-            "collision": collision_maze[i][j] != "0",
-            "events": set()
-        }
-        return tile_details
-
-    def add_tile_events(self):
+    def create_label_layer(self, label_maze, blocks_dict):
+        # 将方块编号的地图转换为名称下标的数组以及名称表
+        names = [""]
+        name_index = {"": 0}
+        layer = np.zeros((self.maze_height, self.maze_width), dtype=np.int32)
         for i in range(self.maze_height):
             for j in range(self.maze_width):
-                if self.tiles[i][j]["game_object"]:
-                    object_name = ":".join([
-                        self.tiles[i][j]["world"],
-                        self.tiles[i][j]["sector"],
-                        self.tiles[i][j]["arena"],
-                        self.tiles[i][j]["game_object"]
-                    ])
-                    go_event = (object_name, None, None, None)
-                    self.tiles[i][j]["events"].add(go_event)
+                name = blocks_dict.get(label_maze[i][j], "")
+                if name not in name_index:
+                    name_index[name] = len(names)
+                    names.append(name)
+                layer[i, j] = name_index[name]
+        return layer, names
+
+    def add_tile_events(self):
+        for i, j in zip(*np.nonzero(self.game_object_layer)):
+            object_name = self.get_tile_path((int(j), int(i)), "game_object")
+            go_event = (object_name, None, None, None)
+            self.add_event_from_tile(go_event, (int(j), int(i)))
 
     def map_address_to_tiles(self):
         address_tiles = {}
+        sector_layer = self.sector_layer.tolist()
+        arena_layer = self.arena_layer.tolist()
+        game_object_layer = self.game_object_layer.tolist()
+        spawning_location_layer = self.spawning_location_layer.tolist()
         for i in range(self.maze_height):
             for j in range(self.maze_width):
                 addresses = []
-                tile = self.tiles[i][j]
-                if tile["sector"]:
-                    addresses.append(f'{tile["world"]}:{tile["sector"]}')
-                if tile["arena"]:
-                    addresses.append(f'{tile["world"]}:{tile["sector"]}:{tile["arena"]}')
-                if tile["game_object"]:
-                    addresses.append(f'{tile["world"]}:{tile["sector"]}:{tile["arena"]}:{tile["game_object"]}')
-                if tile["spawning_location"]:
-                    addresses.append(f'<spawn_loc>{tile["spawning_location"]}')
+                sector = self.sector_names[sector_layer[i][j]]
+                arena = self.arena_names[arena_layer[i][j]]
+                game_object = self.game_object_names[game_object_layer[i][j]]
+                spawning_location = self.spawning_location_names[spawning_location_layer[i][j]]
+                if sector:
+                    addresses.append(f'{self.world}:{sector}')
+                if arena:
+                    addresses.append(f'{self.world}:{sector}:{arena}')
+                if game_object:
+                    addresses.append(f'{self.world}:{sector}:{arena}:{game_object}')
+                if spawning_location:
+                    addresses.append(f'<spawn_loc>{spawning_location}')
 
                 for add in addresses:
                     if add in address_tiles:
@@ -107,25 +215,36 @@ class Maze:
         return x, y
 
     def access_tile(self, tile):
+        """
+        返回瓦片的详细信息字典，键与原先每个瓦片的字典相同。没有事件的瓦片返回
+        空的 frozenset 作为 "events"；修改事件请使用 add_event_from_tile 等方法。
+        """
         x, y = tile
-        return self.tiles[y][x]
+        return {
+            "world": self.world,
+            "sector": self.sector_names[self.sector_layer[y, x]],
+            "arena": self.arena_names[self.arena_layer[y, x]],
+            "game_object": self.game_object_names[self.game_object_layer[y, x]],
+            "spawning_location": self.spawning_location_names[self.spawning_location_layer[y, x]],
+            "collision": bool(self.collision_layer[y, x]),
+            "events": self.tile_events.get((x, y), frozenset())
+        }
 
     def get_tile_path(self, tile, level):
         x, y = tile
-        tile = self.tiles[y][x]
-        path = tile['world']
+        path = self.world
         if level == "world":
             return path
         else:
-            path += f":{tile['sector']}"
+            path += f":{self.sector_names[self.sector_layer[y, x]]}"
         if level == "sector":
             return path
         else:
-            path += f":{tile['arena']}"
+            path += f":{self.arena_names[self.arena_layer[y, x]]}"
         if level == "arena":
             return path
         else:
-            path += f":{tile['game_object']}"
+            path += f":{self.game_object_names[self.game_object_layer[y, x]]}"
         return path
 
     def get_nearby_tiles(self, tile, vision_r):
@@ -141,21 +260,172 @@ class Maze:
                 nearby_tiles.append((i, j))
         return nearby_tiles
 
+    def get_nearby_event_tiles(self, tile, vision_r, arena_path):
+        """
+        返回 get_nearby_tiles(tile, vision_r) 中位于 <arena_path> 且有事件的瓦片，
+        顺序与 get_nearby_tiles 相同（先按 x 再按 y）。只访问该 arena 中有事件的
+        瓦片，而不是视野内的所有瓦片。
+        """
+        x, y = tile
+        left_end = max(0, x - vision_r)
+        right_end = min(self.maze_width - 1, x + vision_r + 1)
+        top_end = max(0, y - vision_r)
+        bottom_end = min(self.maze_height - 1, y + vision_r + 1)
+
+        return sorted(i for i in self.arena_event_tiles.get(arena_path, ())
+                      if left_end <= i[0] < right_end and top_end <= i[1] < bottom_end)
+
     def add_event_from_tile(self, curr_event, tile):
-        self.tiles[tile[1]][tile[0]]["events"].add(curr_event)
+        tile = (tile[0], tile[1])
+        if tile not in self.tile_events:
+            self.tile_events[tile] = set()
+            arena_path = self.get_tile_path(tile, "arena")
+            self.arena_event_tiles.setdefault(arena_path, set()).add(tile)
+        self.tile_events[tile].add(curr_event)
+
+    def remove_tile_from_event_index(self, tile):
+        del self.tile_events[tile]
+        self.arena_event_tiles[self.get_tile_path(tile, "arena")].discard(tile)
 
     def remove_event_from_tile(self, curr_event, tile):
-        self.tiles[tile[1]][tile[0]]["events"].discard(curr_event)
+        tile = (tile[0], tile[1])
+        if tile in self.tile_events:
+            self.tile_events[tile].discard(curr_event)
+            if not self.tile_events[tile]:
+                self.remove_tile_from_event_index(tile)
 
     def turn_event_from_tile_idle(self, curr_event, tile):
-        curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-        for event in curr_tile_ev_cp:
-            if event == curr_event:
-                self.tiles[tile[1]][tile[0]]["events"].remove(event)
-                new_event = (event[0], None, None, None)
-                self.tiles[tile[1]][tile[0]]["events"].add(new_event)
+        tile = (tile[0], tile[1])
+        if tile in self.tile_events and curr_event in self.tile_events[tile]:
+            self.tile_events[tile].remove(curr_event)
+            new_event = (curr_event[0], None, None, None)
+            self.tile_events[tile].add(new_event)
 
     def remove_subject_events_from_tile(self, subject, tile):
-        self.tiles[tile[1]][tile[0]]["events"] = {
-            event for event in self.tiles[tile[1]][tile[0]]["events"] if event[0] != subject
-        }
\ No newline at end of file
+        tile = (tile[0], tile[1])
+        if tile in self.tile_events:
+            events = {event for event in self.tile_events[tile] if event[0] != subject}
+            if events:
+                self.tile_events[tile] = events
+            else:
+                self.remove_tile_from_event_index(tile)
+
+    def distance_fields_key(self):
+        # 碰撞地图或地址变化时，磁盘上缓存的距离场失效
+        content = json.dumps([self.collision_layer.shape,
+                              sorted((add, sorted(tiles))
+                                     for add, tiles in self.address_tiles.items())])
+        key = hashlib.sha1(np.ascontiguousarray(self.collision_layer).tobytes())
+        key.update(content.encode("utf-8"))
+        return key.hexdigest()
+
+    def enable_distance_fields(self, cache_path=None, precompute=True):
+        """
+        为 <address_tiles> 中的地址启用距离场。每个距离场记录了每个瓦片到该地址
+        最近瓦片的步数，之后前往该地址时只需沿梯度行走，无需搜索。
+
+        距离场缓存在 <cache_path>（默认为 env_matrix/maze/distance_fields.npz），
+        碰撞地图或地址变化后会重新计算。precompute 为 False 时距离场在第一次
+        使用时才计算，新计算的距离场由 save_distance_fields() 写回缓存（启用时与
+        ReverieServer.save() 中都会调用）。
+
+        迷宫的瓦片数少于 32767 时距离场以 int16 保存（最大步数小于瓦片数），
+        内存占用是 int32 的一半。
+        """
+        if not cache_path: 
+            cache_path = f"{env_matrix}/maze/distance_fields.npz"
+        self.distance_fields = dict()
+        self.distance_fields_path = cache_path
+        # 是否有尚未写回缓存的距离场
+        self.distance_fields_dirty = False
+        key = self.distance_fields_key()
+
+        if os.path.exists(cache_path): 
+            data = np.load(cache_path, allow_pickle=False)
+            if str(data["key"]) == key: 
+                fields = data["fields"]
+                for count, address in enumerate(data["addresses"].tolist()): 
+                    self.distance_fields[address] = fields[count]
+
+        if precompute and len(self.distance_fields) < len(self.address_tiles): 
+            for address in self.address_tiles: 
+                self.get_distance_field(address)
+        self.save_distance_fields()
+
+    def distance_field_dtype(self):
+        return np.int16 if self.maze_width * self.maze_height < 32767 else np.int32
+
+    def save_distance_fields(self):
+        """
+        将内存中的距离场（包括从缓存载入的）写回缓存文件。没有新计算的距离场时
+        不写入。
+        """
+        if self.distance_fields is None or not self.distance_fields_dirty: 
+            return
+        addresses = list(self.distance_fields.keys())
+        fields = np.zeros((len(addresses), self.maze_height, self.maze_width),
+                          dtype=self.distance_field_dtype())
+        for count, address in enumerate(addresses): 
+            fields[count] = self.distance_fields[address]
+        # 与编译后的迷宫一样先写入临时文件再替换；目录不可写时只是不缓存。
+        tmp_path = f"{self.distance_fields_path}.{os.getpid()}.tmp.npz"
+        try: 
+            np.savez_compressed(tmp_path,
+                                key=np.array(self.distance_fields_key()),
+                                addresses=np.array(addresses),
+                                fields=fields)
+            os.replace(tmp_path, self.distance_fields_path)
+        except OSError: 
+            return
+        self.distance_fields_dirty = False
+
+    def get_distance_field(self, address):
+        if address not in self.distance_fields: 
+            self.distance_fields[address] = distance_field(
+              self.collision_maze, self.address_tiles[address], 
+              collision_block_id).astype(self.distance_field_dtype())
+            self.distance_fields_dirty = True
+        return self.distance_fields[address]
+
+    def path_to_address(self, address, tile):
+        """
+        返回从 <tile> 到 <address> 最近瓦片的路径（包含起点）。未启用距离场、
+        地址不存在或无法到达时返回 None。
+        """
+        if self.distance_fields is None or address not in self.address_tiles: 
+            return None
+        return walk_distance_field(self.get_distance_field(address), tile)
+
+    def enable_nav_graph(self, cluster_size=16):
+        """
+        构建分层导航图（见 NavGraph），之后 find_path 和 find_path_to_nearest
+        先在区域之间规划再在区域内细化，而不是在整个碰撞地图上搜索。
+        """
+        self.nav_graph = NavGraph(self, collision_block_id, cluster_size)
+
+    def find_path(self, start, end):
+        """
+        返回从 <start> 到 <end> 的 (x, y) 瓦片路径（包含两端）。未启用导航图或
+        导航图找不到路线时使用 path_finder。
+        """
+        if self.nav_graph is not None: 
+            path = self.nav_graph.find_path(start, end)
+            if path is not None: 
+                return path
+        return path_finder(self.collision_maze, start, end, collision_block_id)
+
+    def find_path_to_nearest(self, start, targets):
+        """
+        返回 (最近的目标瓦片, 路径)。距离相同时取 <targets> 中靠前的目标。
+        启用导航图时在抽象图上做一次多目标搜索（见 NavGraph.find_path_to_nearest），
+        而不是对每个目标分别调用 find_path。
+        """
+        if self.nav_graph is None: 
+            return path_finder_to_nearest(self.collision_maze, start, targets,
+                                          collision_block_id)
+        found = self.nav_graph.find_path_to_nearest(start, targets)
+        if found is None: 
+            # 起点不可通行或所有目标都无法到达，与未启用导航图时的结果保持一致
+            return path_finder_to_nearest(self.collision_maze, start, targets,
+                                          collision_block_id)
+        return found
@@ -0,0 +1,365 @@
+"""
+文件: nav_graph.py
+描述: 定义了NavGraph类，一个基于区域和入口（portal）的分层导航图（HPA*风格），
+用于在大型迷宫上进行路径规划：先在区域之间的抽象图上搜索粗略路线，再在各个
+区域内部细化为瓦片路径。
+"""
+import heapq
+from collections import deque
+
+from persona.prompt_modules.path_finder import *
+
+class NavGraph:
+    """
+    迷宫的分层导航图。
+
+    区域是具有相同 (sector, arena, 簇) 标签的可通行瓦片的连通分量，其中簇是
+    边长为 <cluster_size> 的方块，用于限制大型户外区域的大小。相邻两个区域之间
+    的每一段连续边界选取中间的一对瓦片作为入口。抽象图的节点是入口瓦片：同一
+    区域内的入口之间以区域内的最短距离相连，跨越边界的一对入口以1相连。
+
+    查询时只需在起点和终点所在的区域内各做一次局部搜索，再在抽象图上做A*，
+    因此代价随区域数量而不是瓦片数量增长。得到的路径不一定是全局最短的。
+    """
+    def __init__(self, maze, collision_block_char, cluster_size=16):
+        self.grid, self.width, self.height = get_collision_grid(
+                                               maze.collision_maze,
+                                               collision_block_char)
+        self.collision_maze = maze.collision_maze
+        self.collision_block_char = collision_block_char
+        self.cluster_size = cluster_size
+
+        # region[格子] 为区域编号，碰撞格子为 -1
+        self.region = [-1] * (self.width * self.height)
+        self.region_count = 0
+        # 区域编号 -> 该区域中的入口格子集合
+        self.portals = dict()
+        # 入口格子 -> {相邻入口格子: 代价}
+        self.edges = dict()
+        # (入口, 入口) -> 区域内的格子路径
+        self.path_cache = dict()
+
+        self.build_regions(maze)
+        self.build_portals()
+        self.build_intra_edges()
+
+    def build_regions(self, maze):
+        sector_layer = maze.sector_layer.tolist()
+        arena_layer = maze.arena_layer.tolist()
+        labels = [None] * (self.width * self.height)
+        for y in range(self.height):
+            for x in range(self.width):
+                cell = y * self.width + x
+                if not self.grid[cell]:
+                    labels[cell] = (sector_layer[y][x], arena_layer[y][x],
+                                    x // self.cluster_size,
+                                    y // self.cluster_size)
+
+        for cell in range(self.width * self.height):
+            if labels[cell] is None or self.region[cell] >= 0:
+                continue
+            region = self.region_count
+            self.region_count += 1
+            self.region[cell] = region
+            queue = deque([cell])
+            while queue:
+                curr = queue.popleft()
+                for n in self.neighbors(curr):
+                    if self.region[n] < 0 and labels[n] == labels[cell]:
+                        self.region[n] = region
+                        queue.append(n)
+
+    def build_portals(self):
+        # 按 (区域A, 区域B, 方向) 收集所有跨越边界的相邻格子对
+        borders = dict()
+        for cell in range(self.width * self.height):
+            if self.region[cell] < 0:
+                continue
+            x = cell % self.width
+            for n, step in [(cell + 1, 1), (cell + self.width, self.width)]:
+                if step == 1 and x == self.width - 1:
+                    continue
+                if n >= self.width * self.height or self.region[n] < 0:
+                    continue
+                if self.region[n] != self.region[cell]:
+                    key = (self.region[cell], self.region[n], step)
+                    borders.setdefault(key, []).append(cell)
+
+        for (region_a, region_b, step), cells in borders.items():
+            # 沿边界方向连续的格子对构成一段边界，选取其中间的一对作为入口
+            along = self.width if step == 1 else 1
+            segment = [cells[0]]
+            for cell in cells[1:] + [None]:
+                if cell is not None and cell == segment[-1] + along:
+                    segment.append(cell)
+                    continue
+                a = segment[len(segment) // 2]
+                self.add_edge(a, a + step, 1)
+                self.portals.setdefault(region_a, set()).add(a)
+                self.portals.setdefault(region_b, set()).add(a + step)
+                segment = [cell]
+
+    def build_intra_edges(self):
+        for region, portals in self.portals.items():
+            for portal in portals:
+                dist, _ = self.region_bfs(portal)
+                for other in portals:
+                    if other != portal and other in dist:
+                        self.add_edge(portal, other, dist[other])
+
+    def add_edge(self, a, b, cost):
+        self.edges.setdefault(a, dict())[b] = cost
+        self.edges.setdefault(b, dict())[a] = cost
+
+    def neighbors(self, cell):
+        # 与 path_finder 相同的顺序：上、左、下、右
+        x = cell % self.width
+        if cell >= self.width:
+            yield cell - self.width
+        if x > 0:
+            yield cell - 1
+        if cell < (self.height - 1) * self.width:
+            yield cell + self.width
+        if x < self.width - 1:
+            yield cell + 1
+
+    def region_bfs(self, source, target=None):
+        """
+        在 <source> 所在的区域内做广度优先搜索。给定 <target> 时找到即停止。
+        返回 (距离字典, 父节点字典)。
+        """
+        region = self.region[source]
+        dist = {source: 0}
+        parent = {source: None}
+        queue = deque([source])
+        while queue:
+            cell = queue.popleft()
+            if cell == target:
+                break
+            for n in self.neighbors(cell):
+                if n not in dist and self.region[n] == region:
+                    dist[n] = dist[cell] + 1
+                    parent[n] = cell
+                    queue.append(n)
+        return dist, parent
+
+    def local_path(self, a, b):
+        """
+        返回区域内从格子 <a> 到格子 <b> 的路径（包含两端）。入口之间的路径会被缓存。
+        """
+        cacheable = a in self.edges and b in self.edges
+        if cacheable and (a, b) in self.path_cache:
+            return self.path_cache[(a, b)]
+
+        _, parent = self.region_bfs(a, b)
+        if b not in parent:
+            return None
+        path = [b]
+        while parent[path[-1]] is not None:
+            path.append(parent[path[-1]])
+        path.reverse()
+
+        if cacheable:
+            self.path_cache[(a, b)] = path
+            self.path_cache[(b, a)] = path[::-1]
+        return path
+
+    def find_path(self, start, end):
+        """
+        返回从 <start> 到 <end> 的 (x, y) 瓦片路径（包含两端）。起点或终点不在
+        任何区域中（例如是碰撞瓦片），或者两者之间没有路线时返回 None。
+        """
+        s = start[1] * self.width + start[0]
+        e = end[1] * self.width + end[0]
+        if s == e:
+            return [(start[0], start[1])]
+        if self.region[s] < 0 or self.region[e] < 0:
+            return None
+        # 短距离的查询直接在瓦片上搜索（只会访问附近的少量格子），避免经过
+        # 入口造成的绕路。
+        if abs(start[0] - end[0]) + abs(start[1] - end[1]) <= self.cluster_size:
+            path = path_finder(self.collision_maze, start, end,
+                               self.collision_block_char)
+            if len(path) > 1:
+                return path
+
+        if self.region[s] == self.region[e]:
+            cells = self.local_path(s, e)
+        else:
+            cells = self.abstract_path(s, e)
+        if cells is None:
+            return None
+        return [(cell % self.width, cell // self.width) for cell in cells]
+
+    def abstract_path(self, s, e):
+        # 起点和终点以区域内的距离接入抽象图
+        start_dist, _ = self.region_bfs(s)
+        start_edges = {p: start_dist[p]
+                       for p in self.portals.get(self.region[s], ())
+                       if p in start_dist}
+        end_dist, _ = self.region_bfs(e)
+        end_edges = {p: end_dist[p]
+                     for p in self.portals.get(self.region[e], ())
+                     if p in end_dist}
+
+        ex, ey = e % self.width, e // self.width
+        def heuristic(cell):
+            return abs(cell % self.width - ex) + abs(cell // self.width - ey)
+
+        # 抽象图上的A*搜索
+        g = {s: 0}
+        came_from = {s: None}
+        heap = [(heuristic(s), 0, s)]
+        counter = 0
+        while heap:
+            _, _, node = heapq.heappop(heap)
+            if node == e:
+                break
+            edges = self.edges.get(node, dict()).items()
+            if node == s:
+                edges = list(edges) + list(start_edges.items())
+            if node in end_edges:
+                edges = list(edges) + [(e, end_edges[node])]
+            for n, cost in edges:
+                new_g = g[node] + cost
+                if n not in g or new_g < g[n]:
+                    g[n] = new_g
+                    came_from[n] = node
+                    counter += 1
+                    heapq.heappush(heap, (new_g + heuristic(n), counter, n))
+        if e not in came_from:
+            return None
+
+        route = [e]
+        while came_from[route[-1]] is not None:
+            route.append(came_from[route[-1]])
+        route.reverse()
+        return self.refine(route)
+
+    def refine(self, route):
+        # 将粗略路线细化为瓦片路径
+        cells = [route[0]]
+        for a, b in zip(route, route[1:]):
+            if self.region[a] != self.region[b]:
+                cells.append(b)
+            else:
+                cells += self.local_path(a, b)[1:]
+        return cells
+
+    def find_path_to_nearest(self, start, targets):
+        """
+        在抽象图上做一次多目标搜索，返回 (最近的目标瓦片, 路径)。
+
+        按区域分组的目标各做一次多源广度优先搜索，得到区域内每个入口到最近
+        目标的距离，作为入口到终点的边接入抽象图；起点所在区域内的目标直接
+        以区域内距离相连。随后只做一次A*（启发函数为到各目标的最小曼哈顿
+        距离），弹出终点时即得到最近的目标。起点不在任何区域中或者所有目标
+        都无法到达时返回 None。
+        """
+        s = start[1] * self.width + start[0]
+        if self.region[s] < 0:
+            return None
+        cells = dict()
+        for target in targets:
+            cell = target[1] * self.width + target[0]
+            if self.region[cell] >= 0:
+                cells.setdefault(cell, target)
+        if not cells:
+            return None
+        if s in cells:
+            return cells[s], [(start[0], start[1])]
+
+        # 目标区域内每个入口 -> (到最近目标的距离, 目标格子, 区域内的父节点字典)
+        start_dist, _ = self.region_bfs(s)
+        by_region = dict()
+        for cell in cells:
+            by_region.setdefault(self.region[cell], []).append(cell)
+        end_edges = dict()
+        for region, seeds in by_region.items():
+            if region == self.region[s]:
+                continue
+            nearest, dist, parent = self.region_multi_bfs(seeds)
+            for p in self.portals.get(region, ()):
+                if p in dist:
+                    end_edges[p] = (dist[p], nearest[p], parent)
+        # 虚拟终点，所有目标都以到它的边接入
+        e = -1
+        start_edges = list(self.portals.get(self.region[s], ()))
+        # 距离相同时取 <targets> 中靠前的目标
+        order = {cell: i for i, cell in enumerate(cells)}
+        direct = [(start_dist[cell], order[cell], cell)
+                  for cell in by_region.get(self.region[s], ())
+                  if cell in start_dist]
+
+        coords = [(cell % self.width, cell // self.width) for cell in cells]
+        def heuristic(cell):
+            if cell == e:
+                return 0
+            x, y = cell % self.width, cell // self.width
+            return min(abs(x - tx) + abs(y - ty) for tx, ty in coords)
+
+        g = {s: 0}
+        came_from = {s: None}
+        reached = None
+        heap = [(heuristic(s), 0, s)]
+        counter = 0
+        while heap:
+            _, _, node = heapq.heappop(heap)
+            if node == e:
+                break
+            edges = list(self.edges.get(node, dict()).items())
+            if node == s:
+                edges += [(p, start_dist[p]) for p in start_edges if p in start_dist]
+                if direct:
+                    edges.append((e, min(direct)[0]))
+            if node in end_edges:
+                edges.append((e, end_edges[node][0]))
+            for n, cost in edges:
+                new_g = g[node] + cost
+                if n not in g or new_g < g[n]:
+                    g[n] = new_g
+                    came_from[n] = node
+                    counter += 1
+                    heapq.heappush(heap, (new_g + heuristic(n), counter, n))
+        if e not in came_from:
+            return None
+
+        last = came_from[e]
+        if last == s:
+            # 起点所在区域内的目标更近（其他区域的入口都不在起点所在区域中）
+            target_cell = min(direct)[2]
+            path = self.local_path(s, target_cell)
+        else:
+            route = [last]
+            while came_from[route[-1]] is not None:
+                route.append(came_from[route[-1]])
+            route.reverse()
+            path = self.refine(route)
+            _, target_cell, parent = end_edges[last]
+            # 沿多源搜索的父节点从入口走到最近的目标
+            cell = last
+            while parent[cell] is not None:
+                cell = parent[cell]
+                path.append(cell)
+        return cells[target_cell], [(cell % self.width, cell // self.width)
+                                    for cell in path]
+
+    def region_multi_bfs(self, sources):
+        """
+        在 <sources> 所在的区域内做多源广度优先搜索。返回 (最近源字典, 距离字典,
+        父节点字典)，父节点指向离源更近的一步。
+        """
+        region = self.region[sources[0]]
+        nearest = {source: source for source in sources}
+        dist = {source: 0 for source in sources}
+        parent = {source: None for source in sources}
+        queue = deque(sources)
+        while queue:
+            cell = queue.popleft()
+            for n in self.neighbors(cell):
+                if n not in dist and self.region[n] == region:
+                    dist[n] = dist[cell] + 1
+                    nearest[n] = nearest[cell]
+                    parent[n] = cell
+                    queue.append(n)
+        return nearest, dist, parent
@@ -0,0 +1,368 @@
+"""
+文件: openai_standin.py
+描述: 一个本地的 OpenAI API 替身服务，实现 gpt_structure 使用的聊天补全、文本补全
+和嵌入接口。它返回固定或模板化的输出，并可配置延迟分布与错误率，用于在没有
+网络、不产生费用的情况下对 ReverieServer 做端到端的压力测试和吞吐量对比。
+
+用法:
+    python openai_standin.py [--port 端口] [--latency fixed|uniform|lognormal]
+                             [--latency-mean 秒] [--latency-sigma 形状参数]
+                             [--error-rate 概率] [--throttle-rate 概率]
+                             [--rules 规则文件] [--chat-rules 规则文件]
+                             [--seed 种子]
+然后在 gpt_structure.py 中设置 llm_api_base = "http://127.0.0.1:<端口>/v1"。
+"""
+import re
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 嵌入向量的维度，与 text-embedding-ada-002 相同。
+STANDIN_EMBEDDING_DIM = 1536
+# 没有匹配的规则时，文本补全和非 JSON 聊天请求返回的内容。
+STANDIN_DEFAULT_OUTPUT = "idle"
+
+# wrap_json_prompt 在提示末尾附加的示例输出。示例本身没有转义（例如 focal_pt
+# 的示例是带引号的列表），因此只截取其中的值，再重新编码为 JSON。
+EXAMPLE_OUTPUT_PATTERN = re.compile(r'示例输出 JSON:\s*\{"output": "(.*)"\}\s*$', re.S)
+
+# 默认规则：(正则表达式, 输出模板)，按顺序匹配，只用于文本补全和未经
+# wrap_json_prompt 包装的聊天提示。每条规则以对应提示模板中的特征文本为键（多数
+# 锚定在提示末尾，即模型需要续写的位置），输出能通过相应 run_gpt_prompt_* 的
+# __func_validate 的内容。其余自由文本家族（keyword_to_thoughts、
+# convo_to_thoughts、whisper_inner_thought 等）由 <default_output> 覆盖。
+DEFAULT_RULES = [
+    # wake_up_hour: "...'s wake up hour:"
+    (r"wake[- ]up hour:\s*$", "6am"),
+    # daily_plan: "1) wake up and complete the morning routine at 6:00 am, 2)"
+    (r"\d+:00 am, 2\)\s*$",
+     " eat breakfast at 7:00 am, 3) work on the day's projects from 8:00 am to"
+     " 12:00 pm, 4) have lunch at 12:00 pm, 5) keep working from 1:00 pm to"
+     " 5:00 pm, 6) have dinner at 6:00 pm, 7) relax and read a book at 8:00 pm,"
+     " 8) go to bed at 11:00 pm."),
+    # task_decomp: "(total duration in minutes 60):"，输出一个占满整段时长的子任务
+    (r"\(total duration in minutes:? (\d+)\)",
+     "working on the task (duration in minutes: {0}, minutes left: 0)"),
+    # new_decomp_schedule: 第一行给出结束时间，提示以 "HH:MM ~" 结尾，补全到结束时间
+    (r"originally planned schedule from [^\n]*? to (\d\d:\d\d)[^\n]*\n[\s\S]*~\s*$",
+     " {0} -- continuing with the original plan"),
+    # generate_hourly_schedule: "[(ID:...) ... -- 08:00 AM] Activity: Isabella is"
+    (r"\] Activity: [^\n\[\]]* is\s*$", " working on the daily plan"),
+    # decide_to_talk / decide_to_react：不发起对话、不做反应，让模拟保持简单
+    (r"Answer in yes or no", "Answer in yes or no: no"),
+    (r"Answer: Option", "Answer: Option 3"),
+    # create_conversation: "What would they talk about now?\nIsabella: \""
+    (r'What would they talk about now\?[\s\S]*:\s*"\s*$', 'Hi!"'),
+    # iterative_convo: 输出 {"<说话人>": "<话语>", "Did the conversation end ...?": <布尔>}
+    (r"Did the conversation end with", '{{"utterance": "Hi!", "end": true}}'),
+    # insight_and_guidance: "(example format: insight (because of 1, 5, 3))\n1."
+    (r"\(because of [^\n]*\)\)[\s\S]*1\.\s*$",
+     " keeping to the daily routine (because of 1)"),
+    # extract_keywords: 清理函数在响应中查找 "Emotive keywords:"
+    (r"keywords:\s*$", " daily routine, plan\nEmotive keywords: calm"),
+    # event_triple / act_obj_event_triple: "Output: (Isabella Rodriguez,"
+    (r"\([^()\n,]+,\s*$", " is, idle)"),
+    # action_sector / action_arena: 选项为 "{a, b, c}"，提示以 "{" 结尾
+    (r"\{([^,{}\n]+)[^{}\n]*\}[^{}]*\{\s*$", "{0}}}"),
+    # action_game_object: 从最后一组 "{a, b, c}" 中选第一个对象
+    (r"\{([^,{}\n]+)[^{}\n]*\}[^{}]*:\s*$", " {0}"),
+]
+
+# 经 wrap_json_prompt 包装的聊天提示默认回显示例输出（poignancy、pronunciatio、
+# focal_pt、summarize_* 等）。只有示例本身通不过验证的家族才需要规则，
+# 输出为完整的 JSON 响应。
+DEFAULT_CHAT_RULES = [
+    # agent_chat: 清理函数要求 "Here is their conversation." 之后每一行都有对应
+    # 的引号内容，而示例中没有引号
+    (r"Here is their conversation\.",
+     '{{"output": "\\"Hi!\\" \\"Hi!\\" \\"Hi!\\""}}'),
+]
+
+
+def standin_embedding(text, dim=STANDIN_EMBEDDING_DIM):
+    """
+    由文本的哈希决定的单位向量。相同的文本总是得到相同的嵌入。
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def apply_rules(rules, prompt):
+    """
+    返回第一条匹配 <prompt> 的规则的输出；没有匹配时返回 None。
+    """
+    for pattern, output in rules:
+        match = pattern.search(prompt)
+        if match:
+            return output.format(*match.groups())
+    return None
+
+
+def count_tokens(text):
+    return len(text) // 4 + 1
+
+
+class OpenAIStandin:
+    """
+    本地替身服务。
+
+    经 wrap_json_prompt 包装的聊天提示（以示例输出 JSON 结尾）：
+      1. <chat_rules>（默认为 DEFAULT_CHAT_RULES）中第一条匹配的规则；
+      2. 回显示例输出，即各 run_gpt_prompt_* 所期望的 JSON 结构。
+    这类提示不经过 <rules>，因此宽松的规则不会截获聊天提示。
+    其他提示：
+      1. <rules>（默认为 DEFAULT_RULES）中第一条匹配的规则；
+      2. <default_output>。
+    规则为 (正则表达式, 输出模板)，模板中的 {0}、{1}... 以匹配的分组填充。
+
+    延迟:
+      latency: "fixed"、"uniform"（0 到 2 倍均值）或 "lognormal"。
+      latency_mean: 平均延迟（秒）。
+      latency_sigma: lognormal 分布的形状参数。
+    错误:
+      error_rate: 返回 500 错误的概率。
+      throttle_rate: 返回 429 限流错误的概率。
+    """
+    def __init__(self, host="127.0.0.1", port=8765, latency="lognormal",
+                 latency_mean=0.5, latency_sigma=0.5, error_rate=0.0,
+                 throttle_rate=0.0, rules=None, chat_rules=None,
+                 default_output=STANDIN_DEFAULT_OUTPUT, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        if rules is None:
+            rules = DEFAULT_RULES
+        if chat_rules is None:
+            chat_rules = DEFAULT_CHAT_RULES
+        self.rules = [(re.compile(pattern, re.S), output)
+                      for pattern, output in rules]
+        self.chat_rules = [(re.compile(pattern, re.S), output)
+                           for pattern, output in chat_rules]
+        self.default_output = default_output
+        self.random = random.Random(seed)
+
+        self.counts = dict()
+        self._lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def sample_latency(self):
+        with self._lock:
+            if self.latency == "fixed":
+                return self.latency_mean
+            if self.latency == "uniform":
+                return self.random.uniform(0, 2 * self.latency_mean)
+            # 使分布的均值等于 latency_mean
+            mu = np.log(max(self.latency_mean, 1e-9)) - self.latency_sigma ** 2 / 2
+            return self.random.lognormvariate(mu, self.latency_sigma)
+
+    def sample_error(self):
+        """
+        返回 (状态码, 错误类型)，不出错时返回 None。
+        """
+        with self._lock:
+            r = self.random.random()
+        if r < self.throttle_rate:
+            return 429, "rate_limit_error"
+        if r < self.throttle_rate + self.error_rate:
+            return 500, "server_error"
+        return None
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def render_output(self, prompt, chat):
+        if chat:
+            example = EXAMPLE_OUTPUT_PATTERN.search(prompt)
+            if example:
+                output = apply_rules(self.chat_rules, prompt)
+                if output is not None:
+                    return output
+                return json.dumps({"output": example.group(1)}, ensure_ascii=False)
+        output = apply_rules(self.rules, prompt)
+        if output is not None:
+            return output
+        return self.default_output
+
+    def chat_completion(self, body):
+        prompt = "\n".join(m.get("content") or "" for m in body.get("messages", []))
+        content = self.render_output(prompt, True)
+        return {"id": f"chatcmpl-{self.next_id()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0,
+                             "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": self.usage(prompt, content)}
+
+    def completion(self, body):
+        prompt = body.get("prompt") or ""
+        if isinstance(prompt, list):
+            prompt = prompt[0] if prompt else ""
+        text = self.render_output(prompt, False)
+        return {"id": f"cmpl-{self.next_id()}",
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "text": text, "logprobs": None,
+                             "finish_reason": "stop"}],
+                "usage": self.usage(prompt, text)}
+
+    def embeddings(self, body):
+        texts = body.get("input") or []
+        if isinstance(texts, str):
+            texts = [texts]
+        data = []
+        for i, text in enumerate(texts):
+            vector = standin_embedding(text)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data += [{"object": "embedding", "index": i, "embedding": embedding}]
+        tokens = sum(count_tokens(text) for text in texts)
+        return {"object": "list", "data": data, "model": body.get("model"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    def usage(self, prompt, output):
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = count_tokens(output)
+        return {"prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    def next_id(self):
+        with self._lock:
+            return "%016x" % self.random.getrandbits(64)
+
+    def handle(self, path, body):
+        """
+        返回 (状态码, 响应体)。
+        """
+        if path.endswith("/chat/completions"):
+            endpoint, handler = "chat", self.chat_completion
+        elif path.endswith("/completions"):
+            endpoint, handler = "completions", self.completion
+        elif path.endswith("/embeddings"):
+            endpoint, handler = "embeddings", self.embeddings
+        else:
+            return 404, {"error": {"message": f"unknown path {path}",
+                                   "type": "invalid_request_error"}}
+
+        self.count(endpoint)
+        time.sleep(self.sample_latency())
+        error = self.sample_error()
+        if error:
+            status, error_type = error
+            self.count(error_type)
+            return status, {"error": {"message": f"stand-in {error_type}",
+                                      "type": error_type}}
+        return 200, handler(body)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def make_server(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    status, response = 400, {"error": {"message": "invalid JSON",
+                                                       "type": "invalid_request_error"}}
+                else:
+                    status, response = standin.handle(self.path, body)
+                self.reply(status, response)
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/stats"):
+                    self.reply(200, standin.stats())
+                else:
+                    self.reply(404, {"error": {"message": f"unknown path {self.path}",
+                                               "type": "invalid_request_error"}})
+
+            def reply(self, status, response):
+                data = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if status == 429:
+                    self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((self.host, self.port), Handler)
+        server.daemon_threads = True
+        return server
+
+    def start(self):
+        """
+        在后台线程中启动服务，返回 API 地址（可直接用作 llm_api_base）。
+        """
+        self.server = self.make_server()
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f"http://{self.host}:{self.port}/v1"
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="本地 OpenAI API 替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"],
+                        default="lognormal")
+    parser.add_argument("--latency-mean", type=float, default=0.5)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    # 规则文件为 [[正则表达式, 输出模板], ...] 形式的 JSON，替换 DEFAULT_RULES
+    parser.add_argument("--rules")
+    # 同上，替换 DEFAULT_CHAT_RULES，输出模板应为完整的 JSON 响应
+    parser.add_argument("--chat-rules")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    rules = json.load(open(args.rules)) if args.rules else None
+    chat_rules = json.load(open(args.chat_rules)) if args.chat_rules else None
+    standin = OpenAIStandin(host=args.host, port=args.port, latency=args.latency,
+                            latency_mean=args.latency_mean,
+                            latency_sigma=args.latency_sigma,
+                            error_rate=args.error_rate,
+                            throttle_rate=args.throttle_rate,
+                            rules=rules, chat_rules=chat_rules, seed=args.seed)
+    server = standin.make_server()
+    print(f"OpenAI stand-in listening on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(standin.stats())
+        server.server_close()
@@ -35,30 +35,25 @@ def execute(persona, maze, personas, plan):
     if not persona.scratch.act_path_set: 
         # <target_tiles> 是一个瓦片坐标列表，表示人物可能去执行当前动作的位置。目标是选择其中一个。
         target_tiles = None
+        path = None
+        persona_name_set = set(personas.keys())
 
         if "<persona>" in plan: 
             # 执行人物-人物交互。
             target_p_tile = (personas[plan.split("<persona>")[-1].strip()]
                             .scratch.curr_tile)
-            potential_path = path_finder(maze.collision_maze, 
-                                        persona.scratch.curr_tile, 
-                                        target_p_tile, 
-                                        collision_block_id)
+            potential_path = maze.find_path(persona.scratch.curr_tile, 
+                                            target_p_tile)
             if len(potential_path) <= 2: 
                 target_tiles = [potential_path[0]]
             else: 
-                potential_1 = path_finder(maze.collision_maze, 
+                # 在中点附近的两个瓦片中选择较近的一个（距离相同时取前者），
+                # 一次多目标搜索即可完成。
+                midpoint_tile, _ = maze.find_path_to_nearest(
                                         persona.scratch.curr_tile, 
-                                        potential_path[int(len(potential_path)/2)], 
-                                        collision_block_id)
-                potential_2 = path_finder(maze.collision_maze, 
-                                        persona.scratch.curr_tile, 
-                                        potential_path[int(len(potential_path)/2)+1], 
-                                        collision_block_id)
-                if len(potential_1) <= len(potential_2): 
-                    target_tiles = [potential_path[int(len(potential_path)/2)]]
-                else: 
-                    target_tiles = [potential_path[int(len(potential_path)/2+1)]]
+                                        [potential_path[int(len(potential_path)/2)], 
+                                         potential_path[int(len(potential_path)/2)+1]])
+                target_tiles = [midpoint_tile]
         
         elif "<waiting>" in plan: 
             # 执行人物在执行动作之前决定等待的交互。
@@ -79,46 +74,36 @@ def execute(persona, maze, personas, plan):
                 maze.address_tiles["Johnson Park:park:park garden"] # 错误
             else: 
                 target_tiles = maze.address_tiles[plan]
+                # 如果迷宫启用了距离场，直接沿梯度走向最近的目标瓦片。
+                # 该瓦片已被其他人物占据时，退回到下面的抽样和搜索。
+                field_path = maze.path_to_address(plan, persona.scratch.curr_tile)
+                if (field_path 
+                    and not tile_has_persona(maze, field_path[-1], persona_name_set)): 
+                    path = field_path
 
-        # 有时会返回多个瓦片（例如，一个桌子可能延伸到许多坐标）。因此，我们在这里进行随机抽样。
-        if len(target_tiles) < 4: 
-            target_tiles = random.sample(list(target_tiles), len(target_tiles))
-        else:
-            target_tiles = random.sample(list(target_tiles), 4)
+        if path is None: 
+            # 有时会返回多个瓦片（例如，一个桌子可能延伸到许多坐标）。因此，我们在这里进行随机抽样。
+            if len(target_tiles) < 4: 
+                target_tiles = random.sample(list(target_tiles), len(target_tiles))
+            else:
+                target_tiles = random.sample(list(target_tiles), 4)
         
-        # 如果可能，我们希望人物在前往迷宫相同位置时占据不同的瓦片。
-        # 如果他们最终在同一个瓦片上，也可以，但我们试图降低这种可能性。
-        # 我们在这里处理重叠。
-        persona_name_set = set(personas.keys())
-        new_target_tiles = []
-        for i in target_tiles: 
-            curr_event_set = maze.access_tile(i)["events"]
-            pass_curr_tile = False
-            for j in curr_event_set: 
-                if j[0] in persona_name_set: 
-                    pass_curr_tile = True
-            if not pass_curr_tile: 
-                new_target_tiles += [i]
-        if len(new_target_tiles) == 0: 
-            new_target_tiles = target_tiles
-        target_tiles = new_target_tiles
+            # 如果可能，我们希望人物在前往迷宫相同位置时占据不同的瓦片。
+            # 如果他们最终在同一个瓦片上，也可以，但我们试图降低这种可能性。
+            # 我们在这里处理重叠。
+            new_target_tiles = []
+            for i in target_tiles: 
+                if not tile_has_persona(maze, i, persona_name_set): 
+                    new_target_tiles += [i]
+            if len(new_target_tiles) == 0: 
+                new_target_tiles = target_tiles
+            target_tiles = new_target_tiles
 
-        # 现在我们已经确定了目标瓦片，我们找到了到其中一个目标瓦片的最短路径。
-        curr_tile = persona.scratch.curr_tile
-        collision_maze = maze.collision_maze
-        closest_target_tile = None
-        path = None
-        for i in target_tiles: 
-            curr_path = path_finder(maze.collision_maze, 
-                                    curr_tile, 
-                                    i, 
-                                    collision_block_id)
-            if not closest_target_tile: 
-                closest_target_tile = i
-                path = curr_path
-            elif len(curr_path) < len(path): 
-                closest_target_tile = i
-                path = curr_path
+            # 现在我们已经确定了目标瓦片，我们用一次多目标搜索找到到其中最近一个
+            # 目标瓦片的最短路径。
+            curr_tile = persona.scratch.curr_tile
+            closest_target_tile, path = maze.find_path_to_nearest(curr_tile, 
+                                                                  target_tiles)
 
         # 实际设置 <planned_path> 和 <act_path_set>。我们在计划路径中去掉了第一个元素，因为它包括当前瓦片。
         persona.scratch.planned_path = path[1:]
@@ -135,3 +120,12 @@ def execute(persona, maze, personas, plan):
 
     execution = ret, persona.scratch.act_pronunciation, description
     return execution
+
+def tile_has_persona(maze, tile, persona_name_set): 
+    """
+    判断瓦片上是否有人物的事件（即是否被人物占据）。
+    """
+    for event in maze.access_tile(tile)["events"]: 
+        if event[0] in persona_name_set: 
+            return True
+    return False
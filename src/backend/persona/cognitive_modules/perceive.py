@@ -45,24 +45,13 @@ def perceive(persona, maze):
                                        persona.scratch.vision_r)
 
   # 存储感知到的空间。注意，persona的s_mem以字典构建的树的形式存在。
+  # 只有第一次看到的瓦片需要加入记忆树。
   for i in nearby_tiles: 
+    if i in persona.s_mem.discovered_tiles: 
+      continue
+    persona.s_mem.discovered_tiles.add(i)
     i = maze.access_tile(i)
-    if i["world"]: 
-      if (i["world"] not in persona.s_mem.tree): 
-        persona.s_mem.tree[i["world"]] = {}
-    if i["sector"]: 
-      if (i["sector"] not in persona.s_mem.tree[i["world"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]] = {}
-    if i["arena"]: 
-      if (i["arena"] not in persona.s_mem.tree[i["world"]]
-                                              [i["sector"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] = []
-    if i["game_object"]: 
-      if (i["game_object"] not in persona.s_mem.tree[i["world"]]
-                                                    [i["sector"]]
-                                                    [i["arena"]]): 
-        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] += [
-                                                             i["game_object"]]
+    persona.s_mem.add_tile(i["world"], i["sector"], i["arena"], i["game_object"])
 
   # 感知事件
   # 我们将感知发生在与人物当前所在竞技场相同的竞技场中的事件。
@@ -72,19 +61,19 @@ def perceive(persona, maze):
   # 我们将根据距离对感知进行排序，距离越近，优先级越高。
   percept_events_list = []
   # 首先，我们将所有发生在附近瓦片上的事件放入percept_events_list中。
-  for tile in nearby_tiles: 
-    tile_details = maze.access_tile(tile)
-    if tile_details["events"]: 
-      if maze.get_tile_path(tile, "arena") == curr_arena_path:  
-        # 计算人物当前瓦片与目标瓦片之间的距离。
-        dist = math.dist([tile[0], tile[1]], 
-                         [persona.scratch.curr_tile[0], 
-                          persona.scratch.curr_tile[1]])
-        # 将任何相关事件按距离添加到我们的临时集合/列表中。
-        for event in tile_details["events"]: 
-          if event not in percept_events_set: 
-            percept_events_list += [[dist, event]]
-            percept_events_set.add(event)
+  # 迷宫的空间索引只返回附近同一竞技场中有事件的瓦片，顺序与nearby_tiles相同。
+  for tile in maze.get_nearby_event_tiles(persona.scratch.curr_tile, 
+                                          persona.scratch.vision_r, 
+                                          curr_arena_path): 
+    # 计算人物当前瓦片与目标瓦片之间的距离。
+    dist = math.dist([tile[0], tile[1]], 
+                     [persona.scratch.curr_tile[0], 
+                      persona.scratch.curr_tile[1]])
+    # 将任何相关事件按距离添加到我们的临时集合/列表中。
+    for event in maze.access_tile(tile)["events"]: 
+      if event not in percept_events_set: 
+        percept_events_list += [[dist, event]]
+        percept_events_set.add(event)
 
   # 我们对距离进行排序，并仅感知最接近的persona.scratch.att_bandwidth数量的事件。
   percept_events_list = sorted(percept_events_list, key=itemgetter(0))
@@ -105,11 +94,9 @@ def perceive(persona, maze):
     desc = f"{s.split(':')[-1]} is {desc}"
     p_event = (s, p, o)
 
-    # 我们检索最新的persona.scratch.retention个事件。如果有新事件发生（即p_event不在latest_events中），
+    # 我们检查最新的persona.scratch.retention个事件。如果有新事件发生（即p_event不在其中），
     # 那么我们将该事件添加到a_mem中并返回它。
-    latest_events = persona.a_mem.get_summarized_latest_events(
-                                    persona.scratch.retention)
-    if p_event not in latest_events:
+    if not persona.a_mem.is_latest_event(p_event, persona.scratch.retention):
       # 首先处理关键词。
       keywords = set()
       sub = p_event[0]
@@ -845,19 +845,15 @@ def _wait_react(persona, reaction_mode):
                   act_obj_event)
 
 
-def plan(persona, maze, personas, new_day, retrieved): 
+def plan_schedule(persona, maze, new_day): 
     """
-    人物的主要认知功能。根据检索到的记忆和感知以及迷宫和新的一天状态，
-    进行长期和短期规划。
+    规划的第一阶段：长期规划与确定下一个行动（部分1和部分2）。
+    只读取迷宫并修改Persona自身的状态，不同Persona之间可以并发执行。
 
     参数： 
         maze: 当前世界的<Maze>实例。
-        personas: 包含所有persona名称为键，<Persona>实例为值的字典。
         new_day: 表示是否是“新的一天”周期的布尔值或字符串。
-        retrieved: 从Persona的联想记忆中检索到的<ConceptNode>字典。
-    返回：
-        persona.scratch.act_address: persona的目标行动地址。
-    """ 
+    """
     # 部分1：生成每小时的日程安排
     if new_day: 
         _long_term_planning(persona, new_day)
@@ -866,7 +862,18 @@ def plan(persona, maze, personas, new_day, retrieved):
     if persona.scratch.act_check_finished(): 
         _determine_action(persona, maze)
 
-    # 部分3：如果感知到需要响应的事件，检索相关信息
+
+def choose_reaction(persona, personas, retrieved): 
+    """
+    规划的第二阶段：选择要关注的事件，并确定反应模式（部分3的步骤1和步骤2）。
+    只读取其他Persona的状态，在所有Persona完成 plan_schedule 之后可以并发执行。
+
+    参数： 
+        personas: 包含所有persona名称为键，<Persona>实例为值的字典。
+        retrieved: 从Persona的联想记忆中检索到的<ConceptNode>字典。
+    返回：
+        反应模式："chat with <名字>"、"wait: <时间>"，或 False。
+    """
     # 步骤1：选择要重点关注的事件
     focused_event = False
     if retrieved.keys(): 
@@ -874,14 +881,39 @@ def plan(persona, maze, personas, new_day, retrieved):
   
     # 步骤2：确定是否有必要做出反应
     if focused_event: 
-        reaction_mode = _should_react(persona, focused_event, personas)
-        if reaction_mode: 
-            # 如果需要对话，则生成对话内容
-            if reaction_mode[:9] == "chat with":
-                _chat_react(maze, persona, focused_event, reaction_mode, personas)
-            elif reaction_mode[:4] == "wait": 
-                _wait_react(persona, reaction_mode)
+        return _should_react(persona, focused_event, personas)
+    return False
+
+
+def react(maze, persona, reaction_mode, personas): 
+    """
+    规划的第三阶段：执行反应。对话反应会同时修改对话双方的状态，
+    等待反应只修改Persona自身的状态。
+    """
+    if reaction_mode: 
+        # 如果需要对话，则生成对话内容
+        if reaction_mode[:9] == "chat with":
+            _chat_react(maze, persona, None, reaction_mode, personas)
+        elif reaction_mode[:4] == "wait": 
+            _wait_react(persona, reaction_mode)
+
+
+def reaction_partner(reaction_mode): 
+    """
+    返回对话反应的对象名字；其他反应返回 None。
+    """
+    if reaction_mode and reaction_mode[:9] == "chat with": 
+        return reaction_mode[9:].strip()
+    return None
+
+
+def finish_plan(persona): 
+    """
+    规划的最后阶段：清理与对话相关的状态并更新聊天缓冲区（步骤3）。
 
+    返回：
+        persona.scratch.act_address: persona的目标行动地址。
+    """
     # 步骤3：清理与对话相关的状态
     if persona.scratch.act_event[1] != "chat with":
         persona.scratch.chatting_with = None
@@ -895,3 +927,23 @@ def plan(persona, maze, personas, new_day, retrieved):
             persona.scratch.chatting_with_buffer[persona_name] -= 1
 
     return persona.scratch.act_address
+
+
+def plan(persona, maze, personas, new_day, retrieved): 
+    """
+    人物的主要认知功能。根据检索到的记忆和感知以及迷宫和新的一天状态，
+    进行长期和短期规划。按顺序执行 plan_schedule、choose_reaction、react
+    和 finish_plan。
+
+    参数： 
+        maze: 当前世界的<Maze>实例。
+        personas: 包含所有persona名称为键，<Persona>实例为值的字典。
+        new_day: 表示是否是“新的一天”周期的布尔值或字符串。
+        retrieved: 从Persona的联想记忆中检索到的<ConceptNode>字典。
+    返回：
+        persona.scratch.act_address: persona的目标行动地址。
+    """ 
+    plan_schedule(persona, maze, new_day)
+    reaction_mode = choose_reaction(persona, personas, retrieved)
+    react(maze, persona, reaction_mode, personas)
+    return finish_plan(persona)
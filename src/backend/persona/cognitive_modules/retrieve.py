@@ -10,6 +10,8 @@ sys.path.append('../../')
 from opensource.generative_agent_simple.backend.global_methods import *
 from persona.prompt_template.gpt_structure import *
 
+import datetime
+import numpy as np
 from numpy import dot
 from numpy.linalg import norm
 
@@ -156,18 +158,72 @@ def extract_relevance(persona, nodes, focal_pt):
   """
   focal_embedding = get_embedding(focal_pt)
 
+  # 所有节点的相关度由一次矩阵-向量乘积算出。
+  embeddings = persona.a_mem.embeddings
+  rows = embeddings.rows([node.embedding_key for node in nodes])
+  similarities = embeddings.similarities(focal_embedding, rows)
+
   relevance_out = dict()
   for count, node in enumerate(nodes): 
-    node_embedding = persona.a_mem.embeddings[node.embedding_key]
-    relevance_out[node.node_id] = cos_sim(node_embedding, focal_embedding)
+    relevance_out[node.node_id] = float(similarities[count])
 
   return relevance_out
 
 
+def normalize_array_floats(a, target_min, target_max): 
+  """
+  normalize_dict_floats 的数组版本。沿最后一个维度将 'a' 原地归一化到目标最小值和最大值之间；
+  某一行的取值全部相同时，该行的值都设为 (target_max - target_min)/2。
+
+  输入: 
+    a: 1-D或2-D的float64 numpy数组。
+    target_min: 整数或浮点数。
+    target_max: 整数或浮点数。
+  输出: 
+    a: 归一化后的同一个数组。
+  """
+  min_val = a.min(axis=-1, keepdims=True)
+  range_val = a.max(axis=-1, keepdims=True) - min_val
+  flat = range_val == 0
+  a -= min_val
+  a *= (target_max - target_min)
+  a /= np.where(flat, 1, range_val)
+  a += target_min
+  if flat.any(): 
+    a[np.broadcast_to(flat, a.shape)] = (target_max - target_min)/2
+  return a
+
+
+def top_highest_x_indices(scores, x): 
+  """
+  返回 'scores' 中最高的 'x' 个值的下标，按分数降序排列。与 top_highest_x_values 的顺序一致：
+  同分时保持原有顺序。只对候选部分排序，而不是对整个数组做完整排序。
+
+  输入: 
+    scores: 1-D numpy数组。
+    x: 整数。要选取的数量。
+  输出: 
+    下标的numpy数组。
+  """
+  n = len(scores)
+  if x <= 0: 
+    return np.zeros(0, dtype=np.int64)
+  if x >= n: 
+    return np.argsort(-scores, kind="stable")
+  kth = np.partition(scores, n - x)[n - x]
+  above = np.flatnonzero(scores > kth)
+  ties = np.flatnonzero(scores == kth)[:x - len(above)]
+  idx = np.sort(np.concatenate([above, ties]))
+  return idx[np.argsort(-scores[idx], kind="stable")]
+
+
 def new_retrieve(persona, focal_points, n_count=30): 
   """
   给定当前persona和焦点（焦点是正在检索的事件或思考），我们检索每个焦点的一组节点，并返回一个字典。
 
+  近因、重要性和相关度以数组形式计算；所有焦点的相关度由一次矩阵乘积得到。
+  排名结果与逐个节点计算的字典版本一致。
+
   输入: 
     persona: 我们正在检索其记忆的当前persona对象。 
     focal_points: 焦点列表（当前检索的事件或思考的描述字符串）。 
@@ -181,51 +237,120 @@ def new_retrieve(persona, focal_points, n_count=30):
   """
   # <retrieved>是我们要返回的主字典
   retrieved = dict() 
-  for focal_pt in focal_points: 
-    # 获取代理记忆中的所有节点（思考和事件），并按创建日期排序。
-    # 你也可以想象获取原始对话，但现在。 
-    nodes = [[i.last_accessed, i]
-              for i in persona.a_mem.seq_event + persona.a_mem.seq_thought
-              if "空闲" not in i.embedding_key]
-    nodes = sorted(nodes, key=lambda x: x[0])
-    nodes = [i for created, i in nodes]
-
-    # 计算组件字典并将其归一化。
-    recency_out = extract_recency(persona, nodes)
-    recency_out = normalize_dict_floats(recency_out, 0, 1)
-    importance_out = extract_importance(persona, nodes)
-    importance_out = normalize_dict_floats(importance_out, 0, 1)  
-    relevance_out = extract_relevance(persona, nodes, focal_pt)
-    relevance_out = normalize_dict_floats(relevance_out, 0, 1)
+
+  ann_index = persona.a_mem.ann_index
+  if (ann_index is not None and focal_points 
+      and len(persona.a_mem.seq_event) + len(persona.a_mem.seq_thought) 
+          >= ann_index.min_nodes): 
+    return ann_retrieve(persona, focal_points, n_count)
+
+  # 获取代理记忆中的所有节点（思考和事件）。
+  # 你也可以想象获取原始对话，但现在。 
+  nodes = [i for i in persona.a_mem.seq_event + persona.a_mem.seq_thought
+           if "空闲" not in i.embedding_key]
+  if not nodes or not focal_points: 
+    for focal_pt in focal_points: 
+      retrieved[focal_pt] = []
+    return retrieved
+
+  # 计算组件数组并将其归一化。近因只取决于节点在排序后的位置，重要性和相关度的
+  # 最小/最大值与节点顺序无关，因此都只需归一化一次。
+  recency = persona.scratch.recency_decay ** np.arange(1, len(nodes) + 1, 
+                                                       dtype=np.float64)
+  recency = normalize_array_floats(recency, 0, 1)
+  importance = np.array([node.poignancy for node in nodes], dtype=np.float64)
+  importance = normalize_array_floats(importance, 0, 1)
+
+  embeddings = persona.a_mem.embeddings
+  rows = embeddings.rows([node.embedding_key for node in nodes])
+  focal_embeddings = get_embeddings(focal_points)
+  relevance = embeddings.similarities(focal_embeddings, rows)
+  relevance = relevance.astype(np.float64)
+  relevance = normalize_array_floats(relevance, 0, 1)
+
+  # 节点按 last_accessed 排序；每个焦点检索后会更新被选中节点的 last_accessed，
+  # 因此下一个焦点的排序需要重新计算。
+  epoch = datetime.datetime(1970, 1, 1)
+  accessed = np.array([(node.last_accessed - epoch).total_seconds() 
+                       for node in nodes], dtype=np.float64)
+
+  # 注意: 尝试不同的权重。[1, 1, 1]倾向于工作得相当好，但在将来，这些权重可能应该通过类似RL的过程来学习，
+  # 也许通过RL类似的过程学习。
+  # gw = [1, 1, 1]
+  # gw = [1, 2, 1]
+  gw = [0.5, 3, 2]
+  for count, focal_pt in enumerate(focal_points): 
+    order = np.argsort(accessed, kind="stable")
 
     # 计算最终得分，结合组件值。
-    # 注意: 尝试不同的权重。[1, 1, 1]倾向于工作得相当好，但在将来，这些权重可能应该通过类似RL的过程来学习，
-    # 也许通过RL类似的过程学习。
-    # gw = [1, 1, 1]
-    # gw = [1, 2, 1]
-    gw = [0.5, 3, 2]
-    master_out = dict()
-    for key in recency_out.keys(): 
-      master_out[key] = (persona.scratch.recency_w*recency_out[key]*gw[0] 
-                     + persona.scratch.relevance_w*relevance_out[key]*gw[1] 
-                     + persona.scratch.importance_w*importance_out[key]*gw[2])
-
-    master_out = top_highest_x_values(master_out, len(master_out.keys()))
-    for key, val in master_out.items(): 
-      print (persona.a_mem.id_to_node[key].embedding_key, val)
-      print (persona.scratch.recency_w*recency_out[key]*1, 
-             persona.scratch.relevance_w*relevance_out[key]*1, 
-             persona.scratch.importance_w*importance_out[key]*1)
-
-    # 提取最高x个值。
-    # <master_out>具有节点id的键和浮点数的值。一旦我们获得了最高x个值，我们想将节点id转换为节点，并返回节点列表。
-    master_out = top_highest_x_values(master_out, n_count)
-    master_nodes = [persona.a_mem.id_to_node[key] 
-                    for key in list(master_out.keys())]
+    master_out = (persona.scratch.recency_w*recency*gw[0] 
+                  + persona.scratch.relevance_w*relevance[count][order]*gw[1] 
+                  + persona.scratch.importance_w*importance[order]*gw[2])
+
+    # 提取最高x个值，并将下标转换为节点。
+    top = top_highest_x_indices(master_out, n_count)
+    master_nodes = [nodes[order[i]] for i in top]
+
+    if debug: 
+      for i in top: 
+        print (nodes[order[i]].embedding_key, master_out[i])
 
     for n in master_nodes: 
       n.last_accessed = persona.scratch.curr_time
+    accessed[order[top]] = (persona.scratch.curr_time - epoch).total_seconds()
       
     retrieved[focal_pt] = master_nodes
 
   return retrieved
+
+
+def ann_retrieve(persona, focal_points, n_count=30): 
+  """
+  new_retrieve 在启用IVF索引后的近似版本。每个焦点只对索引探查到的候选节点
+  计算相关度、近因和重要性，并在候选节点中取前 <n_count> 个，因此每次查询的
+  开销与候选数而不是记忆总量成正比。
+
+  与精确路径的区别：三个分量都在候选节点内归一化，近因按候选节点在
+  last_accessed 排序中的位置计算。
+
+  输入与输出同 new_retrieve。
+  """
+  retrieved = dict()
+  a_mem = persona.a_mem
+  focal_embeddings = np.asarray(get_embeddings(focal_points), dtype=np.float32)
+  candidate_rows = a_mem.ann_index.candidate_rows(focal_embeddings)
+  query_norms = np.linalg.norm(focal_embeddings, axis=-1, keepdims=True)
+  focal_embeddings = focal_embeddings / np.where(query_norms == 0, 1, query_norms)
+
+  epoch = datetime.datetime(1970, 1, 1)
+  gw = [0.5, 3, 2]
+  for count, focal_pt in enumerate(focal_points): 
+    nodes = a_mem.ann_candidates(candidate_rows[count])
+    if not nodes: 
+      retrieved[focal_pt] = []
+      continue
+
+    rows = a_mem.embeddings.rows([node.embedding_key for node in nodes])
+    relevance = (a_mem.embeddings.matrix[rows] @ focal_embeddings[count]).astype(np.float64)
+    accessed = np.array([(node.last_accessed - epoch).total_seconds() 
+                         for node in nodes], dtype=np.float64)
+    order = np.argsort(accessed, kind="stable")
+
+    recency = persona.scratch.recency_decay ** np.arange(1, len(nodes) + 1, 
+                                                         dtype=np.float64)
+    recency = normalize_array_floats(recency, 0, 1)
+    importance = np.array([node.poignancy for node in nodes], dtype=np.float64)
+    importance = normalize_array_floats(importance, 0, 1)
+    relevance = normalize_array_floats(relevance, 0, 1)
+
+    master_out = (persona.scratch.recency_w*recency*gw[0] 
+                  + persona.scratch.relevance_w*relevance[order]*gw[1] 
+                  + persona.scratch.importance_w*importance[order]*gw[2])
+    top = top_highest_x_indices(master_out, n_count)
+    master_nodes = [nodes[order[i]] for i in top]
+
+    for n in master_nodes: 
+      n.last_accessed = persona.scratch.curr_time
+    retrieved[focal_pt] = master_nodes
+
+  return retrieved
@@ -3,10 +3,84 @@ sys.path.append('../../')
 
 import json
 import datetime
+from collections import Counter
 
 from opensource.generative_agent_simple.backend.global_methods import *
+from persona.memory_modules.embedding_matrix import *
+from persona.memory_modules.ann_index import *
+
+class NewestFirstList: 
+    """
+    按插入顺序追加存储、以“最新在前”的顺序对外呈现的节点序列。
+
+    原先的 seq_event[0:0] = [node] 每次插入都要移动整个列表；这里改为在底层
+    列表末尾追加（O(1)），读取时再把下标翻转过来。因此 seq[0] 仍然是最新的
+    节点，seq[-1] 是最早的节点，seq[:n] 是最新的n个节点。
+    """
+    def __init__(self): 
+        self._nodes = []
+
+    def push(self, node): 
+        self._nodes.append(node)
+
+    def __len__(self): 
+        return len(self._nodes)
+
+    def __bool__(self): 
+        return bool(self._nodes)
+
+    def __iter__(self): 
+        return reversed(self._nodes)
+
+    def __reversed__(self): 
+        return iter(self._nodes)
+
+    def __contains__(self, node): 
+        return node in self._nodes
+
+    def __getitem__(self, index): 
+        n = len(self._nodes)
+        if isinstance(index, slice): 
+            start, stop, step = index.indices(n)
+            if step == 1 and start == 0: 
+                return self._nodes[n - stop:][::-1]
+            return [self._nodes[n - 1 - i] for i in range(start, stop, step)]
+        if index < 0: 
+            index += n
+        if index < 0 or index >= n: 
+            raise IndexError("NewestFirstList index out of range")
+        return self._nodes[n - 1 - index]
+
+    def __add__(self, other): 
+        return list(self) + list(other)
+
+    def __radd__(self, other): 
+        return list(other) + list(self)
+
+    def __eq__(self, other): 
+        return list(self) == list(other)
+
+    def __repr__(self): 
+        return repr(list(self))
+
+
+def intern_str(value): 
+    """
+    驻留字符串，使大量节点中重复出现的主语/谓语/宾语共享同一个对象。
+    """
+    if type(value) == str: 
+        return sys.intern(value)
+    return value
+
 
 class ConceptNode: 
+    # 使用 __slots__ 代替每个实例的 __dict__，以减少大量节点的内存占用。
+    __slots__ = ("node_id", "node_count", "type_count", "type", "depth",
+                 "created", "expiration", "last_accessed",
+                 "subject", "predicate", "object",
+                 "description", "embedding_key", "poignancy", "keywords", 
+                 "filling")
+
     def __init__(self, node_id, node_count, type_count, node_type, depth,
                  created, expiration, 
                  s, p, o, 
@@ -21,9 +95,9 @@ class ConceptNode:
         self.expiration = expiration
         self.last_accessed = self.created
 
-        self.subject = s
-        self.predicate = p
-        self.object = o
+        self.subject = intern_str(s)
+        self.predicate = intern_str(p)
+        self.object = intern_str(o)
 
         self.description = description
         self.embedding_key = embedding_key
@@ -34,24 +108,91 @@ class ConceptNode:
     def spo_summary(self): 
         return (self.subject, self.predicate, self.object)
 
-class AssociativeMemory: 
-    def __init__(self, f_saved): 
-        self.id_to_node = dict()
+def parse_node_time(time_str, parsed_times): 
+    """
+    解析节点的时间字符串，相同的字符串只解析一次并返回同一个 datetime 对象。
+    """
+    if time_str not in parsed_times: 
+        parsed_times[time_str] = datetime.datetime.strptime(time_str, 
+                                                            '%Y-%m-%d %H:%M:%S')
+    return parsed_times[time_str]
+
+
+def measure_node_footprint(n_nodes=20000): 
+    """
+    用 tracemalloc 测量每个 ConceptNode 占用的字节数，并与不带 __slots__、
+    不驻留字符串的旧式节点对比。
+
+    输出: 
+      {"dict_bytes_per_node": ..., "slots_bytes_per_node": ...}
+    """
+    import tracemalloc
+
+    class DictConceptNode: 
+        def __init__(self, node_id, node_count, type_count, node_type, depth,
+                     created, expiration, s, p, o, 
+                     description, embedding_key, poignancy, keywords, filling): 
+            self.node_id = node_id
+            self.node_count = node_count
+            self.type_count = type_count
+            self.type = node_type
+            self.depth = depth
+            self.created = created
+            self.expiration = expiration
+            self.last_accessed = self.created
+            self.subject = s
+            self.predicate = p
+            self.object = o
+            self.description = description
+            self.embedding_key = embedding_key
+            self.poignancy = poignancy
+            self.keywords = keywords
+            self.filling = filling
+
+    def build(node_class, parse_time): 
+        nodes = []
+        for count in range(n_nodes): 
+            created = parse_time(f"2023-02-13 {count // 3600 % 24:02d}:"
+                                 f"{count // 60 % 60:02d}:00")
+            # 用 "".join 构造字符串，模拟从 JSON 读入的、互不共享的字符串对象。
+            s = "".join(["Isabella ", "Rodriguez"])
+            p = "".join(["is"])
+            o = "".join(["idle"])
+            description = f"Isabella Rodriguez is doing task {count}"
+            nodes += [node_class(f"node_{count}", count, count, "event", 0, 
+                                 created, None, s, p, o, description, 
+                                 description, 1, {"isabella rodriguez", "idle"}, 
+                                 [])]
+        return nodes
+
+    results = dict()
+    for label, node_class, parse_time in [
+        ("dict_bytes_per_node", DictConceptNode, 
+         lambda t: datetime.datetime.strptime(t, '%Y-%m-%d %H:%M:%S')),
+        ("slots_bytes_per_node", ConceptNode, 
+         lambda t, cache=dict(): parse_node_time(t, cache))]: 
+        tracemalloc.start()
+        nodes = build(node_class, parse_time)
+        results[label] = tracemalloc.get_traced_memory()[0] / n_nodes
+        tracemalloc.stop()
+        del nodes
+    return results
 
-        self.seq_event = []
-        self.seq_thought = []
-        self.seq_chat = []
 
-        self.kw_to_event = dict()
-        self.kw_to_thought = dict()
-        self.kw_to_chat = dict()
-
-        self.kw_strength_event = dict()
-        self.kw_strength_thought = dict()
-
-        self.embeddings = json.load(open(f_saved + "/embeddings.json"))
+class AssociativeMemory: 
+    def __init__(self, f_saved): 
+        self.init_indexes()
+        if has_npy_embeddings(f_saved): 
+            self.embeddings = EmbeddingMatrix.load_npy(f_saved)
+            self.embeddings_format = "npy"
+            self.embeddings_dtype = self.embeddings.stored_dtype
+        else: 
+            self.embeddings = EmbeddingMatrix(
+                                json.load(open(f_saved + "/embeddings.json")))
 
         nodes_load = json.load(open(f_saved + "/nodes.json"))
+        # 同一步中创建的节点时间戳相同，缓存解析结果以共享 datetime 对象。
+        parsed_times = dict()
         for count in range(len(nodes_load.keys())): 
             node_id = f"node_{str(count+1)}"
             node_details = nodes_load[node_id]
@@ -61,12 +202,11 @@ class AssociativeMemory:
             node_type = node_details["type"]
             depth = node_details["depth"]
 
-            created = datetime.datetime.strptime(node_details["created"], 
-                                                '%Y-%m-%d %H:%M:%S')
+            created = parse_node_time(node_details["created"], parsed_times)
             expiration = None
             if node_details["expiration"]: 
-                expiration = datetime.datetime.strptime(node_details["expiration"],
-                                                        '%Y-%m-%d %H:%M:%S')
+                expiration = parse_node_time(node_details["expiration"], 
+                                             parsed_times)
 
             s = node_details["subject"]
             p = node_details["predicate"]
@@ -95,6 +235,38 @@ class AssociativeMemory:
         if kw_strength_load["kw_strength_thought"]: 
             self.kw_strength_thought = kw_strength_load["kw_strength_thought"]
     
+    def init_indexes(self): 
+        """
+        初始化空的节点序列、关键词索引与嵌入存储。
+        """
+        self.id_to_node = dict()
+
+        self.seq_event = NewestFirstList()
+        self.seq_thought = NewestFirstList()
+        self.seq_chat = NewestFirstList()
+
+        self.kw_to_event = dict()
+        self.kw_to_thought = dict()
+        self.kw_to_chat = dict()
+
+        self.kw_strength_event = dict()
+        self.kw_strength_thought = dict()
+
+        self.embeddings = EmbeddingMatrix()
+        # 嵌入的保存格式："json"（embeddings.json）或 "npy"（二进制，见
+        # EmbeddingMatrix.save_npy）。默认沿用载入时的格式。
+        self.embeddings_format = "json"
+        self.embeddings_dtype = "float32"
+        # 可选的近似最近邻索引，见 enable_ann_index()。启用后 <ann_nodes> 将
+        # embedding_key 映射到可检索的事件与思考节点。
+        self.ann_index = None
+        self.ann_nodes = None
+
+        # 最新 <latest_events_retention> 个事件的 spo_summary 计数，由 add_event
+        # 增量维护，见 is_latest_event()。在第一次查询时才建立。
+        self.latest_events = Counter()
+        self.latest_events_retention = None
+
     def save(self, out_json): 
         r = dict()
         for count in range(len(self.id_to_node.keys()), 0, -1): 
@@ -132,8 +304,39 @@ class AssociativeMemory:
         with open(out_json+"/kw_strength.json", "w") as outfile:
             json.dump(r, outfile)
 
-        with open(out_json+"/embeddings.json", "w") as outfile:
-            json.dump(self.embeddings, outfile)
+        if self.embeddings_format == "npy": 
+            self.embeddings.save_npy(out_json, self.embeddings_dtype)
+        else: 
+            with open(out_json+"/embeddings.json", "w") as outfile:
+                json.dump(self.embeddings.to_dict(), outfile)
+
+    def enable_ann_index(self, nlist=None, nprobe=8, min_nodes=20000): 
+        """
+        为相关度检索启用IVF近似最近邻索引。节点数达到<min_nodes>后，new_retrieve
+        改用 ann_retrieve：只对索引探查到的候选节点计算相关度、近因和重要性，
+        并在候选节点中排序。索引随嵌入的加入增量更新。
+        """
+        self.ann_index = IVFIndex(self.embeddings, nlist, nprobe, min_nodes)
+        self.ann_nodes = dict()
+        for node in self.seq_event + self.seq_thought: 
+            self.add_ann_node(node)
+        return self.ann_index
+
+    def add_ann_node(self, node): 
+        """
+        将可检索的节点加入 <ann_nodes>；与 new_retrieve 一样跳过空闲节点。
+        """
+        if self.ann_nodes is None or "空闲" in node.embedding_key: 
+            return
+        self.ann_nodes.setdefault(node.embedding_key, []).append(node)
+
+    def ann_candidates(self, rows): 
+        """
+        返回嵌入行号 <rows> 对应的可检索节点。
+        """
+        row_keys = self.embeddings.row_keys
+        return [node for row in rows.tolist() 
+                     for node in self.ann_nodes.get(row_keys[row], ())]
 
     def add_event(self, created, expiration, s, p, o, 
                         description, keywords, poignancy, 
@@ -159,14 +362,22 @@ class AssociativeMemory:
                         poignancy, keywords, filling)
 
         # 创建各种字典缓存以便快速访问
-        self.seq_event[0:0] = [node]
+        self.seq_event.push(node)
+        if self.latest_events_retention is not None: 
+            # 新事件进入窗口，第 retention+1 新的事件离开窗口
+            self.latest_events[node.spo_summary()] += 1
+            if len(self.seq_event) > self.latest_events_retention: 
+                old = self.seq_event[self.latest_events_retention].spo_summary()
+                self.latest_events[old] -= 1
+                if not self.latest_events[old]: 
+                    del self.latest_events[old]
         keywords = [i.lower() for i in keywords]
         for kw in keywords: 
-            if kw in self.kw_to_event: 
-                self.kw_to_event[kw][0:0] = [node]
-            else: 
-                self.kw_to_event[kw] = [node]
+            if kw not in self.kw_to_event: 
+                self.kw_to_event[kw] = NewestFirstList()
+            self.kw_to_event[kw].push(node)
         self.id_to_node[node_id] = node 
+        self.add_ann_node(node)
 
         # 添加到kw_strength
         if f"{p} {o}" != "is idle":  
@@ -203,14 +414,14 @@ class AssociativeMemory:
                         description, embedding_pair[0], poignancy, keywords, filling)
 
         # 创建各种字典缓存以便快速访问
-        self.seq_thought[0:0] = [node]
+        self.seq_thought.push(node)
         keywords = [i.lower() for i in keywords]
         for kw in keywords: 
-            if kw in self.kw_to_thought: 
-                self.kw_to_thought[kw][0:0] = [node]
-            else: 
-                self.kw_to_thought[kw] = [node]
+            if kw not in self.kw_to_thought: 
+                self.kw_to_thought[kw] = NewestFirstList()
+            self.kw_to_thought[kw].push(node)
         self.id_to_node[node_id] = node 
+        self.add_ann_node(node)
 
         # 添加到kw_strength
         if f"{p} {o}" != "is idle":  
@@ -242,13 +453,12 @@ class AssociativeMemory:
                         description, embedding_pair[0], poignancy, keywords, filling)
 
         # 创建各种字典缓存以便快速访问
-        self.seq_chat[0:0] = [node]
+        self.seq_chat.push(node)
         keywords = [i.lower() for i in keywords]
         for kw in keywords: 
-            if kw in self.kw_to_chat: 
-                self.kw_to_chat[kw][0:0] = [node]
-            else: 
-                self.kw_to_chat[kw] = [node]
+            if kw not in self.kw_to_chat: 
+                self.kw_to_chat[kw] = NewestFirstList()
+            self.kw_to_chat[kw].push(node)
         self.id_to_node[node_id] = node 
 
         self.embeddings[embedding_pair[0]] = embedding_pair[1]
@@ -263,6 +473,18 @@ class AssociativeMemory:
         return ret_set
 
 
+    def is_latest_event(self, spo_summary, retention): 
+        """
+        判断 <spo_summary> 是否在最新的 <retention> 个事件中，等价于
+        spo_summary in get_summarized_latest_events(retention)，但只需O(1)。
+        """
+        if retention != self.latest_events_retention: 
+            self.latest_events = Counter(e_node.spo_summary() 
+                                         for e_node in self.seq_event[:retention])
+            self.latest_events_retention = retention
+        return spo_summary in self.latest_events
+
+
     def get_str_seq_events(self): 
         ret_str = ""
         for count, event in enumerate(self.seq_event): 
@@ -315,4 +537,7 @@ class AssociativeMemory:
         if target_persona_name.lower() in self.kw_to_chat: 
             return self.kw_to_chat[target_persona_name.lower()][0]
         else: 
-            return False
\ No newline at end of file
+            return False
+
+if __name__ == '__main__':
+    print (measure_node_footprint())
@@ -0,0 +1,203 @@
+"""
+文件: embedding_matrix.py
+描述: 定义了EmbeddingMatrix类，用连续的float32矩阵存储关联记忆中的嵌入向量，
+使一次矩阵-向量乘积即可算出所有节点的相关度。
+"""
+import os
+import json
+import numpy as np
+
+# 二进制嵌入文件格式的版本号，写在 embeddings_index.json 中。
+EMBEDDINGS_FORMAT_VERSION = 1
+
+class EmbeddingMatrix: 
+    """
+    以 embedding_key 为键的嵌入向量存储。
+
+    每一行保存归一化后的向量，<norms> 保存原始向量的模长，因此既可以直接用
+    矩阵乘积计算余弦相似度，也可以还原出原始向量。对外提供与原先的 dict 相同
+    的访问方式（in、[]、keys()、items()、len()）。
+    """
+    def __init__(self, embeddings=None): 
+        self.key_to_row = dict()
+        self.row_keys = []
+        self.matrix = None
+        self.norms = None
+        self.size = 0
+        # 保存为二进制格式时使用的 dtype；从二进制文件载入时沿用文件中的 dtype。
+        self.stored_dtype = "float32"
+
+        if embeddings:
+            keys = list(embeddings.keys())
+            vectors = np.asarray([embeddings[key] for key in keys],
+                                 dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1)
+            safe_norms = np.where(norms == 0, 1, norms)
+            self.matrix = vectors / safe_norms[:, None]
+            self.norms = norms.astype(np.float32)
+            self.row_keys = keys
+            self.key_to_row = {key: row for row, key in enumerate(keys)}
+            self.size = len(keys)
+
+    def _reserve(self, dim): 
+        if self.matrix is None:
+            self.matrix = np.zeros((64, dim), dtype=np.float32)
+            self.norms = np.zeros(64, dtype=np.float32)
+        elif (self.size == self.matrix.shape[0]
+              or not self.matrix.flags.writeable):
+            capacity = max(self.matrix.shape[0] * 2, 64)
+            matrix = np.zeros((capacity, self.matrix.shape[1]), dtype=np.float32)
+            matrix[:self.size] = self.matrix[:self.size]
+            norms = np.zeros(capacity, dtype=np.float32)
+            norms[:self.size] = self.norms[:self.size]
+            self.matrix = matrix
+            self.norms = norms
+
+    def __setitem__(self, key, vector): 
+        # 嵌入由 embedding_key 的文本唯一决定，已存在的键不再重写。这样从只读
+        # 内存映射文件载入的矩阵在只加入新键之前都不需要被复制。
+        if key in self.key_to_row:
+            return
+        vector = np.asarray(vector, dtype=np.float32)
+        self._reserve(vector.shape[0])
+        row = self.size
+        self.size += 1
+        self.key_to_row[key] = row
+        self.row_keys.append(key)
+        norm = np.linalg.norm(vector)
+        self.matrix[row] = vector / norm if norm else vector
+        self.norms[row] = norm
+
+    def __getitem__(self, key): 
+        row = self.key_to_row[key]
+        return (self.matrix[row] * self.norms[row]).tolist()
+
+    def __contains__(self, key): 
+        return key in self.key_to_row
+
+    def __len__(self): 
+        return self.size
+
+    def __iter__(self): 
+        return iter(self.row_keys)
+
+    def keys(self): 
+        return list(self.row_keys)
+
+    def items(self): 
+        for key in self.row_keys:
+            yield key, self[key]
+
+    def get(self, key, default=None): 
+        if key in self.key_to_row:
+            return self[key]
+        return default
+
+    def to_dict(self): 
+        """
+        还原为 {embedding_key: 向量列表} 的字典，用于保存为 JSON。
+        """
+        return {key: self[key] for key in self.row_keys}
+
+    def rows(self, keys): 
+        """
+        将一组 embedding_key 转换为行号数组。
+        """
+        return np.fromiter((self.key_to_row[key] for key in keys),
+                           dtype=np.int64, count=len(keys))
+
+    def similarities(self, query, rows=None): 
+        """
+        计算查询向量与存储向量之间的余弦相似度。
+
+        输入:
+          query: 一个向量，或形状为 (m, dim) 的多个向量。
+          rows: 可选的行号数组；为 None 时与所有行计算。
+        输出:
+          形状为 (n,) 或 (m, n) 的相似度数组。
+        """
+        query = np.asarray(query, dtype=np.float32)
+        q_norm = np.linalg.norm(query, axis=-1, keepdims=True)
+        query = query / np.where(q_norm == 0, 1, q_norm)
+        if self.matrix is None:
+            return np.zeros(query.shape[:-1] + (0,), dtype=np.float32)
+        matrix = self.matrix[:self.size] if rows is None else self.matrix[rows]
+        return query @ matrix.T
+
+    def save_npy(self, folder, dtype="float32"): 
+        """
+        以二进制格式保存到 <folder>：
+          embeddings.npy        已归一化的行，float32 或 float16
+          embeddings_norms.npy  每行的原始模长，float32
+          embeddings_index.json 格式版本、dtype、维度和按行排列的键
+        先写入临时文件再替换，因此可以安全地覆盖当前正被内存映射的文件。
+        """
+        dim = self.matrix.shape[1] if self.matrix is not None else 0
+        matrix = (self.matrix[:self.size] if self.matrix is not None
+                  else np.zeros((0, dim), dtype=np.float32))
+        norms = (self.norms[:self.size] if self.norms is not None
+                 else np.zeros(0, dtype=np.float32))
+        index = {"version": EMBEDDINGS_FORMAT_VERSION,
+                 "dtype": dtype,
+                 "dim": dim,
+                 "keys": self.row_keys[:self.size]}
+        for name, array in [("embeddings.npy", matrix.astype(dtype)),
+                            ("embeddings_norms.npy", norms.astype(np.float32))]:
+            with open(f"{folder}/{name}.tmp", "wb") as outfile:
+                np.save(outfile, array)
+            os.replace(f"{folder}/{name}.tmp", f"{folder}/{name}")
+        with open(f"{folder}/embeddings_index.json.tmp", "w") as outfile:
+            json.dump(index, outfile)
+        os.replace(f"{folder}/embeddings_index.json.tmp",
+                   f"{folder}/embeddings_index.json")
+
+    @classmethod
+    def load_npy(cls, folder, mmap=True): 
+        """
+        从 save_npy() 写出的二进制文件载入。<mmap> 为 True 时以只读内存映射方式
+        打开，不解析也不复制向量数据；第一次加入新键时才复制为可写的float32矩阵。
+        """
+        index = json.load(open(f"{folder}/embeddings_index.json"))
+        if index["version"] != EMBEDDINGS_FORMAT_VERSION:
+            raise ValueError(f"unsupported embeddings format version "
+                             f"{index['version']} in {folder}")
+        mmap_mode = "r" if mmap else None
+        embeddings = cls()
+        embeddings.row_keys = list(index["keys"])
+        embeddings.key_to_row = {key: row
+                                 for row, key in enumerate(embeddings.row_keys)}
+        embeddings.size = len(embeddings.row_keys)
+        embeddings.stored_dtype = index["dtype"]
+        if embeddings.size:
+            embeddings.matrix = np.load(f"{folder}/embeddings.npy",
+                                        mmap_mode=mmap_mode)
+            embeddings.norms = np.load(f"{folder}/embeddings_norms.npy",
+                                       mmap_mode=mmap_mode)
+        return embeddings
+
+
+def has_npy_embeddings(folder): 
+    return os.path.exists(f"{folder}/embeddings_index.json")
+
+
+def convert_embeddings_json_to_npy(folder, dtype="float32", remove_json=False): 
+    """
+    将 <folder>/embeddings.json 转换为二进制格式。
+
+    输入:
+      folder: 关联记忆文件夹（包含 embeddings.json）。
+      dtype: "float32" 或 "float16"。
+      remove_json: 为 True 时转换后删除 embeddings.json。
+    """
+    embeddings = EmbeddingMatrix(json.load(open(f"{folder}/embeddings.json")))
+    embeddings.save_npy(folder, dtype)
+    if remove_json:
+        os.remove(f"{folder}/embeddings.json")
+    return embeddings
+
+
+if __name__ == '__main__':
+    import sys
+    # 用法: python embedding_matrix.py <associative_memory文件夹> [float32|float16]
+    convert_embeddings_json_to_npy(sys.argv[1],
+                                   sys.argv[2] if len(sys.argv) > 2 else "float32")
@@ -16,6 +16,37 @@ class MemoryTree:
     self.tree = {}
     if check_if_file_exists(f_saved): 
       self.tree = json.load(open(f_saved))
+    # 已经加入过记忆树的瓦片。瓦片的地址不会改变，因此每个瓦片只需处理一次。
+    self.discovered_tiles = set()
+    # {(world, sector, arena): 游戏对象集合}，与树中的列表同步，用于O(1)判断
+    # 对象是否已存在；树中仍保留列表以保持对象被发现的顺序。
+    self.arena_objects = dict()
+
+  def add_tile(self, world, sector, arena, game_object): 
+    """
+    将一个瓦片的地址加入记忆树。
+
+    输入：
+      world, sector, arena, game_object：瓦片各层的名称，空字符串表示没有该层。
+    输出：
+      None
+    """
+    if world: 
+      if world not in self.tree: 
+        self.tree[world] = {}
+    if sector: 
+      if sector not in self.tree[world]: 
+        self.tree[world][sector] = {}
+    if arena: 
+      if arena not in self.tree[world][sector]: 
+        self.tree[world][sector][arena] = []
+    if game_object: 
+      key = (world, sector, arena)
+      if key not in self.arena_objects: 
+        self.arena_objects[key] = set(self.tree[world][sector][arena])
+      if game_object not in self.arena_objects[key]: 
+        self.arena_objects[key].add(game_object)
+        self.tree[world][sector][arena] += [game_object]
 
   def print_tree(self): 
     """
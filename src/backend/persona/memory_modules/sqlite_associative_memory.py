@@ -0,0 +1,183 @@
+"""
+文件: sqlite_associative_memory.py
+描述: 定义了SQLiteAssociativeMemory类，一个以本地SQLite数据库为存储后端的
+关联记忆。节点、关键词强度和嵌入在加入时即写入数据库，保存时只需提交增量。
+"""
+import sys
+sys.path.append('../../')
+
+import json
+import sqlite3
+import numpy as np
+
+from opensource.generative_agent_simple.backend.global_methods import *
+from persona.memory_modules.associative_memory import *
+
+# 关联记忆的存储后端："json"（nodes.json 等文件）或 "sqlite"。
+# 文件夹中已存在 memory.sqlite3 时总是使用 SQLite 后端。
+associative_memory_backend = "json"
+
+class SQLiteAssociativeMemory(AssociativeMemory): 
+    """
+    以 <f_saved>/memory.sqlite3 为存储的关联记忆。
+
+    首次打开只有 JSON 文件的文件夹时，会按原有方式载入一次并导入数据库。
+    之后的载入直接从数据库批量读取节点、关键词强度和嵌入，不再经过
+    add_event/add_thought/add_chat 逐个重放，也不需要解析 JSON。
+    """
+    def __init__(self, f_saved): 
+        self.f_saved = f_saved
+        db_path = f"{f_saved}/memory.sqlite3"
+        exists = check_if_file_exists(db_path)
+
+        self.conn = self.connect(db_path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS nodes (
+                node_count INTEGER PRIMARY KEY,
+                node_id TEXT, type_count INTEGER, type TEXT, depth INTEGER,
+                created TEXT, expiration TEXT,
+                subject TEXT, predicate TEXT, object TEXT,
+                description TEXT, embedding_key TEXT, poignancy INTEGER,
+                keywords TEXT, filling TEXT);
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY, vector BLOB);
+            CREATE TABLE IF NOT EXISTS kw_strength (
+                kind TEXT, keyword TEXT, strength INTEGER,
+                PRIMARY KEY (kind, keyword));""")
+
+        # 批量导入期间暂不逐条提交。
+        self.bulk = True
+        if exists:
+            self.load_from_db()
+        else:
+            AssociativeMemory.__init__(self, f_saved)
+            self.write_kw_strength(self.kw_strength_event, "event")
+            self.write_kw_strength(self.kw_strength_thought, "thought")
+        self.conn.commit()
+        self.bulk = False
+
+    def connect(self, db_path): 
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def load_from_db(self): 
+        self.init_indexes()
+
+        keys = []
+        vectors = []
+        for key, vector in self.conn.execute("SELECT key, vector FROM embeddings"):
+            keys += [key]
+            vectors += [np.frombuffer(vector, dtype=np.float32)]
+        if keys:
+            self.embeddings = EmbeddingMatrix(dict(zip(keys, vectors)))
+
+        parsed_times = dict()
+        seqs = {"event": (self.seq_event, self.kw_to_event),
+                "thought": (self.seq_thought, self.kw_to_thought),
+                "chat": (self.seq_chat, self.kw_to_chat)}
+        rows = self.conn.execute("""SELECT node_id, node_count, type_count, type,
+                                      depth, created, expiration, subject,
+                                      predicate, object, description,
+                                      embedding_key, poignancy, keywords, filling
+                                    FROM nodes ORDER BY node_count""")
+        for row in rows:
+            expiration = None
+            if row[6]:
+                expiration = parse_node_time(row[6], parsed_times)
+            node = ConceptNode(row[0], row[1], row[2], row[3], row[4],
+                               parse_node_time(row[5], parsed_times), expiration,
+                               row[7], row[8], row[9], row[10], row[11], row[12],
+                               set(json.loads(row[13])), json.loads(row[14]))
+            seq, kw_to = seqs[node.type]
+            seq.push(node)
+            for kw in [i.lower() for i in node.keywords]:
+                if kw not in kw_to:
+                    kw_to[kw] = NewestFirstList()
+                kw_to[kw].push(node)
+            self.id_to_node[node.node_id] = node
+
+        for kind, keyword, strength in self.conn.execute(
+                "SELECT kind, keyword, strength FROM kw_strength"):
+            if kind == "event":
+                self.kw_strength_event[keyword] = strength
+            else:
+                self.kw_strength_thought[keyword] = strength
+
+    def write_node(self, node, embedding_pair, kw_strength, kind): 
+        self.conn.execute("""INSERT OR REPLACE INTO nodes VALUES
+                               (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (node.node_count, node.node_id, node.type_count, node.type,
+             node.depth, node.created.strftime('%Y-%m-%d %H:%M:%S'),
+             node.expiration.strftime('%Y-%m-%d %H:%M:%S')
+               if node.expiration else None,
+             node.subject, node.predicate, node.object, node.description,
+             node.embedding_key, node.poignancy,
+             json.dumps(list(node.keywords)), json.dumps(node.filling)))
+        self.conn.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+            (embedding_pair[0],
+             np.asarray(embedding_pair[1], dtype=np.float32).tobytes()))
+        if kw_strength is not None and not self.bulk:
+            keywords = [i.lower() for i in node.keywords]
+            self.write_kw_strength({kw: kw_strength[kw] for kw in keywords
+                                    if kw in kw_strength}, kind)
+        if not self.bulk:
+            self.conn.commit()
+
+    def write_kw_strength(self, kw_strength, kind): 
+        self.conn.executemany("INSERT OR REPLACE INTO kw_strength VALUES (?, ?, ?)",
+                              [(kind, kw, strength)
+                               for kw, strength in kw_strength.items()])
+
+    def add_event(self, created, expiration, s, p, o,
+                        description, keywords, poignancy,
+                        embedding_pair, filling):
+        node = AssociativeMemory.add_event(self, created, expiration, s, p, o,
+                                           description, keywords, poignancy,
+                                           embedding_pair, filling)
+        self.write_node(node, embedding_pair, self.kw_strength_event, "event")
+        return node
+
+    def add_thought(self, created, expiration, s, p, o,
+                          description, keywords, poignancy,
+                          embedding_pair, filling):
+        node = AssociativeMemory.add_thought(self, created, expiration, s, p, o,
+                                             description, keywords, poignancy,
+                                             embedding_pair, filling)
+        self.write_node(node, embedding_pair, self.kw_strength_thought, "thought")
+        return node
+
+    def add_chat(self, created, expiration, s, p, o,
+                       description, keywords, poignancy,
+                       embedding_pair, filling):
+        node = AssociativeMemory.add_chat(self, created, expiration, s, p, o,
+                                          description, keywords, poignancy,
+                                          embedding_pair, filling)
+        self.write_node(node, embedding_pair, None, "chat")
+        return node
+
+    def save(self, out_json): 
+        """
+        节点在加入时已经写入数据库，这里只需提交。保存到其他文件夹时（例如分叉
+        模拟）将数据库整体复制过去，并改为使用复制后的数据库，与 JSON 后端一样
+        之后新增的节点写入最近一次保存的位置，原文件夹不再改变。
+        """
+        self.conn.commit()
+        if out_json != self.f_saved:
+            create_folder_if_not_there(f"{out_json}/memory.sqlite3")
+            dest = self.connect(f"{out_json}/memory.sqlite3")
+            self.conn.backup(dest)
+            self.conn.close()
+            self.conn = dest
+            self.f_saved = out_json
+
+
+def load_associative_memory(f_saved): 
+    """
+    根据 <associative_memory_backend> 与文件夹内容选择关联记忆的存储后端。
+    """
+    if (associative_memory_backend == "sqlite"
+        or check_if_file_exists(f"{f_saved}/memory.sqlite3")):
+        return SQLiteAssociativeMemory(f_saved)
+    return AssociativeMemory(f_saved)
@@ -9,6 +9,7 @@ from global_methods import *
 from persona.memory_structures.spatial_memory import *
 from persona.memory_structures.associative_memory import *
 from persona.memory_structures.scratch import *
+from persona.memory_modules.sqlite_associative_memory import *
 
 from persona.cognitive_modules.perceive import *
 from persona.cognitive_modules.retrieve import *
@@ -30,7 +31,7 @@ class Persona:
         f_s_mem_saved = f"{folder_mem_saved}/bootstrap_memory/spatial_memory.json"
         self.s_mem = MemoryTree(f_s_mem_saved)
         f_a_mem_saved = f"{folder_mem_saved}/bootstrap_memory/associative_memory"
-        self.a_mem = AssociativeMemory(f_a_mem_saved)
+        self.a_mem = load_associative_memory(f_a_mem_saved)
         scratch_saved = f"{folder_mem_saved}/bootstrap_memory/scratch.json"
         self.scratch = Scratch(scratch_saved)
 
@@ -89,6 +90,34 @@ class Persona:
         """
         return plan(self, maze, personas, new_day, retrieved)
 
+    def plan_schedule(self, maze, new_day):
+        """
+        规划的第一阶段（长期规划与确定下一个行动），只修改自身状态。
+        """
+        plan_schedule(self, maze, new_day)
+
+    def choose_reaction(self, personas, retrieved):
+        """
+        规划的第二阶段，只读取其他Persona的状态。
+        返回值：
+            反应模式："chat with <名字>"、"wait: <时间>"，或 False。
+        """
+        return choose_reaction(self, personas, retrieved)
+
+    def react(self, maze, personas, reaction_mode):
+        """
+        规划的第三阶段。对话反应会同时修改对话对象的状态。
+        """
+        react(maze, self, reaction_mode, personas)
+
+    def finish_plan(self):
+        """
+        规划的最后阶段，清理自身与对话相关的状态。
+        返回值：
+            Persona的目标动作地址（persona.scratch.act_address）。
+        """
+        return finish_plan(self)
+
     def execute(self, maze, personas, plan):
         """
         执行Persona的当前计划。
@@ -108,17 +137,17 @@ class Persona:
         """
         reflect(self)
 
-    def move(self, maze, personas, curr_tile, curr_time):
+    def begin_move(self, maze, curr_tile, curr_time):
         """
-        执行Persona的主要认知功能。
+        执行认知循环中只读取迷宫和自身记忆的阶段（感知与检索）。
+        不同Persona之间的这一阶段互不依赖，因此可以并发执行。
 
         参数：
             maze：当前世界的迷宫实例。
-            personas：一个字典，其中包含所有Persona名称作为键，Persona实例作为值。
             curr_tile：当前Persona的当前方块位置。
             curr_time：指示游戏当前时间的datetime实例。
         返回值：
-            执行的具体动作，包含下一个方块、发音和描述。
+            (new_day, retrieved)，供plan()使用。
         """
         self.scratch.curr_tile = curr_tile
         new_day = False
@@ -130,6 +159,21 @@ class Persona:
         self.scratch.curr_time = curr_time
         perceived = self.perceive(maze)
         retrieved = self.retrieve(perceived)
+        return new_day, retrieved
+
+    def move(self, maze, personas, curr_tile, curr_time):
+        """
+        执行Persona的主要认知功能。
+
+        参数：
+            maze：当前世界的迷宫实例。
+            personas：一个字典，其中包含所有Persona名称作为键，Persona实例作为值。
+            curr_tile：当前Persona的当前方块位置。
+            curr_time：指示游戏当前时间的datetime实例。
+        返回值：
+            执行的具体动作，包含下一个方块、发音和描述。
+        """
+        new_day, retrieved = self.begin_move(maze, curr_tile, curr_time)
         plan = self.plan(maze, personas, new_day, retrieved)
         self.reflect()
         return self.execute(maze, personas, plan)
@@ -1,30 +1,465 @@
+import os
+import re
+import copy
 import json
 import random
 import openai
 import time 
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 
 from utils import *
 
 openai.api_key = openai_api_key
 
+# OpenAI API 地址。为 None 时使用官方服务；设置为本地替身服务的地址（例如
+# "http://127.0.0.1:8765/v1"，见 openai_standin.py）即可在离线环境中运行模拟。
+llm_api_base = None
+
+# LLM 响应缓存配置。
+# <llm_cache_mode> 可取 "off"（不使用缓存）、"readwrite"（读写缓存）或
+# "replay"（只读回放：命中时直接返回，未命中时照常请求但不写入缓存）。
+llm_cache_mode = "readwrite"
+llm_cache_path = "llm_cache.sqlite3"
+llm_cache_max_entries = 200000
+
+# 嵌入服务配置。持久化缓存同样遵循 <llm_cache_mode>。
+embedding_cache_path = "embedding_cache.sqlite3"
+# 内存中最多保留的嵌入条数。
+embedding_memory_max_entries = 20000
+# 一次 Embedding.create 请求中最多包含的文本数。
+embedding_max_batch = 64
+# 发起请求前等待其他线程加入同一批次的时间（秒）。
+embedding_batch_window = 0.005
+
+# 提示模板配置。为 True 时每次渲染前检查模板文件的修改时间，文件变化后重新载入；
+# 为 False 时每个模板只在第一次使用时读取一次。
+prompt_template_reload = False
+# 为 True 时，输入数量少于模板中的占位符数量会抛出 ValueError；为 False 时只打印
+# 警告，缺少的 !<INPUT n>! 保留在提示中（与原先逐个替换的行为一致）。
+prompt_template_strict = False
+
+# 速率限制配置：{模型: (每分钟请求数, 每分钟 token 数)}。未列出的模型使用
+# <llm_default_rate_limit>；某一项为 None 时不限制该项。
+llm_rate_limits = {"gpt-3.5-turbo": (3500, 90000), 
+                   "gpt-4": (200, 40000), 
+                   "text-davinci-003": (3000, 250000), 
+                   "text-embedding-ada-002": (3000, 1000000)}
+llm_default_rate_limit = (3000, 250000)
+# 聊天请求没有 max_tokens，按此数量预估回复的 token 数。
+llm_expected_completion_tokens = 256
+# 遇到限流类错误时的最大重试次数，以及指数退避的初始与最大等待时间（秒）。
+llm_max_retries = 6
+llm_backoff_base = 1.0
+llm_backoff_max = 60.0
+
+def set_llm_api_base(api_base): 
+    """
+    切换之后所有请求使用的 API 地址。<api_base> 为 None 时恢复为官方服务。
+    """
+    global llm_api_base
+    llm_api_base = api_base
+    openai.api_base = api_base or "https://api.openai.com/v1"
+
+
+if llm_api_base: 
+    set_llm_api_base(llm_api_base)
+
 def temp_sleep(seconds=0.1):
     """
     临时休眠函数，用于模拟请求间隔。
     """
     time.sleep(seconds)
 
-def ChatGPT_single_request(prompt): 
+
+# ============================================================================
+# ################[SECTION 0: LLM 响应缓存与速率限制] ###################
+# ============================================================================
+
+class LLMResponseCache: 
     """
-    向 OpenAI 发送单个请求并返回响应。
+    基于 SQLite 的持久化 LLM 响应缓存。
+
+    缓存键是 (模型, 参数, 渲染后的提示) 的 SHA-256 摘要，因此不同分支或回放
+    中渲染出相同提示的调用可以共享同一条记录。条目数超过 <max_entries> 时按
+    最近最少使用（LRU）的顺序淘汰。
+    """
+    def __init__(self, path, max_entries=200000, mode="readwrite"): 
+        self.path = path
+        self.max_entries = max_entries
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._tick = 0
+        self._count = 0
+
+    def _connect(self): 
+        if self._conn is None: 
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS llm_cache (
+                                    key TEXT PRIMARY KEY,
+                                    model TEXT,
+                                    response TEXT,
+                                    last_used INTEGER)""")
+            self._conn.execute("""CREATE INDEX IF NOT EXISTS llm_cache_lru 
+                                    ON llm_cache (last_used)""")
+            row = self._conn.execute(
+                    "SELECT MAX(last_used), COUNT(*) FROM llm_cache").fetchone()
+            self._tick = row[0] or 0
+            # 记录条数只在打开时统计一次，之后随插入和淘汰维护。
+            self._count = row[1]
+        return self._conn
+
+    def make_key(self, model, parameters, prompt): 
+        """
+        由模型名、参数字典和渲染后的提示生成缓存键。
+        """
+        raw = json.dumps([model, parameters, prompt], 
+                         sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key): 
+        """
+        查询缓存。命中时返回缓存的响应字符串，否则返回 None。
+        """
+        if self.mode == "off": 
+            return None
+        with self._lock: 
+            conn = self._connect()
+            row = conn.execute("SELECT response FROM llm_cache WHERE key = ?", 
+                               (key,)).fetchone()
+            if row is None: 
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.mode == "readwrite": 
+                self._tick += 1
+                conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", 
+                             (self._tick, key))
+                conn.commit()
+            return row[0]
+
+    def put(self, key, model, response): 
+        """
+        写入一条缓存记录，并在超出容量时淘汰最久未使用的记录。回放模式下不写入。
+        """
+        if self.mode != "readwrite": 
+            return
+        with self._lock: 
+            conn = self._connect()
+            self._tick += 1
+            exists = conn.execute("SELECT 1 FROM llm_cache WHERE key = ?", 
+                                  (key,)).fetchone()
+            conn.execute("""INSERT OR REPLACE INTO llm_cache 
+                              (key, model, response, last_used) 
+                            VALUES (?, ?, ?, ?)""", 
+                         (key, model, response, self._tick))
+            if not exists: 
+                self._count += 1
+            if self._count > self.max_entries: 
+                conn.execute("""DELETE FROM llm_cache WHERE key IN (
+                                  SELECT key FROM llm_cache 
+                                  ORDER BY last_used ASC LIMIT ?)""", 
+                             (self._count - self.max_entries,))
+                self._count = self.max_entries
+            conn.commit()
+
+    def stats(self): 
+        """
+        返回命中/未命中计数。
+        """
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": hit_rate}
+
+
+llm_cache = LLMResponseCache(llm_cache_path, llm_cache_max_entries, 
+                             llm_cache_mode)
+
+
+class SingleFlight: 
+    """
+    合并同时在途的相同调用。第一个调用者执行 <fn>()，在它完成之前以相同的键
+    到来的调用者等待同一个结果；异常同样会传给所有等待者。每个调用者得到结果
+    的一份深拷贝，因此各自的 func_clean_up 可以安全地修改它。调用完成后键即被
+    移除，之后的调用由持久化缓存负责去重。
+    """
+    def __init__(self): 
+        self.shared = 0
+        self._lock = threading.Lock()
+        # 键 -> Future
+        self._calls = dict()
+
+    def do(self, key, fn): 
+        with self._lock: 
+            future = self._calls.get(key)
+            leader = future is None
+            if leader: 
+                future = Future()
+                self._calls[key] = future
+            else: 
+                self.shared += 1
+
+        if not leader: 
+            return copy.deepcopy(future.result())
+        try: 
+            result = fn()
+        except BaseException as e: 
+            future.set_exception(e)
+            raise
+        else: 
+            future.set_result(result)
+            return copy.deepcopy(result)
+        finally: 
+            with self._lock: 
+                self._calls.pop(key, None)
+
+
+class AsyncSingleFlight: 
+    """
+    SingleFlight 的异步版本。在途的调用以任务的形式保存（每个事件循环各自一组），
+    单个等待者被取消不会取消其他等待者共享的任务。多个线程可能各自运行事件循环，
+    因此 <_calls> 和计数都在锁内修改。
     """
-    temp_sleep()
+    def __init__(self): 
+        self.shared = 0
+        self._lock = threading.Lock()
+        # (事件循环, 键) -> Task
+        self._calls = dict()
+
+    def _done(self, call_key): 
+        with self._lock: 
+            self._calls.pop(call_key, None)
+
+    async def do(self, key, fn): 
+        call_key = (asyncio.get_running_loop(), key)
+        with self._lock: 
+            task = self._calls.get(call_key)
+            if task is None: 
+                task = asyncio.ensure_future(fn())
+                self._calls[call_key] = task
+                task.add_done_callback(lambda _: self._done(call_key))
+            else: 
+                self.shared += 1
+        return copy.deepcopy(await asyncio.shield(task))
+
+
+llm_single_flight = SingleFlight()
+llm_async_single_flight = AsyncSingleFlight()
+
 
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo", 
-        messages=[{"role": "user", "content": prompt}]
-    )
+def flight_key(cache_key, func_validate, func_clean_up): 
+    """
+    single-flight 的键。func_validate / func_clean_up 通常是每次调用新建的闭包，
+    因此用它们的代码对象区分不同的 run_gpt_prompt_* 函数。
+    """
+    return (cache_key, 
+            getattr(func_validate, "__code__", func_validate), 
+            getattr(func_clean_up, "__code__", func_clean_up))
+
+
+# 可以通过等待后重试解决的错误：限流、服务暂时不可用、超时和连接错误。
+RETRYABLE_LLM_ERRORS = (openai.error.RateLimitError, 
+                        openai.error.ServiceUnavailableError, 
+                        openai.error.APIError, 
+                        openai.error.Timeout, 
+                        openai.error.APIConnectionError, 
+                        openai.error.TryAgain)
+
+
+class TokenBucket: 
+    """
+    令牌桶。容量为一分钟的额度，每秒恢复 额度/60。reserve() 立即扣除额度
+    （允许透支）并返回调用者需要等待的秒数，因此同步和异步的调用者可以共用
+    同一个桶，而不必在持有锁时等待。
+    """
+    def __init__(self, per_minute): 
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now): 
+        self.level = min(self.capacity, 
+                         self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        if self.level >= 0: 
+            return 0.0
+        return -self.level / self.rate
+
+    def refund(self, amount): 
+        self.level = min(self.capacity, self.level + amount)
+
+
+class LLMRateLimiter: 
+    """
+    所有 Persona 共享的速率限制器。每个模型各有一个请求数桶和一个 token 数桶，
+    请求在两者都有额度时才会发出。收到限流错误后，该模型的所有调用者都会暂停
+    一段退避时间，避免在额度耗尽时继续发出注定失败的请求。
+    """
+    def __init__(self, limits, default_limit): 
+        self.limits = limits
+        self.default_limit = default_limit
+        # 模型 -> (请求数桶, token 数桶)
+        self.buckets = dict()
+        # 模型 -> 暂停到的时刻（time.monotonic()）
+        self.paused_until = dict()
+        self.waited = 0.0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def _buckets(self, model): 
+        if model not in self.buckets: 
+            rpm, tpm = self.limits.get(model, self.default_limit)
+            self.buckets[model] = (TokenBucket(rpm) if rpm else None, 
+                                   TokenBucket(tpm) if tpm else None)
+        return self.buckets[model]
+
+    def reserve(self, model, tokens): 
+        """
+        扣除一次请求和 <tokens> 个 token 的额度，返回需要等待的秒数。
+        """
+        with self._lock: 
+            now = time.monotonic()
+            wait = max(self.paused_until.get(model, 0) - now, 0)
+            request_bucket, token_bucket = self._buckets(model)
+            if request_bucket: 
+                wait = max(wait, request_bucket.reserve(1, now))
+            if token_bucket: 
+                wait = max(wait, token_bucket.reserve(tokens, now))
+            self.waited += wait
+            return wait
+
+    def acquire(self, model, tokens): 
+        wait = self.reserve(model, tokens)
+        if wait: 
+            time.sleep(wait)
+
+    async def acquire_async(self, model, tokens): 
+        wait = self.reserve(model, tokens)
+        if wait: 
+            await asyncio.sleep(wait)
+
+    def settle(self, model, estimated, actual): 
+        """
+        按响应中实际使用的 token 数修正预估时扣除的额度。
+        """
+        if actual is None: 
+            return
+        with self._lock: 
+            token_bucket = self._buckets(model)[1]
+            if token_bucket: 
+                token_bucket.refund(estimated - actual)
+
+    def pause(self, model, seconds): 
+        """
+        让 <model> 的所有调用者至少等待 <seconds> 秒。
+        """
+        with self._lock: 
+            self.throttled += 1
+            self.paused_until[model] = max(self.paused_until.get(model, 0), 
+                                           time.monotonic() + seconds)
+
+    def stats(self): 
+        """
+        返回累计等待时间与收到的限流错误次数。
+        """
+        return {"waited_seconds": round(self.waited, 3), 
+                "throttled": self.throttled}
+
+
+llm_rate_limiter = LLMRateLimiter(llm_rate_limits, llm_default_rate_limit)
+
+
+def estimate_tokens(text): 
+    """
+    粗略估计文本的 token 数（英文约每 4 个字符一个 token）。
+    """
+    return len(text) // 4 + 1
+
+
+def response_tokens(response): 
+    try: 
+        return response["usage"]["total_tokens"]
+    except (KeyError, TypeError): 
+        return None
+
+
+def retry_delay(error, attempt): 
+    """
+    第 <attempt> 次重试前的等待时间：带完全抖动的指数退避。服务端给出
+    Retry-After 时至少等待该时间。
+    """
+    delay = random.uniform(0, min(llm_backoff_max, llm_backoff_base * 2 ** attempt))
+    headers = getattr(error, "headers", None) or {}
+    try: 
+        delay = max(delay, float(headers.get("retry-after", 0)))
+    except (TypeError, ValueError): 
+        pass
+    return delay
+
+
+def call_llm(model, tokens, request): 
+    """
+    在速率限制下调用 <request>() 并返回其结果。遇到限流类错误时暂停该模型并
+    按指数退避重试，重试 <llm_max_retries> 次后仍失败则抛出最后一次的错误。
+    """
+    for attempt in range(llm_max_retries + 1): 
+        llm_rate_limiter.acquire(model, tokens)
+        try: 
+            with llm_concurrency: 
+                response = request()
+        except RETRYABLE_LLM_ERRORS as e: 
+            if attempt == llm_max_retries: 
+                raise
+            llm_rate_limiter.pause(model, retry_delay(e, attempt))
+            continue
+        llm_rate_limiter.settle(model, tokens, response_tokens(response))
+        return response
+
+
+async def async_call_llm(model, tokens, request): 
+    """
+    call_llm 的可等待版本。<request>() 返回一个协程。
+    """
+    for attempt in range(llm_max_retries + 1): 
+        await llm_rate_limiter.acquire_async(model, tokens)
+        try: 
+            response = await request()
+        except RETRYABLE_LLM_ERRORS as e: 
+            if attempt == llm_max_retries: 
+                raise
+            llm_rate_limiter.pause(model, retry_delay(e, attempt))
+            continue
+        llm_rate_limiter.settle(model, tokens, response_tokens(response))
+        return response
+
+
+def chat_completion(prompt, model): 
+    """
+    在速率限制下发出一次聊天请求，返回回复文本。
+    """
+    completion = call_llm(model, 
+                          estimate_tokens(prompt) + llm_expected_completion_tokens, 
+                          lambda: openai.ChatCompletion.create(
+                                    model=model, 
+                                    messages=[{"role": "user", "content": prompt}]))
     return completion["choices"][0]["message"]["content"]
 
+def ChatGPT_single_request(prompt): 
+    """
+    向 OpenAI 发送单个请求并返回响应。
+    """
+    return chat_completion(prompt, "gpt-3.5-turbo")
+
 
 # ============================================================================
 # #####################[SECTION 1: CHATGPT-3 结构] ######################
@@ -34,14 +469,8 @@ def GPT4_request(prompt):
     """
     给定提示和 GPT 参数字典，向 OpenAI 发送请求并返回响应。
     """
-    temp_sleep()
-
     try: 
-        completion = openai.ChatCompletion.create(
-        model="gpt-4", 
-        messages=[{"role": "user", "content": prompt}]
-        )
-        return completion["choices"][0]["message"]["content"]
+        return chat_completion(prompt, "gpt-4")
 
     except: 
         print ("ChatGPT ERROR")
@@ -53,17 +482,34 @@ def ChatGPT_request(prompt):
     给定提示和 GPT 参数字典，向 OpenAI 发送请求并返回响应。
     """
     try: 
-        completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo", 
-        messages=[{"role": "user", "content": prompt}]
-        )
-        return completion["choices"][0]["message"]["content"]
+        return chat_completion(prompt, "gpt-3.5-turbo")
 
     except: 
         print ("ChatGPT ERROR")
         return "ChatGPT ERROR"
 
 
+def wrap_json_prompt(prompt, example_output, special_instruction, header=""): 
+    """
+    将提示包装为要求以 JSON 格式输出的聊天提示。
+    """
+    prompt = header + '"""\n' + prompt + '\n"""\n'
+    prompt += f"以 JSON 格式输出上述提示的响应。{special_instruction}\n"
+    prompt += "示例输出 JSON:\n"
+    prompt += '{"output": "' + str(example_output) + '"}'
+    return prompt
+
+
+def extract_json_output(gpt_response): 
+    """
+    从聊天响应中截取 JSON 并返回其中的 "output" 字段。
+    """
+    gpt_response = gpt_response.strip()
+    end_index = gpt_response.rfind('}') + 1
+    gpt_response = gpt_response[:end_index]
+    return json.loads(gpt_response)["output"]
+
+
 def GPT4_safe_generate_response(prompt, 
                                    example_output,
                                    special_instruction,
@@ -75,35 +521,57 @@ def GPT4_safe_generate_response(prompt,
     """
     生成 GPT-4 安全响应。
     """
-    prompt = 'GPT-3 提示：\n"""\n' + prompt + '\n"""\n'
-    prompt += f"以 JSON 格式输出上述提示的响应。{special_instruction}\n"
-    prompt += "示例输出 JSON:\n"
-    prompt += '{"output": "' + str(example_output) + '"}'
+    prompt = wrap_json_prompt(prompt, example_output, special_instruction, 
+                              'GPT-3 提示：\n')
 
     if verbose: 
         print ("CHAT GPT 提示")
         print (prompt)
 
-    for i in range(repeat): 
-
+    cache_key = llm_cache.make_key("gpt-4", {}, prompt)
+    cached = llm_cache.get(cache_key)
+    if cached is not None: 
         try: 
-            curr_gpt_response = GPT4_request(prompt).strip()
-            end_index = curr_gpt_response.rfind('}') + 1
-            curr_gpt_response = curr_gpt_response[:end_index]
-            curr_gpt_response = json.loads(curr_gpt_response)["output"]
+            cached = json.loads(cached)
+            if func_validate(cached, prompt=prompt): 
+                return func_clean_up(cached, prompt=prompt)
+        except: 
+            pass
 
-            if func_validate(curr_gpt_response, prompt=prompt): 
-                return func_clean_up(curr_gpt_response, prompt=prompt)
+    def fetch(): 
+        for i in range(repeat): 
 
-            if verbose: 
-                print ("---- 重复次数: \n", i, curr_gpt_response)
-                print (curr_gpt_response)
-                print ("~~~~")
+            try: 
+                curr_gpt_response = extract_json_output(GPT4_request(prompt))
 
-        except: 
-            pass
+                if func_validate(curr_gpt_response, prompt=prompt): 
+                    # 与原来一样，JSON 解析或清理失败时重试
+                    func_clean_up(copy.deepcopy(curr_gpt_response), prompt=prompt)
+                    llm_cache.put(cache_key, "gpt-4", json.dumps(curr_gpt_response))
+                    return True, curr_gpt_response
+
+                if verbose: 
+                    print ("---- 重复次数: \n", i, curr_gpt_response)
+                    print (curr_gpt_response)
+                    print ("~~~~")
+
+            except: 
+                pass
 
-    return False
+        return False, None
+
+    # 同一提示的并发请求只发出一次，共享经过验证的响应。
+    found, curr_gpt_response = llm_single_flight.do(
+                                 flight_key(cache_key, func_validate, func_clean_up), 
+                                 fetch)
+    if not found: 
+        return False
+    try: 
+        return func_clean_up(curr_gpt_response, prompt=prompt)
+    except: 
+        # 共享的响应只在领头调用者的闭包上验证过清理，本调用者单独重试
+        found, curr_gpt_response = fetch()
+        return func_clean_up(curr_gpt_response, prompt=prompt) if found else False
 
 
 def ChatGPT_safe_generate_response(prompt, 
@@ -117,35 +585,56 @@ def ChatGPT_safe_generate_response(prompt,
     """
     生成 ChatGPT 安全响应。
     """
-    prompt = '"""\n' + prompt + '\n"""\n'
-    prompt += f"以 JSON 格式输出上述提示的响应。{special_instruction}\n"
-    prompt += "示例输出 JSON:\n"
-    prompt += '{"output": "' + str(example_output) + '"}'
+    prompt = wrap_json_prompt(prompt, example_output, special_instruction)
 
     if verbose: 
         print ("CHAT GPT 提示")
         print (prompt)
 
-    for i in range(repeat): 
-
+    cache_key = llm_cache.make_key("gpt-3.5-turbo", {}, prompt)
+    cached = llm_cache.get(cache_key)
+    if cached is not None: 
         try: 
-            curr_gpt_response = ChatGPT_request(prompt).strip()
-            end_index = curr_gpt_response.rfind('}') + 1
-            curr_gpt_response = curr_gpt_response[:end_index]
-            curr_gpt_response = json.loads(curr_gpt_response)["output"]
+            cached = json.loads(cached)
+            if func_validate(cached, prompt=prompt): 
+                return func_clean_up(cached, prompt=prompt)
+        except: 
+            pass
 
-            if func_validate(curr_gpt_response, prompt=prompt): 
-                return func_clean_up(curr_gpt_response, prompt=prompt)
+    def fetch(): 
+        for i in range(repeat): 
 
-            if verbose: 
-                print ("---- 重复次数: \n", i, curr_gpt_response)
-                print (curr_gpt_response)
-                print ("~~~~")
+            try: 
+                curr_gpt_response = extract_json_output(ChatGPT_request(prompt))
 
-        except: 
-            pass
+                if func_validate(curr_gpt_response, prompt=prompt): 
+                    # 与原来一样，JSON 解析或清理失败时重试
+                    func_clean_up(copy.deepcopy(curr_gpt_response), prompt=prompt)
+                    llm_cache.put(cache_key, "gpt-3.5-turbo", 
+                                  json.dumps(curr_gpt_response))
+                    return True, curr_gpt_response
+
+                if verbose: 
+                    print ("---- 重复次数: \n", i, curr_gpt_response)
+                    print (curr_gpt_response)
+                    print ("~~~~")
+
+            except: 
+                pass
 
-    return False
+        return False, None
+
+    found, curr_gpt_response = llm_single_flight.do(
+                                 flight_key(cache_key, func_validate, func_clean_up), 
+                                 fetch)
+    if not found: 
+        return False
+    try: 
+        return func_clean_up(curr_gpt_response, prompt=prompt)
+    except: 
+        # 共享的响应只在领头调用者的闭包上验证过清理，本调用者单独重试
+        found, curr_gpt_response = fetch()
+        return func_clean_up(curr_gpt_response, prompt=prompt) if found else False
 
 
 def ChatGPT_safe_generate_response_OLD(prompt, 
@@ -161,18 +650,44 @@ def ChatGPT_safe_generate_response_OLD(prompt,
         print ("CHAT GPT 提示")
         print (prompt)
 
-    for i in range(repeat): 
+    cache_key = llm_cache.make_key("gpt-3.5-turbo", {}, prompt)
+    cached = llm_cache.get(cache_key)
+    if cached is not None: 
         try: 
-            curr_gpt_response = ChatGPT_request(prompt).strip()
-            if func_validate(curr_gpt_response, prompt=prompt): 
-                return func_clean_up(curr_gpt_response, prompt=prompt)
-            if verbose: 
-                print (f"---- 重复次数: {i}")
-                print (curr_gpt_response)
-                print ("~~~~")
-
+            if func_validate(cached, prompt=prompt): 
+                return func_clean_up(cached, prompt=prompt)
         except: 
             pass
+
+    def fetch(): 
+        for i in range(repeat): 
+            try: 
+                curr_gpt_response = ChatGPT_request(prompt).strip()
+                if func_validate(curr_gpt_response, prompt=prompt): 
+                    func_clean_up(copy.deepcopy(curr_gpt_response), prompt=prompt)
+                    if curr_gpt_response != "ChatGPT ERROR": 
+                        llm_cache.put(cache_key, "gpt-3.5-turbo", curr_gpt_response)
+                    return True, curr_gpt_response
+                if verbose: 
+                    print (f"---- 重复次数: {i}")
+                    print (curr_gpt_response)
+                    print ("~~~~")
+
+            except: 
+                pass
+        return False, None
+
+    found, curr_gpt_response = llm_single_flight.do(
+                                 flight_key(cache_key, func_validate, func_clean_up), 
+                                 fetch)
+    if found: 
+        try: 
+            return func_clean_up(curr_gpt_response, prompt=prompt)
+        except: 
+            # 共享的响应只在领头调用者的闭包上验证过清理，本调用者单独重试
+            found, curr_gpt_response = fetch()
+            if found: 
+                return func_clean_up(curr_gpt_response, prompt=prompt)
     print ("安全响应触发") 
     return fail_safe_response
 
@@ -185,40 +700,121 @@ def GPT_request(prompt, gpt_parameter):
     """
     给定提示和 GPT 参数字典，向 OpenAI 发送请求并返回响应。
     """
-    temp_sleep()
     try: 
-        response = openai.Completion.create(
-                    model=gpt_parameter["engine"],
-                    prompt=prompt,
-                    temperature=gpt_parameter["temperature"],
-                    max_tokens=gpt_parameter["max_tokens"],
-                    top_p=gpt_parameter["top_p"],
-                    frequency_penalty=gpt_parameter["frequency_penalty"],
-                    presence_penalty=gpt_parameter["presence_penalty"],
-                    stream=gpt_parameter["stream"],
-                    stop=gpt_parameter["stop"],)
+        response = call_llm(gpt_parameter["engine"], 
+                            estimate_tokens(prompt) + gpt_parameter["max_tokens"], 
+                            lambda: openai.Completion.create(
+                                      model=gpt_parameter["engine"],
+                                      prompt=prompt,
+                                      temperature=gpt_parameter["temperature"],
+                                      max_tokens=gpt_parameter["max_tokens"],
+                                      top_p=gpt_parameter["top_p"],
+                                      frequency_penalty=gpt_parameter["frequency_penalty"],
+                                      presence_penalty=gpt_parameter["presence_penalty"],
+                                      stream=gpt_parameter["stream"],
+                                      stop=gpt_parameter["stop"],))
         return response.choices[0].text
     except: 
         print ("TOKEN LIMIT EXCEEDED")
         return "TOKEN LIMIT EXCEEDED"
 
 
-def generate_prompt(curr_input, prompt_lib_file): 
+class PromptTemplate: 
     """
-    生成提示。
+    解析后的提示模板。
+
+    模板文件只读取一次：去掉 <commentblockmarker> 之前的注释部分，再按
+    !<INPUT n>! 占位符切分为文本片段与输入编号交替的列表，渲染时一次拼接完成。
+    """
+    marker = "<commentblockmarker>###</commentblockmarker>"
+    placeholder = re.compile(r"!<INPUT (\d+)>!")
+
+    def __init__(self, path): 
+        self.path = path
+        self.mtime = None
+        self.parsed = ([""], 0)
+        self.load()
+
+    def load(self): 
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, "r") as f: 
+            text = f.read()
+        if self.marker in text: 
+            text = text.split(self.marker)[1]
+        # 偶数位置为文本片段，奇数位置为输入编号
+        parts = self.placeholder.split(text)
+        for i in range(1, len(parts), 2): 
+            parts[i] = int(parts[i])
+        # 一次性替换，重新载入时并发的渲染只会看到完整的旧版本或新版本
+        self.parsed = (parts, max(parts[1::2], default=-1) + 1)
+        self.mtime = mtime
+
+    def is_stale(self): 
+        return os.stat(self.path).st_mtime != self.mtime
+
+    def render(self, curr_input, strict=None): 
+        """
+        用 <curr_input> 填充占位符。<strict> 为 None 时使用 <prompt_template_strict>。
+        """
+        if strict is None: 
+            strict = prompt_template_strict
+        parts, input_count = self.parsed
+        if len(curr_input) < input_count: 
+            if strict: 
+                raise ValueError(f"{self.path} expects {input_count} inputs, "
+                                 f"got {len(curr_input)}")
+            print (f"警告：{self.path} 需要 {input_count} 个输入，实际只有 "
+                   f"{len(curr_input)} 个，缺少的占位符保持原样")
+        pieces = list(parts)
+        for i in range(1, len(pieces), 2): 
+            if pieces[i] < len(curr_input): 
+                pieces[i] = curr_input[pieces[i]]
+            else: 
+                pieces[i] = f"!<INPUT {pieces[i]}>!"
+        return "".join(pieces).strip()
+
+
+class PromptTemplateRegistry: 
+    """
+    以文件路径为键缓存 <PromptTemplate>。<reload> 为 True 时，模板文件被修改后
+    在下一次使用时重新解析。
+    """
+    def __init__(self, reload=False): 
+        self.reload = reload
+        self.templates = dict()
+        self._lock = threading.Lock()
+
+    def get(self, path): 
+        template = self.templates.get(path)
+        if template is not None and not (self.reload and template.is_stale()): 
+            return template
+        with self._lock: 
+            template = self.templates.get(path)
+            if template is None: 
+                template = PromptTemplate(path)
+                self.templates[path] = template
+            elif self.reload and template.is_stale(): 
+                template.load()
+        return template
+
+    def clear(self): 
+        with self._lock: 
+            self.templates = dict()
+
+
+prompt_templates = PromptTemplateRegistry(prompt_template_reload)
+
+
+def generate_prompt(curr_input, prompt_lib_file, strict=None): 
+    """
+    生成提示。模板由 <prompt_templates> 解析并缓存。输入数量少于模板中的
+    占位符数量时，<strict>（默认取 <prompt_template_strict>）为 True 则抛出
+    ValueError，否则打印警告并保留缺少的占位符。
     """
     if type(curr_input) == type("string"): 
         curr_input = [curr_input]
     curr_input = [str(i) for i in curr_input]
-
-    f = open(prompt_lib_file, "r")
-    prompt = f.read()
-    f.close()
-    for count, i in enumerate(curr_input):   
-        prompt = prompt.replace(f"!<INPUT {count}>!", i)
-    if "<commentblockmarker>###</commentblockmarker>" in prompt: 
-        prompt = prompt.split("<commentblockmarker>###</commentblockmarker>")[1]
-    return prompt.strip()
+    return prompt_templates.get(prompt_lib_file).render(curr_input, strict)
 
 
 def safe_generate_response(prompt, 
@@ -234,26 +830,563 @@ def safe_generate_response(prompt,
     if verbose: 
         print (prompt)
 
-    for i in range(repeat): 
-        curr_gpt_response = GPT_request(prompt, gpt_parameter)
-        if func_validate(curr_gpt_response, prompt=prompt): 
-            return func_clean_up(curr_gpt_response, prompt=prompt)
-        if verbose: 
-            print ("---- 重复次数: ", i, curr_gpt_response)
-            print (curr_gpt_response)
-            print ("~~~~")
-    return fail_safe_response
+    cache_key = llm_cache.make_key(gpt_parameter["engine"], gpt_parameter, prompt)
+    cached = llm_cache.get(cache_key)
+    if cached is not None and func_validate(cached, prompt=prompt): 
+        return func_clean_up(cached, prompt=prompt)
+
+    def fetch(): 
+        for i in range(repeat): 
+            curr_gpt_response = GPT_request(prompt, gpt_parameter)
+            if func_validate(curr_gpt_response, prompt=prompt): 
+                if curr_gpt_response != "TOKEN LIMIT EXCEEDED": 
+                    llm_cache.put(cache_key, gpt_parameter["engine"], 
+                                  curr_gpt_response)
+                return True, curr_gpt_response
+            if verbose: 
+                print ("---- 重复次数: ", i, curr_gpt_response)
+                print (curr_gpt_response)
+                print ("~~~~")
+        return False, None
+
+    found, curr_gpt_response = llm_single_flight.do(
+                                 flight_key(cache_key, func_validate, func_clean_up), 
+                                 fetch)
+    if not found: 
+        return fail_safe_response
+    return func_clean_up(curr_gpt_response, prompt=prompt)
+
+
+def normalize_embedding_text(text): 
+    text = text.replace("\n", " ")
+    if not text: 
+        text = "this is blank"
+    return text
+
+
+class EmbeddingService: 
+    """
+    所有 Persona 共享的嵌入服务。
+
+    每段文本先查询内存缓存与持久化的 SQLite 缓存；未命中的文本进入待请求
+    队列，并发调用者在 <batch_window> 内加入队列的文本合并为一次多输入的
+    Embedding.create 请求。已经在请求中的文本不会被重复请求，后来的调用者
+    直接等待同一个结果。
+    """
+    def __init__(self, path, mode="readwrite", memory_max_entries=20000, 
+                 max_batch=64, batch_window=0.005): 
+        self.path = path
+        self.mode = mode
+        self.memory_max_entries = memory_max_entries
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+
+        self._lock = threading.Lock()
+        self._conn = None
+        # (model, text) -> float32 向量，按最近使用排序
+        self._memory = OrderedDict()
+        # (model, text) -> Future，正在请求中的文本
+        self._pending = dict()
+        # model -> 等待请求的文本列表
+        self._queue = dict()
+
+    def _connect(self): 
+        if self._conn is None: 
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                                    model TEXT,
+                                    text TEXT,
+                                    vector BLOB,
+                                    PRIMARY KEY (model, text))""")
+        return self._conn
+
+    def _remember(self, key, vector): 
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_max_entries: 
+            self._memory.popitem(last=False)
+
+    def _lookup(self, key): 
+        # 调用者需持有 self._lock
+        if key in self._memory: 
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if self.mode == "off": 
+            return None
+        row = self._connect().execute(
+                "SELECT vector FROM embeddings WHERE model = ? AND text = ?", 
+                key).fetchone()
+        if row is None: 
+            return None
+        vector = np.frombuffer(row[0], dtype=np.float32)
+        self._remember(key, vector)
+        return vector
+
+    def lookup(self, text, model="text-embedding-ada-002"): 
+        """
+        只查询缓存，命中时返回嵌入（列表），否则返回 None。
+        """
+        with self._lock: 
+            vector = self._lookup((model, normalize_embedding_text(text)))
+            if vector is None: 
+                self.misses += 1
+            else: 
+                self.hits += 1
+        return None if vector is None else vector.tolist()
+
+    def record_request(self): 
+        """
+        记录一次绕过批处理队列直接发出的请求（见 async_get_embedding）。
+        """
+        with self._lock: 
+            self.requests += 1
+
+    def store(self, items, model="text-embedding-ada-002"): 
+        """
+        将 [(文本, 嵌入)] 写入内存缓存和持久化缓存。
+        """
+        rows = []
+        with self._lock: 
+            for text, vector in items: 
+                key = (model, normalize_embedding_text(text))
+                vector = np.asarray(vector, dtype=np.float32)
+                self._remember(key, vector)
+                rows += [(key[0], key[1], vector.tobytes())]
+            if self.mode == "readwrite": 
+                conn = self._connect()
+                conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", 
+                                 rows)
+                conn.commit()
+
+    def _flush(self, model): 
+        while True: 
+            with self._lock: 
+                batch = self._queue.get(model, [])[:self.max_batch]
+                if not batch: 
+                    return
+                self._queue[model] = self._queue[model][len(batch):]
+                futures = [self._pending[(model, text)] for text in batch]
+                self.requests += 1
+
+            try: 
+                response = call_llm(model, 
+                                    sum(estimate_tokens(text) for text in batch), 
+                                    lambda: openai.Embedding.create(input=batch, 
+                                                                    model=model))
+                data = sorted(response['data'], key=lambda item: item['index'])
+                # 与缓存中保存的精度一致，使命中与未命中时返回相同的值
+                vectors = [np.asarray(item['embedding'], dtype=np.float32) 
+                           for item in data]
+                self.store(zip(batch, vectors), model)
+                for future, vector in zip(futures, vectors): 
+                    future.set_result(vector.tolist())
+            except Exception as e: 
+                for future in futures: 
+                    future.set_exception(e)
+            finally: 
+                with self._lock: 
+                    for text in batch: 
+                        self._pending.pop((model, text), None)
+
+    def get_embeddings(self, texts, model="text-embedding-ada-002"): 
+        """
+        返回 <texts> 中每段文本的嵌入（列表），顺序与输入相同。
+        """
+        texts = [normalize_embedding_text(text) for text in texts]
+        results = dict()
+        waiting = dict()
+        queued = False
+        with self._lock: 
+            for text in texts: 
+                key = (model, text)
+                if text in results or text in waiting: 
+                    continue
+                vector = self._lookup(key)
+                if vector is not None: 
+                    self.hits += 1
+                    results[text] = vector.tolist()
+                elif key in self._pending: 
+                    self.hits += 1
+                    waiting[text] = self._pending[key]
+                else: 
+                    self.misses += 1
+                    future = Future()
+                    self._pending[key] = future
+                    self._queue.setdefault(model, []).append(text)
+                    waiting[text] = future
+                    queued = True
+
+        if queued: 
+            if self.batch_window: 
+                time.sleep(self.batch_window)
+            self._flush(model)
+        for text, future in waiting.items(): 
+            results[text] = future.result()
+        return [results[text] for text in texts]
+
+    def stats(self): 
+        """
+        返回缓存命中/未命中计数与实际发出的请求数。
+        """
+        with self._lock: 
+            return {"hits": self.hits, "misses": self.misses, 
+                    "requests": self.requests}
+
+
+embedding_service = EmbeddingService(embedding_cache_path, llm_cache_mode, 
+                                     embedding_memory_max_entries, 
+                                     embedding_max_batch, 
+                                     embedding_batch_window)
+
+def get_embeddings(texts, model="text-embedding-ada-002"): 
+    """
+    批量获取文本嵌入，经由共享的嵌入服务去重、缓存并合并请求。
+    """
+    return embedding_service.get_embeddings(texts, model)
 
 
 def get_embedding(text, model="text-embedding-ada-002"):
     """
     获取文本嵌入。
     """
-    text = text.replace("\n", " ")
-    if not text: 
-        text = "this is blank"
-    return openai.Embedding.create(
-            input=[text], model=model)['data'][0]['embedding']
+    return embedding_service.get_embeddings([text], model)[0]
+
+
+# ============================================================================
+# ###################[SECTION 3: 异步 LLM 客户端] ####################
+# ============================================================================
+
+# 同时在途的 LLM 请求的最大数量（同步与异步、所有线程和事件循环合计）。
+llm_max_concurrency = 8
+
+
+class ConcurrencyLimiter: 
+    """
+    线程安全的并发上限，同时支持 with（同步）和 async with（异步）。
+
+    与 asyncio.Semaphore 不同，它不绑定到某个事件循环，因此步骤线程池中各自
+    运行 asyncio.run() 的多个事件循环以及同步调用共享同一个上限。释放时名额
+    直接交给排在最前面的等待者：同步等待者通过 threading.Event 唤醒，异步
+    等待者通过 call_soon_threadsafe 在它自己的事件循环中唤醒。
+    """
+    def __init__(self, limit): 
+        self.limit = limit
+        self.active = 0
+        self._lock = threading.Lock()
+        # 等待者：("thread", Event) 或 ("async", (事件循环, Future))
+        self._waiters = deque()
+
+    def set_limit(self, limit): 
+        with self._lock: 
+            self.limit = limit
+            while self._waiters and self.active < self.limit: 
+                self.active += 1
+                self._grant(self._waiters.popleft())
+
+    def _grant(self, waiter): 
+        # 调用时持有 self._lock，名额已计入 self.active。
+        kind, handle = waiter
+        if kind == "thread": 
+            handle.set()
+        else: 
+            loop, future = handle
+            loop.call_soon_threadsafe(self._grant_async, future)
+
+    def _grant_async(self, future): 
+        # 在等待者的事件循环中运行。等待者已被取消时把名额交给下一个等待者。
+        if future.done(): 
+            self.release()
+        else: 
+            future.set_result(None)
+
+    def acquire(self): 
+        with self._lock: 
+            if self.active < self.limit and not self._waiters: 
+                self.active += 1
+                return
+            event = threading.Event()
+            self._waiters.append(("thread", event))
+        event.wait()
+
+    async def acquire_async(self): 
+        with self._lock: 
+            if self.active < self.limit and not self._waiters: 
+                self.active += 1
+                return
+            loop = asyncio.get_running_loop()
+            waiter = ("async", (loop, loop.create_future()))
+            self._waiters.append(waiter)
+        future = waiter[1][1]
+        try: 
+            await future
+        except asyncio.CancelledError: 
+            with self._lock: 
+                if waiter in self._waiters: 
+                    self._waiters.remove(waiter)
+                    raise
+            # 名额已经交给了这个等待者：已经拿到时归还；否则 _grant_async
+            # 会发现 Future 已取消并归还。
+            if future.done() and not future.cancelled(): 
+                self.release()
+            raise
+
+    def release(self): 
+        with self._lock: 
+            if self._waiters and self.active <= self.limit: 
+                self._grant(self._waiters.popleft())
+            else: 
+                self.active -= 1
+
+    def __enter__(self): 
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc): 
+        self.release()
+
+    async def __aenter__(self): 
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc): 
+        self.release()
+
+
+llm_concurrency = ConcurrencyLimiter(llm_max_concurrency)
+
+
+def set_llm_concurrency(max_concurrency): 
+    """
+    设置 LLM 请求的并发上限，立即对所有线程和事件循环生效。
+    """
+    global llm_max_concurrency
+    llm_max_concurrency = max_concurrency
+    llm_concurrency.set_limit(max_concurrency)
+
+
+async def async_chat_request(prompt, model="gpt-3.5-turbo"): 
+    """
+    ChatGPT_request / GPT4_request 的可等待版本。
+    """
+    async def request(): 
+        async with llm_concurrency: 
+            return await openai.ChatCompletion.acreate(
+                model=model, 
+                messages=[{"role": "user", "content": prompt}])
+
+    try: 
+        completion = await async_call_llm(
+                       model, 
+                       estimate_tokens(prompt) + llm_expected_completion_tokens, 
+                       request)
+        return completion["choices"][0]["message"]["content"]
+    except: 
+        print ("ChatGPT ERROR")
+        return "ChatGPT ERROR"
+
+
+async def async_ChatGPT_request(prompt): 
+    return await async_chat_request(prompt, "gpt-3.5-turbo")
+
+
+async def async_GPT4_request(prompt): 
+    return await async_chat_request(prompt, "gpt-4")
+
+
+async def async_GPT_request(prompt, gpt_parameter): 
+    """
+    GPT_request 的可等待版本。
+    """
+    async def request(): 
+        async with llm_concurrency: 
+            return await openai.Completion.acreate(
+                model=gpt_parameter["engine"],
+                prompt=prompt,
+                temperature=gpt_parameter["temperature"],
+                max_tokens=gpt_parameter["max_tokens"],
+                top_p=gpt_parameter["top_p"],
+                frequency_penalty=gpt_parameter["frequency_penalty"],
+                presence_penalty=gpt_parameter["presence_penalty"],
+                stream=gpt_parameter["stream"],
+                stop=gpt_parameter["stop"],)
+
+    try: 
+        response = await async_call_llm(
+                     gpt_parameter["engine"], 
+                     estimate_tokens(prompt) + gpt_parameter["max_tokens"], 
+                     request)
+        return response.choices[0].text
+    except: 
+        print ("TOKEN LIMIT EXCEEDED")
+        return "TOKEN LIMIT EXCEEDED"
+
+
+async def async_get_embedding(text, model="text-embedding-ada-002"): 
+    """
+    get_embedding 的可等待版本。
+    """
+    cached = embedding_service.lookup(text, model)
+    if cached is not None: 
+        return cached
+    text = normalize_embedding_text(text)
+
+    async def request(): 
+        async with llm_concurrency: 
+            return await openai.Embedding.acreate(input=[text], model=model)
+
+    embedding_service.record_request()
+    response = await async_call_llm(model, estimate_tokens(text), request)
+    embedding = np.asarray(response['data'][0]['embedding'], dtype=np.float32)
+    embedding_service.store([(text, embedding)], model)
+    return embedding.tolist()
+
+
+async def _async_chat_safe_generate_response(prompt, 
+                                             model,
+                                             repeat,
+                                             fail_safe_response,
+                                             func_validate,
+                                             func_clean_up,
+                                             verbose): 
+    if verbose: 
+        print ("CHAT GPT 提示")
+        print (prompt)
+
+    cache_key = llm_cache.make_key(model, {}, prompt)
+    cached = llm_cache.get(cache_key)
+    if cached is not None: 
+        try: 
+            cached = json.loads(cached)
+            if func_validate(cached, prompt=prompt): 
+                return func_clean_up(cached, prompt=prompt)
+        except: 
+            pass
+
+    async def fetch(): 
+        for i in range(repeat): 
+
+            try: 
+                curr_gpt_response = extract_json_output(
+                                      await async_chat_request(prompt, model))
+
+                if func_validate(curr_gpt_response, prompt=prompt): 
+                    # 与原来一样，JSON 解析或清理失败时重试
+                    func_clean_up(copy.deepcopy(curr_gpt_response), prompt=prompt)
+                    llm_cache.put(cache_key, model, json.dumps(curr_gpt_response))
+                    return True, curr_gpt_response
+
+                if verbose: 
+                    print ("---- 重复次数: \n", i, curr_gpt_response)
+                    print (curr_gpt_response)
+                    print ("~~~~")
+
+            except: 
+                pass
+
+        return False, None
+
+    found, curr_gpt_response = await llm_async_single_flight.do(
+                                 flight_key(cache_key, func_validate, func_clean_up), 
+                                 fetch)
+    if not found: 
+        return False
+    try: 
+        return func_clean_up(curr_gpt_response, prompt=prompt)
+    except: 
+        # 共享的响应只在领头调用者的闭包上验证过清理，本调用者单独重试
+        found, curr_gpt_response = await fetch()
+        return func_clean_up(curr_gpt_response, prompt=prompt) if found else False
+
+
+async def async_ChatGPT_safe_generate_response(prompt, 
+                                               example_output,
+                                               special_instruction,
+                                               repeat=3,
+                                               fail_safe_response="error",
+                                               func_validate=None,
+                                               func_clean_up=None,
+                                               verbose=False): 
+    """
+    ChatGPT_safe_generate_response 的可等待版本。
+    """
+    prompt = wrap_json_prompt(prompt, example_output, special_instruction)
+    return await _async_chat_safe_generate_response(
+                   prompt, "gpt-3.5-turbo", repeat, fail_safe_response, 
+                   func_validate, func_clean_up, verbose)
+
+
+async def async_GPT4_safe_generate_response(prompt, 
+                                            example_output,
+                                            special_instruction,
+                                            repeat=3,
+                                            fail_safe_response="error",
+                                            func_validate=None,
+                                            func_clean_up=None,
+                                            verbose=False): 
+    """
+    GPT4_safe_generate_response 的可等待版本。
+    """
+    prompt = wrap_json_prompt(prompt, example_output, special_instruction, 
+                              'GPT-3 提示：\n')
+    return await _async_chat_safe_generate_response(
+                   prompt, "gpt-4", repeat, fail_safe_response, 
+                   func_validate, func_clean_up, verbose)
+
+
+async def async_safe_generate_response(prompt, 
+                                       gpt_parameter,
+                                       repeat=5,
+                                       fail_safe_response="error",
+                                       func_validate=None,
+                                       func_clean_up=None,
+                                       verbose=False): 
+    """
+    safe_generate_response 的可等待版本。
+    """
+    if verbose: 
+        print (prompt)
+
+    cache_key = llm_cache.make_key(gpt_parameter["engine"], gpt_parameter, prompt)
+    cached = llm_cache.get(cache_key)
+    if cached is not None and func_validate(cached, prompt=prompt): 
+        return func_clean_up(cached, prompt=prompt)
+
+    async def fetch(): 
+        for i in range(repeat): 
+            curr_gpt_response = await async_GPT_request(prompt, gpt_parameter)
+            if func_validate(curr_gpt_response, prompt=prompt): 
+                if curr_gpt_response != "TOKEN LIMIT EXCEEDED": 
+                    llm_cache.put(cache_key, gpt_parameter["engine"], 
+                                  curr_gpt_response)
+                return True, curr_gpt_response
+            if verbose: 
+                print ("---- 重复次数: ", i, curr_gpt_response)
+                print (curr_gpt_response)
+                print ("~~~~")
+        return False, None
+
+    found, curr_gpt_response = await llm_async_single_flight.do(
+                                 flight_key(cache_key, func_validate, func_clean_up), 
+                                 fetch)
+    if not found: 
+        return fail_safe_response
+    return func_clean_up(curr_gpt_response, prompt=prompt)
+
+
+def run_llm_batch(coroutines): 
+    """
+    在新的事件循环中并发运行一组 LLM 协程，并按输入顺序返回结果。
+    同时在途的请求数受 <llm_max_concurrency> 限制。
+
+    示例：
+        outputs = run_llm_batch([async_ChatGPT_request(p) for p in prompts])
+    """
+    async def _gather(): 
+        return await asyncio.gather(*coroutines)
+    return asyncio.run(_gather())
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import numpy as np
+from collections import deque
 
 # 打印迷宫
 def print_maze(maze):
@@ -151,6 +152,179 @@ def path_finder_v2(a, start, end, collision_block_char, verbose=False):
     the_path.reverse()
     return the_path
 
+# 碰撞网格缓存：{id(迷宫): (迷宫, 碰撞块字符, (网格, 宽, 高))}
+_collision_grid_cache = dict()
+
+# 将迷宫转换为按行展开的碰撞数组（1 表示不可通行），并按迷宫对象缓存
+def get_collision_grid(maze, collision_block_char):
+    cached = _collision_grid_cache.get(id(maze))
+    if cached and cached[0] is maze and cached[1] == collision_block_char: 
+        return cached[2]
+
+    height = len(maze)
+    width = len(maze[0])
+    grid = bytearray(width * height)
+    for i, row in enumerate(maze): 
+        for j, item in enumerate(row): 
+            if item == collision_block_char: 
+                grid[i * width + j] = 1
+
+    _collision_grid_cache[id(maze)] = (maze, collision_block_char,
+                                       (grid, width, height))
+    return grid, width, height
+
+# 从 <start> 出发按层次标记格子，直到 <ends> 中第一个被标记的终点所在的层次
+# 全部标记完成（或所有可到达的格子都已访问）。坐标为 (行, 列)。
+# 返回的标记 m[格子] 与 path_finder_v2 相同：起点为1，未访问的格子不在字典中。
+def bfs_labels(a, start, ends, collision_block_char):
+    grid, width, height = get_collision_grid(a, collision_block_char)
+
+    start_cell = start[0] * width + start[1]
+    end_cells = {end[0] * width + end[1] for end in ends}
+    m = {start_cell: 1}
+    found = 1 if start_cell in end_cells else 0
+    queue = deque([start_cell])
+    while queue:
+        cell = queue[0]
+        if found and m[cell] >= found: 
+            break
+        queue.popleft()
+        k = m[cell] + 1
+        i, j = divmod(cell, width)
+        neighbors = []
+        if i > 0: 
+            neighbors += [cell - width]
+        if j > 0: 
+            neighbors += [cell - 1]
+        if i < height - 1: 
+            neighbors += [cell + width]
+        if j < width - 1: 
+            neighbors += [cell + 1]
+        for n in neighbors: 
+            if n not in m and not grid[n]: 
+                m[n] = k
+                queue.append(n)
+                if not found and n in end_cells: 
+                    found = k
+
+    return m, width, height
+
+# 从 <end> 沿标记回溯到起点，邻居的优先顺序与 path_finder_v2 相同（上、左、下、右）
+def backtrack_labels(m, end, width, height):
+    cell = end[0] * width + end[1]
+    k = m.get(cell, 0)
+    the_path = [(end[0], end[1])]
+    while k > 1:
+        i, j = divmod(cell, width)
+        if i > 0 and m.get(cell - width) == k-1:
+            cell -= width
+        elif j > 0 and m.get(cell - 1) == k-1:
+            cell -= 1
+        elif i < height - 1 and m.get(cell + width) == k-1:
+            cell += width
+        else:
+            cell += 1
+        the_path.append(divmod(cell, width))
+        k -= 1
+
+    the_path.reverse()
+    return the_path
+
+# 基于队列的广度优先搜索
+# 与 path_finder_v2 的层次标记和回溯顺序（上、左、下、右）相同，因此返回完全相同
+# 的路径；但每个格子只访问一次，并且没有 150 步的上限。无法到达终点时同样返回
+# [end]。
+def path_finder_v3(a, start, end, collision_block_char, verbose=False):
+    m, width, height = bfs_labels(a, start, [end], collision_block_char)
+    if verbose: 
+        print ("已访问的格子数:", len(m))
+    return backtrack_labels(m, end, width, height)
+
+# 多目标搜索：一次广度优先搜索找到离 <start> 最近的可到达目标
+# 坐标与 path_finder 相同，使用 (x, y)。距离相同时取 <targets> 中靠前的目标，
+# 返回的路径与 path_finder(maze, start, 该目标) 完全相同。所有目标都无法到达时，
+# 与 path_finder 一样返回第一个目标和 [目标]。
+def path_finder_to_nearest(maze, start, targets, collision_block_char):
+    ends = [(target[1], target[0]) for target in targets]
+    m, width, height = bfs_labels(maze, (start[1], start[0]), ends,
+                                  collision_block_char)
+
+    closest = 0
+    closest_k = None
+    for count, end in enumerate(ends): 
+        k = m.get(end[0] * width + end[1])
+        if k and (closest_k is None or k < closest_k): 
+            closest = count
+            closest_k = k
+
+    path = backtrack_labels(m, ends[closest], width, height)
+    return targets[closest], [(i[1], i[0]) for i in path]
+
+# 多源广度优先搜索：计算每个格子到 <sources> 中最近一个格子的步数
+# <sources> 与 path_finder 相同，使用 (x, y) 坐标。返回形状为 (高, 宽) 的 int32
+# 数组，无法到达的格子为 -1。与 path_finder 一致，碰撞格子不能作为终点，因此
+# 被忽略。
+def distance_field(a, sources, collision_block_char):
+    grid, width, height = get_collision_grid(a, collision_block_char)
+
+    dist = [-1] * (width * height)
+    queue = deque()
+    for x, y in sources: 
+        cell = y * width + x
+        if not grid[cell] and dist[cell] < 0: 
+            dist[cell] = 0
+            queue.append(cell)
+
+    while queue:
+        cell = queue.popleft()
+        k = dist[cell] + 1
+        i, j = divmod(cell, width)
+        if i > 0: 
+            n = cell - width
+            if dist[n] < 0 and not grid[n]: 
+                dist[n] = k
+                queue.append(n)
+        if j > 0: 
+            n = cell - 1
+            if dist[n] < 0 and not grid[n]: 
+                dist[n] = k
+                queue.append(n)
+        if i < height - 1: 
+            n = cell + width
+            if dist[n] < 0 and not grid[n]: 
+                dist[n] = k
+                queue.append(n)
+        if j < width - 1: 
+            n = cell + 1
+            if dist[n] < 0 and not grid[n]: 
+                dist[n] = k
+                queue.append(n)
+
+    return np.array(dist, dtype=np.int32).reshape(height, width)
+
+# 沿距离场的梯度从 <start> 走到最近的源格子，返回包含起点的 (x, y) 路径
+# 起点无法到达任何源格子时返回 None。
+def walk_distance_field(field, start):
+    height, width = field.shape
+    x, y = start
+    k = int(field[y, x])
+    if k < 0: 
+        return None
+
+    the_path = [(x, y)]
+    while k > 0:
+        if y > 0 and field[y - 1, x] == k-1:
+            y -= 1
+        elif x > 0 and field[y, x - 1] == k-1:
+            x -= 1
+        elif y < height - 1 and field[y + 1, x] == k-1:
+            y += 1
+        else:
+            x += 1
+        the_path.append((x, y))
+        k -= 1
+    return the_path
+
 # 找到最近的坐标
 def closest_coordinate(curr_coordinate, target_coordinates): 
     min_dist = None
@@ -176,7 +350,7 @@ def path_finder(maze, start, end, collision_block_char, verbose=False):
     end = (end[1], end[0])
     # 紧急修补结束
 
-    path = path_finder_v2(maze, start, end, collision_block_char, verbose)
+    path = path_finder_v3(maze, start, end, collision_block_char, verbose)
 
     new_path = []
     for i in path: 
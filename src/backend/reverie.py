@@ -7,6 +7,7 @@ import math
 import os
 import shutil
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from selenium import webdriver
 
@@ -59,10 +60,13 @@ class ReverieServer:
             self.personas[persona_name] = curr_persona
             self.personas_tile[persona_name] = (p_x, p_y)
             # 将人物对象添加到对应的迷宫方块中
-            self.maze.tiles[p_y][p_x]["events"].add(curr_persona.scratch
-                                                      .get_curr_event_and_desc())
+            self.maze.add_event_from_tile(curr_persona.scratch
+                                            .get_curr_event_and_desc(), (p_x, p_y))
 
         self.server_sleep = 0.1
+        # <step_workers> 大于1时，每一步中各Persona的感知/检索、规划与反思
+        # 阶段会在线程池中并发执行（见 move_personas）。
+        self.step_workers = 1
 
         curr_sim_code = dict()
         curr_sim_code["sim_code"] = self.sim_code
@@ -96,6 +100,9 @@ class ReverieServer:
             save_folder = f"{sim_folder}/personas/{persona_name}/bootstrap_memory"
             persona.save(save_folder)
 
+        # 将运行中新计算的距离场写回缓存
+        self.maze.save_distance_fields()
+
 
     def start_path_tester_server(self): 
         # 定义函数用于打印树结构
@@ -169,7 +176,175 @@ class ReverieServer:
             time.sleep(self.server_sleep * 10)
 
 
+    def move_personas(self, pool=None): 
+        """
+        让所有Persona完成一步认知循环，返回 {persona_name: execution}。
+
+        没有线程池时按顺序调用 persona.move()。有线程池时分阶段执行，每个阶段
+        之间等待全部完成：
+          1. 感知/检索：只读取迷宫与自身记忆，并发执行。
+          2. plan_schedule（长期规划与确定行动，绝大部分 LLM 调用）：只修改
+             自身状态，并发执行。
+          3. choose_reaction（决定是否对话或等待）：只读取其他Persona在阶段2
+             之后的状态，并发执行。
+          4. 对话会同时修改对话双方，因此先按Persona名字顺序分配对话：
+             一个Persona在本步中只能参与一次对话，已被分配的Persona的其他
+             反应被放弃。分配后的各组反应互不相交，再并发执行。
+          5. finish_plan、反思（只写入自身记忆）并发执行；最后按顺序执行
+             execute。
+        因此结果与线程调度无关。与顺序执行不同的是，每个Persona在阶段3看到的
+        是其他Persona本步规划之后的状态，而不取决于字典中的先后顺序。
+        """
+        executions = dict()
+        if pool is None: 
+            for persona_name, persona in self.personas.items(): 
+                executions[persona_name] = persona.move(
+                    self.maze, self.personas, self.personas_tile[persona_name], 
+                    self.curr_time)
+            return executions
+
+        def run_all(func, names): 
+            futures = {name: pool.submit(func, self.personas[name]) 
+                       for name in names}
+            return {name: futures[name].result() for name in names}
+
+        names = list(self.personas.keys())
+        begun = run_all(lambda persona: persona.begin_move(
+                            self.maze, self.personas_tile[persona.name], 
+                            self.curr_time), 
+                        names)
+
+        run_all(lambda persona: persona.plan_schedule(
+                    self.maze, begun[persona.name][0]), 
+                names)
+
+        reactions = run_all(lambda persona: persona.choose_reaction(
+                                self.personas, begun[persona.name][1]), 
+                            names)
+
+        # 按名字顺序分配对话，保证每个Persona最多参与一个反应
+        claimed = set()
+        accepted = dict()
+        for persona_name in sorted(names): 
+            reaction_mode = reactions[persona_name]
+            if not reaction_mode or persona_name in claimed: 
+                continue
+            partner = reaction_partner(reaction_mode)
+            if partner in claimed: 
+                continue
+            claimed.add(persona_name)
+            if partner: 
+                claimed.add(partner)
+            accepted[persona_name] = reaction_mode
+        run_all(lambda persona: persona.react(self.maze, self.personas, 
+                                              accepted[persona.name]), 
+                sorted(accepted))
+
+        plans = run_all(lambda persona: persona.finish_plan(), names)
+        run_all(lambda persona: persona.reflect(), names)
+
+        for persona_name, persona in self.personas.items(): 
+            executions[persona_name] = persona.execute(self.maze, self.personas, 
+                                                       plans[persona_name])
+        return executions
+
+    def apply_environment(self, new_env, game_obj_cleanup): 
+        """
+        将新的环境状态（每个Persona所在的瓦片）应用到迷宫上。
+
+        输入：
+          new_env：{persona_name: {"x": x, "y": y, ...}}，即 environment/<step>.json 的内容。
+          game_obj_cleanup：上一步留下的需要恢复为空闲的游戏对象事件。
+        输出：
+          这一步的 game_obj_cleanup。
+        """
+        for key, val in game_obj_cleanup.items(): 
+            self.maze.turn_event_from_tile_idle(key, val)
+        game_obj_cleanup = dict()
+        for persona_name, persona in self.personas.items(): 
+            curr_tile = self.personas_tile[persona_name]
+            new_tile = (new_env[persona_name]["x"], 
+                        new_env[persona_name]["y"])
+            self.personas_tile[persona_name] = new_tile
+            self.maze.remove_subject_events_from_tile(persona.name, curr_tile)
+            self.maze.add_event_from_tile(persona.scratch
+                                        .get_curr_event_and_desc(), new_tile)
+
+            if not persona.scratch.planned_path: 
+                game_obj_cleanup[persona.scratch
+                                .get_curr_obj_event_and_desc()] = new_tile
+                self.maze.add_event_from_tile(persona.scratch
+                                    .get_curr_obj_event_and_desc(), new_tile)
+                blank = (persona.scratch.get_curr_obj_event_and_desc()[0], 
+                        None, None, None)
+                self.maze.remove_event_from_tile(blank, new_tile)
+        return game_obj_cleanup
+
+
+    def run_step(self, new_env, game_obj_cleanup, pool=None): 
+        """
+        在给定的环境状态上运行一步模拟：应用环境、让所有Persona行动、写出
+        movement/<step>.json，并推进步数与时间。
+
+        输出：
+          (movements, game_obj_cleanup)
+        """
+        sim_folder = f"{fs_storage}/{self.sim_code}"
+        game_obj_cleanup = self.apply_environment(new_env, game_obj_cleanup)
+
+        movements = {"persona": dict(), 
+                    "meta": dict()}
+        executions = self.move_personas(pool)
+        for persona_name, persona in self.personas.items(): 
+            next_tile, pronunciatio, description = executions[persona_name]
+            movements["persona"][persona_name] = {}
+            movements["persona"][persona_name]["movement"] = next_tile
+            movements["persona"][persona_name]["pronunciatio"] = pronunciatio
+            movements["persona"][persona_name]["description"] = description
+            movements["persona"][persona_name]["chat"] = (persona
+                                                        .scratch.chat)
+
+        movements["meta"]["curr_time"] = (self.curr_time 
+                                        .strftime("%B %d, %Y, %H:%M:%S"))
+
+        curr_move_file = f"{sim_folder}/movement/{self.step}.json"
+        with open(curr_move_file, "w") as outfile: 
+            outfile.write(json.dumps(movements, indent=2))
+
+        self.step += 1
+        self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
+        return movements, game_obj_cleanup
+
+
+    def movements_to_environment(self, movements): 
+        """
+        根据一步的 movements 计算下一步的环境状态，即前端在每个Persona走到
+        目标瓦片后通过 process_environment 写回的内容。
+        """
+        new_env = dict()
+        for persona_name, movement in movements["persona"].items(): 
+            new_env[persona_name] = {"maze": self.maze.maze_name, 
+                                     "x": movement["movement"][0], 
+                                     "y": movement["movement"][1]}
+        return new_env
+
+
+    def make_step_pool(self): 
+        if self.step_workers > 1: 
+            return ThreadPoolExecutor(max_workers=self.step_workers)
+        return None
+
+
     def start_server(self, int_counter): 
+        pool = self.make_step_pool()
+        try: 
+            self._run_server_loop(int_counter, pool)
+        finally: 
+            if pool: 
+                pool.shutdown()
+
+
+    def _run_server_loop(self, int_counter, pool): 
         sim_folder = f"{fs_storage}/{self.sim_code}"
         game_obj_cleanup = dict()
 
@@ -186,55 +361,50 @@ class ReverieServer:
                     pass
             
                 if env_retrieved: 
-                    for key, val in game_obj_cleanup.items(): 
-                        self.maze.turn_event_from_tile_idle(key, val)
-                    game_obj_cleanup = dict()
-                    for persona_name, persona in self.personas.items(): 
-                        curr_tile = self.personas_tile[persona_name]
-                        new_tile = (new_env[persona_name]["x"], 
-                                    new_env[persona_name]["y"])
-                        self.personas_tile[persona_name] = new_tile
-                        self.maze.remove_subject_events_from_tile(persona.name, curr_tile)
-                        self.maze.add_event_from_tile(persona.scratch
-                                                    .get_curr_event_and_desc(), new_tile)
-
-                        if not persona.scratch.planned_path: 
-                            game_obj_cleanup[persona.scratch
-                                            .get_curr_obj_event_and_desc()] = new_tile
-                            self.maze.add_event_from_tile(persona.scratch
-                                                .get_curr_obj_event_and_desc(), new_tile)
-                            blank = (persona.scratch.get_curr_obj_event_and_desc()[0], 
-                                    None, None, None)
-                            self.maze.remove_event_from_tile(blank, new_tile)
-
-                    movements = {"persona": dict(), 
-                                "meta": dict()}
-                    for persona_name, persona in self.personas.items(): 
-                        next_tile, pronunciatio, description = persona.move(
-                        self.maze, self.personas, self.personas_tile[persona_name], 
-                        self.curr_time)
-                        movements["persona"][persona_name] = {}
-                        movements["persona"][persona_name]["movement"] = next_tile
-                        movements["persona"][persona_name]["pronunciatio"] = pronunciatio
-                        movements["persona"][persona_name]["description"] = description
-                        movements["persona"][persona_name]["chat"] = (persona
-                                                                    .scratch.chat)
-
-                    movements["meta"]["curr_time"] = (self.curr_time 
-                                                    .strftime("%B %d, %Y, %H:%M:%S"))
-
-                    curr_move_file = f"{sim_folder}/movement/{self.step}.json"
-                    with open(curr_move_file, "w") as outfile: 
-                        outfile.write(json.dumps(movements, indent=2))
-
-                    self.step += 1
-                    self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
-
+                    _, game_obj_cleanup = self.run_step(new_env, game_obj_cleanup, pool)
                     int_counter -= 1
                     
             time.sleep(self.server_sleep)
 
 
+    def run_steps(self, int_counter, write_environment=True): 
+        """
+        无前端（headless）地连续运行 <int_counter> 步。
+
+        每一步的环境状态由上一步的 movements 直接算出（见
+        movements_to_environment），不等待浏览器写回 environment 文件，也不轮询。
+        第一步使用已有的 environment/<step>.json。write_environment 为 True 时
+        仍写出每一步的 environment/<step>.json，使模拟文件夹与有前端时的一致，
+        之后可以继续用前端运行。
+
+        输入：
+          int_counter：要运行的步数。
+        输出：
+          最后一步的 movements；int_counter 为 0 时返回 None。
+        """
+        sim_folder = f"{fs_storage}/{self.sim_code}"
+        with open(f"{sim_folder}/environment/{self.step}.json") as json_file:
+            new_env = json.load(json_file)
+
+        movements = None
+        game_obj_cleanup = dict()
+        pool = self.make_step_pool()
+        try: 
+            for _ in range(int_counter): 
+                movements, game_obj_cleanup = self.run_step(new_env, 
+                                                            game_obj_cleanup, 
+                                                            pool)
+                new_env = self.movements_to_environment(movements)
+                if write_environment: 
+                    curr_env_file = f"{sim_folder}/environment/{self.step}.json"
+                    with open(curr_env_file, "w") as outfile: 
+                        outfile.write(json.dumps(new_env, indent=2))
+        finally: 
+            if pool: 
+                pool.shutdown()
+        return movements
+
+
     def open_server(self): 
         print ("注意：本模拟包中的代理是由生成代理架构和LLM支持的计算构造。我们")
         print ("澄清这些代理缺乏类似人类的代理、意识和独立决策能力。\n---")
@@ -262,6 +432,13 @@ class ReverieServer:
                 elif sim_command.lower() == "save": 
                     self.save()
 
+                elif sim_command[:17].lower() == "set step workers ": 
+                    self.step_workers = int(sim_command.split()[-1])
+
+                elif sim_command[:13].lower() == "headless run ": 
+                    int_count = int(sim_command.split()[-1])
+                    self.run_steps(int_count)
+
                 elif sim_command[:3].lower() == "run": 
                     int_count = int(sim_command.split()[-1])
                     self.start_server(int_count)
@@ -321,6 +498,35 @@ class ReverieServer:
                     ret_str += f'{self.curr_time.strftime("%B %d, %Y, %H:%M:%S")}\n'
                     ret_str += f'steps: {self.step}'
 
+                elif ("enable ann index" 
+                    in sim_command[:16].lower()): 
+                    for persona_name, persona in self.personas.items(): 
+                        persona.a_mem.enable_ann_index()
+
+                elif ("enable distance fields" 
+                    in sim_command[:22].lower()): 
+                    self.maze.enable_distance_fields()
+
+                elif ("enable nav graph" 
+                    in sim_command[:16].lower()): 
+                    self.maze.enable_nav_graph()
+
+                elif sim_command[:17].lower() == "set llm api base ": 
+                    # 参数为 default 时恢复为官方服务。
+                    api_base = sim_command[17:].strip()
+                    set_llm_api_base(None if api_base == "default" else api_base)
+
+                elif ("print llm cache stats" 
+                    in sim_command.lower()): 
+                    for key, val in llm_cache.stats().items(): 
+                        ret_str += f"{key}: {val}\n"
+                    for key, val in embedding_service.stats().items(): 
+                        ret_str += f"embedding {key}: {val}\n"
+                    for key, val in llm_rate_limiter.stats().items(): 
+                        ret_str += f"rate limit {key}: {val}\n"
+                    ret_str += (f"shared in-flight calls: "
+                                f"{llm_single_flight.shared + llm_async_single_flight.shared}\n")
+
                 elif ("print tile event" 
                     in sim_command[:16].lower()): 
                     cooordinate = [int(i.strip()) for i in sim_command[16:].split(",")]
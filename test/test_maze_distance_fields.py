@@ -0,0 +1,67 @@
+"""
+检查距离场：按需计算的距离场会写回缓存，并以 int16 保存。
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "backend"))
+maze_module = pytest.importorskip("maze")
+
+
+def make_maze(width=20, height=12):
+    """
+    构建一个不读取任何文件的小迷宫：四周是墙，两个地址分别在左右两端。
+    """
+    wall = maze_module.collision_block_id
+    collision_maze = [["0"] * width for _ in range(height)]
+    for x in range(width):
+        collision_maze[0][x] = wall
+        collision_maze[height - 1][x] = wall
+    for y in range(height):
+        collision_maze[y][0] = wall
+        collision_maze[y][width - 1] = wall
+
+    maze = maze_module.Maze.__new__(maze_module.Maze)
+    maze.maze_width = width
+    maze.maze_height = height
+    maze.collision_layer = np.array(collision_maze) == wall
+    maze.address_tiles = {"world:left": {(1, 5)}, "world:right": {(18, 5)}}
+    maze.distance_fields = None
+    return maze
+
+
+def test_lazy_fields_are_persisted(tmp_path):
+    cache_path = str(tmp_path / "distance_fields.npz")
+    maze = make_maze()
+    maze.enable_distance_fields(cache_path, precompute=False)
+    assert not os.path.exists(cache_path)
+
+    path = maze.path_to_address("world:left", (10, 5))
+    assert path[0] == (10, 5) and path[-1] == (1, 5) and len(path) == 10
+    assert maze.distance_fields["world:left"].dtype == np.int16
+    maze.save_distance_fields()
+
+    reloaded = make_maze()
+    reloaded.enable_distance_fields(cache_path, precompute=False)
+    assert list(reloaded.distance_fields) == ["world:left"]
+    assert np.array_equal(reloaded.distance_fields["world:left"],
+                          maze.distance_fields["world:left"])
+
+    # 再计算一个地址后，缓存同时包含新旧两个距离场
+    reloaded.path_to_address("world:right", (10, 5))
+    reloaded.save_distance_fields()
+    again = make_maze()
+    again.enable_distance_fields(cache_path, precompute=False)
+    assert sorted(again.distance_fields) == ["world:left", "world:right"]
+
+
+def test_precompute_writes_all_fields(tmp_path):
+    cache_path = str(tmp_path / "distance_fields.npz")
+    maze = make_maze()
+    maze.enable_distance_fields(cache_path)
+    data = np.load(cache_path)
+    assert sorted(data["addresses"].tolist()) == ["world:left", "world:right"]
+    assert data["fields"].dtype == np.int16
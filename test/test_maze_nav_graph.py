@@ -0,0 +1,110 @@
+"""
+比较启用与未启用导航图时 Maze.find_path_to_nearest 的结果。
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "backend"))
+maze_module = pytest.importorskip("maze")
+
+
+def make_maze(width=30, height=20):
+    """
+    构建一个不读取任何文件的小迷宫：四周是墙，(1, 1) 被墙围住无法到达，
+    (5, 5) 本身是碰撞瓦片。
+    """
+    wall = maze_module.collision_block_id
+    collision_maze = [["0"] * width for _ in range(height)]
+    for x in range(width):
+        collision_maze[0][x] = wall
+        collision_maze[height - 1][x] = wall
+    for y in range(height):
+        collision_maze[y][0] = wall
+        collision_maze[y][width - 1] = wall
+    # 把 (1, 1) 围起来
+    collision_maze[1][2] = wall
+    collision_maze[2][1] = wall
+    collision_maze[2][2] = wall
+    collision_maze[5][5] = wall
+
+    maze = maze_module.Maze.__new__(maze_module.Maze)
+    maze.maze_width = width
+    maze.maze_height = height
+    maze.collision_layer = np.array(collision_maze) == wall
+    maze.sector_layer = np.zeros((height, width), dtype=np.int32)
+    maze.arena_layer = np.zeros((height, width), dtype=np.int32)
+    maze.nav_graph = None
+    return maze
+
+
+def assert_valid_path(maze, path, start, end):
+    assert tuple(path[0]) == tuple(start)
+    assert tuple(path[-1]) == tuple(end)
+    for (x0, y0), (x1, y1) in zip(path, path[1:]):
+        assert abs(x0 - x1) + abs(y0 - y1) == 1
+        assert maze.collision_maze[y1][x1] != maze_module.collision_block_id
+
+
+@pytest.mark.parametrize("targets", [
+    [(1, 1), (28, 18)],
+    [(5, 5), (28, 18)],
+    [(1, 1), (5, 5), (20, 10), (28, 18)],
+])
+def test_unreachable_targets_match_without_nav_graph(targets):
+    maze = make_maze()
+    start = (10, 10)
+    expected_target, expected_path = maze.find_path_to_nearest(start, targets)
+
+    maze.enable_nav_graph(cluster_size=8)
+    target, path = maze.find_path_to_nearest(start, targets)
+
+    # 导航图的路径不一定最短，但必须选择同一个可到达的目标，并真正走到那里。
+    assert target == expected_target
+    assert_valid_path(maze, path, start, target)
+
+
+def test_reachable_target_is_preferred_over_closer_unreachable_one():
+    maze = make_maze()
+    maze.enable_nav_graph(cluster_size=8)
+    target, path = maze.find_path_to_nearest((3, 3), [(1, 1), (28, 18)])
+    assert target == (28, 18)
+    assert_valid_path(maze, path, (3, 3), target)
+
+
+def test_nearest_uses_one_search_and_valid_paths(monkeypatch):
+    rng = np.random.default_rng(0)
+    maze = make_maze(width=48, height=40)
+    wall = maze_module.collision_block_id
+    for x, y in rng.integers(1, [47, 39], size=(200, 2)):
+        maze.collision_layer[y, x] = True
+    maze.sector_layer[:, 24:] = 1
+    maze.enable_nav_graph(cluster_size=8)
+    monkeypatch.setattr(maze.nav_graph, "find_path",
+                        lambda *args: pytest.fail("find_path called per target"))
+
+    open_tiles = [(x, y) for y in range(40) for x in range(48)
+                  if maze.collision_maze[y][x] != wall]
+    for _ in range(30):
+        start = open_tiles[rng.integers(len(open_tiles))]
+        targets = [open_tiles[i] for i in rng.integers(len(open_tiles), size=5)]
+        expected_target, expected_path = maze_module.path_finder_to_nearest(
+            maze.collision_maze, start, targets, wall)
+        target, path = maze.find_path_to_nearest(start, targets)
+        if len(expected_path) == 1 and tuple(expected_path[0]) != tuple(start):
+            continue
+        assert target in targets
+        assert_valid_path(maze, path, start, target)
+        # 导航图的路径不一定最短，但不会比到最近目标的最短路径长太多
+        assert len(path) <= 2 * len(expected_path) + 16
+
+
+def test_collision_maze_is_derived_from_layer():
+    maze = make_maze()
+    wall = maze_module.collision_block_id
+    assert "collision_maze" not in maze_module.COMPILED_MAZE_FIELDS
+    assert maze.collision_maze[0][0] == wall
+    assert maze.collision_maze[3][3] == "0"
+    assert maze.collision_maze is maze.collision_maze
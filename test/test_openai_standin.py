@@ -0,0 +1,247 @@
+"""
+检查 OpenAI 替身服务的默认规则：对每个 run_gpt_prompt_* 家族，经由 gpt_structure
+的 safe_generate_* 函数向进程内启动的替身服务发送请求，用 run_gpt_prompt.py 中真实
+的 __func_validate / __chat_func_validate 验证，确认没有用到 fail_safe。
+"""
+import os
+import sys
+import types
+import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "backend"))
+standin_module = pytest.importorskip("openai_standin")
+
+FAIL_SAFE = object()
+GPT_PARAM = {"engine": "text-davinci-003", "max_tokens": 50, "temperature": 0,
+             "top_p": 1, "stream": False, "frequency_penalty": 0,
+             "presence_penalty": 0, "stop": None}
+
+
+@pytest.fixture(scope="module")
+def prompt_modules():
+    gpt_structure = pytest.importorskip("persona.prompt_modules.gpt_structure")
+    run_gpt_prompt = pytest.importorskip("persona.prompt_modules.run_gpt_prompt")
+    return gpt_structure, run_gpt_prompt
+
+
+@pytest.fixture(scope="module")
+def standin_server(prompt_modules):
+    gpt_structure, _ = prompt_modules
+    standin = standin_module.OpenAIStandin(port=0, latency="fixed", latency_mean=0, seed=0)
+    cache_mode = gpt_structure.llm_cache.mode
+    gpt_structure.llm_cache.mode = "off"
+    gpt_structure.set_llm_api_base(standin.start())
+    yield standin
+    gpt_structure.set_llm_api_base(None)
+    gpt_structure.llm_cache.mode = cache_mode
+    standin.shutdown()
+
+
+def family_functions(run_gpt_prompt, family, names):
+    """
+    取出 run_gpt_prompt.py 中 <family> 内部定义的函数（如 __func_validate）。
+    从源码编译取第一个同名定义，因为文件后面有同名的占位函数覆盖了部分家族。
+    """
+    path = run_gpt_prompt.__file__
+    module_code = compile(open(path, encoding="utf-8").read(), path, "exec")
+    family_code = next(code for code in module_code.co_consts
+                       if isinstance(code, types.CodeType) and code.co_name == family)
+    codes = {code.co_name: code for code in family_code.co_consts
+             if isinstance(code, types.CodeType)}
+    built = dict()
+
+    def build(name):
+        if name not in built:
+            code = codes[name]
+            closure = tuple(types.CellType(build(var)) for var in code.co_freevars)
+            built[name] = types.FunctionType(code, run_gpt_prompt.__dict__, name,
+                                             None, closure or None)
+        return built[name]
+    return [build(name) for name in names]
+
+
+TEXT = ("__func_validate", "__func_clean_up")
+CHAT = ("__chat_func_validate", "__chat_func_clean_up")
+
+NEW_DECOMP_PROMPT = (
+    "Here was Isabella's originally planned schedule from "
+    f"{datetime.datetime(2023, 2, 13, 8, 0).strftime('%H:%M %p')} to "
+    f"{datetime.datetime(2023, 2, 13, 10, 0).strftime('%H:%M %p')}.\n"
+    "08:00 ~ 10:00 -- working\n\n"
+    "But Isabella unexpectedly ended up talking for 30 minutes.\n"
+    "The revised schedule:\n"
+    "08:00 ~ 08:30 -- working\n"
+    "08:30 ~ 09:00 -- talking\n"
+    "09:00 ~")
+
+# (家族, 验证与清理函数名, 提示)，经 safe_generate_response 发送文本补全请求
+TEXT_FAMILIES = [
+    ("run_gpt_prompt_wake_up_hour", TEXT,
+     "Isabella goes to bed around 11pm.\n\nIsabella's wake up hour:"),
+    ("run_gpt_prompt_daily_plan", TEXT,
+     "Here is Isabella's plan today in broad-strokes: "
+     "1) wake up and complete the morning routine at 6:00 am, 2)"),
+    ("run_gpt_prompt_generate_hourly_schedule", TEXT,
+     "[(ID:abc123) Monday February 13 -- 05:00 AM] Activity: Isabella is sleeping\n"
+     "[(ID:def456) Monday February 13 -- 06:00 AM] Activity: Isabella is"),
+    ("run_gpt_prompt_task_decomp", TEXT,
+     "In 5 min increments, list the subtasks Isabella does when Isabella is "
+     "working from 08:00AM ~ 09:00AM (total duration in minutes 60):\n1) Isabella is"),
+    ("run_gpt_prompt_action_sector", TEXT,
+     "Area options: {Hobbs Cafe, Isabella Rodriguez's apartment}.\n"
+     "For brewing coffee, Isabella Rodriguez should go to the following area: {"),
+    ("run_gpt_prompt_action_arena", TEXT,
+     "Hobbs Cafe has the following areas: {cafe, kitchen}.\n"
+     "For brewing coffee, Isabella Rodriguez should go to the following area in Hobbs Cafe: {"),
+    ("run_gpt_prompt_action_game_object", TEXT,
+     "Current activity: brewing coffee\nObjects available: {coffee machine, counter, sink}\n"
+     "Pick ONE most relevant object from the objects available:"),
+    ("run_gpt_prompt_event_triple", TEXT,
+     "Input: Isabella is brewing coffee\nOutput: (Isabella Rodriguez,"),
+    ("run_gpt_prompt_act_obj_event_triple", TEXT,
+     "Input: coffee machine is brewing coffee\nOutput: (coffee machine,"),
+    ("run_gpt_prompt_new_decomp_schedule", TEXT, NEW_DECOMP_PROMPT),
+    ("run_gpt_prompt_decide_to_talk", TEXT,
+     "Question: Would Isabella initiate a conversation with Maria?\nAnswer in yes or no:"),
+    ("run_gpt_prompt_decide_to_react", TEXT,
+     "Option 1: Wait\nOption 2: Leave\nOption 3: Keep going\nAnswer: Option"),
+    ("run_gpt_prompt_create_conversation", TEXT,
+     'Isabella and Maria are in the cafe.\nWhat would they talk about now?\nIsabella: "'),
+    ("run_gpt_prompt_extract_keywords", TEXT,
+     "Event: Isabella is brewing coffee\nFactually descriptive keywords: coffee\n"
+     "Emotive keywords: cozy\n\nEvent: Isabella is serving customers\n"
+     "Factually descriptive keywords:"),
+    ("run_gpt_prompt_keyword_to_thoughts", TEXT,
+     "Here is what Isabella knows about the party.\nWhat does Isabella think about it?"),
+    ("run_gpt_prompt_convo_to_thoughts", TEXT,
+     "Isabella: Hi!\nMaria: Hi!\n\nWhat does Isabella think about Maria?"),
+    ("run_gpt_prompt_insight_and_guidance", TEXT,
+     "1. Isabella is brewing coffee\n2. Isabella is serving customers\n\n"
+     "What 1 high-level insights can you infer from the above statements? "
+     "(example format: insight (because of 1, 5, 3))\n1."),
+    ("run_gpt_prompt_generate_next_convo_line", TEXT,
+     "Isabella is talking to Maria.\nWhat would Isabella say next?\nIsabella: \""),
+    ("run_gpt_prompt_generate_whisper_inner_thought", TEXT,
+     "Translate the following whisper into a statement.\nWhisper: you like parties\nStatement:"),
+    ("run_gpt_prompt_planning_thought_on_convo", TEXT,
+     "Isabella: Hi!\nMaria: Hi!\n\nWrite down if there is anything Isabella needs to remember:"),
+    ("run_gpt_prompt_memo_on_convo", TEXT,
+     "Isabella: Hi!\nMaria: Hi!\n\nWhat did Isabella find interesting?"),
+]
+
+# (家族, 验证与清理函数名, 提示, 示例输出, 特别说明)，经 ChatGPT_safe_generate_response
+# 发送聊天请求。act_obj_desc 与 summarize_ideas 调用了没有定义的 __chat_func_*，
+# 这里使用它们实际定义的 __func_*。
+CHAT_FAMILIES = [
+    ("run_gpt_prompt_pronunciatio", CHAT,
+     "Convert an action description to an emoji.\nAction description: brewing coffee",
+     "🛁🧖‍♀️", "The value for the output must ONLY contain the emojis."),
+    ("run_gpt_prompt_act_obj_desc", TEXT,
+     "Task: We want to understand the state of an object that is being used by someone.",
+     "being fixed", "The output should ONLY contain the phrase that should go in <fill in>."),
+    ("run_gpt_prompt_summarize_conversation", TEXT,
+     "Conversation:\nIsabella: Hi!\nMaria: Hi!\n\nSummarize the conversation above in one sentence:",
+     "conversing about what to eat for lunch",
+     "The output must continue the sentence above by filling in the <fill in> tag."),
+    ("run_gpt_prompt_event_poignancy", CHAT,
+     "Event: Isabella is brewing coffee\nRate (return a number between 1 to 10):",
+     "5", "Only a number (1 to 10) is allowed."),
+    ("run_gpt_prompt_thought_poignancy", CHAT,
+     "Thought: Isabella likes parties\nRate (return a number between 1 to 10):",
+     "5", "Only a number (1 to 10) is allowed."),
+    ("run_gpt_prompt_chat_poignancy", CHAT,
+     "Conversation: Isabella and Maria say hi\nRate (return a number between 1 to 10):",
+     "5", "Only a number (1 to 10) is allowed."),
+    ("run_gpt_prompt_focal_pt", CHAT,
+     "Isabella is brewing coffee\n\nGiven only the information above, what are 3 most "
+     "salient high-level questions we can answer about the subjects grounded in the statements?",
+     '["What should Jane do for lunch", "Does Jane like strawberry", "Who is Jane"]',
+     "Output must be a list of str."),
+    ("run_gpt_prompt_agent_chat_summarize_ideas", CHAT,
+     "Isabella is talking to Maria. Summarize what Isabella is thinking about.",
+     "Jane Doe is working on a project",
+     "The output should be a string that responds to the question."),
+    ("run_gpt_prompt_agent_chat_summarize_relationship", CHAT,
+     "Summarize Isabella's relationship with Maria.",
+     "Jane Doe is working on a project",
+     "The output should be a string that responds to the question."),
+    ("run_gpt_prompt_agent_chat", TEXT,
+     'Isabella and Maria are in the cafe.\nHere is their conversation.\n\nIsabella: "',
+     "Jane Doe: Hi! John Doe: Hey there! How are you doing?",
+     "The output should be a string that responds to the question. The conversation "
+     "output starts with <speaker>: <response> and alternates between the two participants."),
+    ("run_gpt_prompt_summarize_ideas", TEXT,
+     "Statements:\nIsabella likes parties\n\nWhat is Isabella planning?",
+     "Jane Doe is working on a project",
+     "The output should be a string that responds to the question."),
+]
+
+
+@pytest.mark.parametrize("family, names, prompt", TEXT_FAMILIES,
+                         ids=[family for family, _, _ in TEXT_FAMILIES])
+def test_text_family_passes_validator(prompt_modules, standin_server, family, names, prompt):
+    gpt_structure, run_gpt_prompt = prompt_modules
+    validate, clean_up = family_functions(run_gpt_prompt, family, names)
+    output = gpt_structure.safe_generate_response(prompt, GPT_PARAM, 1, FAIL_SAFE,
+                                                  validate, clean_up)
+    assert output is not FAIL_SAFE
+
+
+@pytest.mark.parametrize("family, names, prompt, example_output, special_instruction",
+                         CHAT_FAMILIES, ids=[family for family, *_ in CHAT_FAMILIES])
+def test_chat_family_passes_validator(prompt_modules, standin_server, family, names, prompt,
+                                      example_output, special_instruction):
+    gpt_structure, run_gpt_prompt = prompt_modules
+    validate, clean_up = family_functions(run_gpt_prompt, family, names)
+    output = gpt_structure.ChatGPT_safe_generate_response(prompt, example_output,
+                                                          special_instruction, 1, FAIL_SAFE,
+                                                          validate, clean_up)
+    assert output is not FAIL_SAFE
+
+
+def test_iterative_convo_passes_validator(prompt_modules, standin_server):
+    gpt_structure, run_gpt_prompt = prompt_modules
+    validate, clean_up = family_functions(run_gpt_prompt, "run_gpt_generate_iterative_chat_utt",
+                                          CHAT)
+    prompt = ('Output format: Output a json of the following format:\n{\n'
+              '"Isabella": "<Isabella\'s utterance>",\n'
+              '"Did the conversation end with Isabella\'s utterance?": "<json Boolean>"\n}')
+    output = gpt_structure.ChatGPT_safe_generate_response_OLD(prompt, 1, FAIL_SAFE,
+                                                              validate, clean_up)
+    assert output == {"utterance": "Hi!", "end": True}
+
+
+def test_server_counts_requests(prompt_modules, standin_server):
+    gpt_structure, _ = prompt_modules
+    gpt_structure.safe_generate_response("Isabella's wake up hour:", GPT_PARAM, 1, FAIL_SAFE,
+                                         lambda response, prompt="": True,
+                                         lambda response, prompt="": response)
+    assert standin_server.stats().get("completions", 0) > 0
+
+
+def complete(standin, prompt):
+    return standin.completion({"prompt": prompt})["choices"][0]["text"]
+
+
+def chat(standin, prompt):
+    body = {"messages": [{"role": "user", "content": prompt}]}
+    return standin.chat_completion(body)["choices"][0]["message"]["content"]
+
+
+def test_explicit_rules_replace_defaults():
+    standin = standin_module.OpenAIStandin(latency="fixed", latency_mean=0,
+                                           rules=[[r"party on (\w+)", "party {0}"]])
+    assert complete(standin, "a party on Friday") == "party Friday"
+    assert complete(standin, "Isabella's wake up hour:") == standin_module.STANDIN_DEFAULT_OUTPUT
+
+
+def test_loose_rules_do_not_capture_wrapped_chat_prompts():
+    standin = standin_module.OpenAIStandin(latency="fixed", latency_mean=0,
+                                           rules=[[r"Isabella", "loose"]])
+    prompt = ('"""\nEvent: Isabella is brewing coffee\n"""\n'
+              "以 JSON 格式输出上述提示的响应。\n示例输出 JSON:\n"
+              '{"output": "5"}')
+    assert chat(standin, prompt) == '{"output": "5"}'
+    assert chat(standin, "Isabella, unwrapped") == "loose"
@@ -0,0 +1,50 @@
+"""
+检查 PromptTemplate 的渲染结果与原先逐个 str.replace 的实现一致。
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "backend"))
+gpt_structure = pytest.importorskip("persona.prompt_modules.gpt_structure")
+
+TEMPLATE = ("说明文字\n<commentblockmarker>###</commentblockmarker>\n"
+            "!<INPUT 0>! is at !<INPUT 1>!. !<INPUT 0>! is !<INPUT 2>!.\n")
+
+
+def old_generate_prompt(curr_input, prompt_lib_file):
+    prompt = open(prompt_lib_file, "r").read()
+    for count, i in enumerate(curr_input):
+        prompt = prompt.replace(f"!<INPUT {count}>!", i)
+    if "<commentblockmarker>###</commentblockmarker>" in prompt:
+        prompt = prompt.split("<commentblockmarker>###</commentblockmarker>")[1]
+    return prompt.strip()
+
+
+@pytest.fixture
+def template_file(tmp_path):
+    path = tmp_path / "template.txt"
+    path.write_text(TEMPLATE)
+    gpt_structure.prompt_templates.clear()
+    yield str(path)
+    gpt_structure.prompt_templates.clear()
+
+
+def test_render_matches_old_replace(template_file):
+    curr_input = ["Isabella", "the cafe", "brewing coffee"]
+    prompt = gpt_structure.generate_prompt(curr_input, template_file, strict=True)
+    assert prompt == old_generate_prompt(curr_input, template_file)
+
+
+def test_missing_inputs_left_unfilled(template_file, capsys):
+    curr_input = ["Isabella", "the cafe"]
+    prompt = gpt_structure.generate_prompt(curr_input, template_file, strict=False)
+    assert prompt == old_generate_prompt(curr_input, template_file)
+    assert "!<INPUT 2>!" in prompt
+    assert "警告" in capsys.readouterr().out
+
+
+def test_missing_inputs_raise_when_strict(template_file):
+    with pytest.raises(ValueError):
+        gpt_structure.generate_prompt(["Isabella"], template_file, strict=True)
@@ -0,0 +1,96 @@
+"""
+检查 single-flight 层：JSON 解析或清理失败时仍然重试，异步版本可以在多个线程
+各自的事件循环中同时使用。
+"""
+import os
+import sys
+import asyncio
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "backend"))
+gpt_structure = pytest.importorskip("persona.prompt_modules.gpt_structure")
+
+
+@pytest.fixture(autouse=True)
+def cache_off():
+    mode = gpt_structure.llm_cache.mode
+    gpt_structure.llm_cache.mode = "off"
+    yield
+    gpt_structure.llm_cache.mode = mode
+
+
+def fake_requests(monkeypatch, name, responses):
+    calls = []
+
+    def request(prompt):
+        calls.append(prompt)
+        return responses[len(calls) - 1]
+    monkeypatch.setattr(gpt_structure, name, request)
+    return calls
+
+
+def clean_up_int(gpt_response, prompt=""):
+    return int(gpt_response)
+
+
+def test_json_parse_failure_retries(monkeypatch):
+    calls = fake_requests(monkeypatch, "ChatGPT_request",
+                          ["not json", '{"output": "7"}'])
+    output = gpt_structure.ChatGPT_safe_generate_response(
+               "retry parse", "5", "", 3, "fail", lambda r, prompt="": True, clean_up_int)
+    assert output == 7
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("name, generate", [
+    ("ChatGPT_request", lambda *args: gpt_structure.ChatGPT_safe_generate_response(
+                                        "retry clean up", "5", "", *args)),
+    ("GPT4_request", lambda *args: gpt_structure.GPT4_safe_generate_response(
+                                     "retry clean up", "5", "", *args)),
+])
+def test_clean_up_failure_retries(monkeypatch, name, generate):
+    calls = fake_requests(monkeypatch, name,
+                          ['{"output": "seven"}', '{"output": "7"}'])
+    output = generate(3, "fail", lambda r, prompt="": True, clean_up_int)
+    assert output == 7
+    assert len(calls) == 2
+
+
+def test_old_clean_up_failure_retries(monkeypatch):
+    calls = fake_requests(monkeypatch, "ChatGPT_request", ["seven", "7"])
+    output = gpt_structure.ChatGPT_safe_generate_response_OLD(
+               "retry old", 3, "fail", lambda r, prompt="": True, clean_up_int)
+    assert output == 7
+    assert len(calls) == 2
+
+
+def test_async_single_flight_across_threads():
+    flight = gpt_structure.AsyncSingleFlight()
+    threads_count = 8
+    callers = 20
+    barrier = threading.Barrier(threads_count)
+    results = []
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        return [1]
+
+    async def run_callers():
+        return await asyncio.gather(*[flight.do("key", fetch) for _ in range(callers)])
+
+    def worker():
+        barrier.wait()
+        results.append(asyncio.run(run_callers()))
+
+    threads = [threading.Thread(target=worker) for _ in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(r == [[1]] * callers for r in results)
+    # 每个事件循环各自一个领头调用者
+    assert flight.shared == threads_count * (callers - 1)
+    assert flight._calls == dict()
@@ -0,0 +1,56 @@
+"""
+检查 SQLiteAssociativeMemory 保存到其他文件夹后改为使用复制后的数据库。
+"""
+import os
+import sys
+import json
+import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "backend"))
+sqlite_memory = pytest.importorskip("persona.memory_modules.sqlite_associative_memory")
+
+
+def make_json_memory_folder(folder):
+    os.makedirs(folder)
+    with open(f"{folder}/embeddings.json", "w") as f:
+        json.dump({}, f)
+    with open(f"{folder}/nodes.json", "w") as f:
+        json.dump({}, f)
+    with open(f"{folder}/kw_strength.json", "w") as f:
+        json.dump({"kw_strength_event": {}, "kw_strength_thought": {}}, f)
+
+
+def add_event(memory, description):
+    created = datetime.datetime(2023, 2, 13, 8, 0)
+    return memory.add_event(created, None, "Isabella", "is", description,
+                            f"Isabella is {description}", {"Isabella"}, 3,
+                            (description, [0.1, 0.2, 0.3]), [])
+
+
+def node_descriptions(folder):
+    memory = sqlite_memory.SQLiteAssociativeMemory(folder)
+    descriptions = sorted(node.description for node in memory.id_to_node.values())
+    memory.conn.close()
+    return descriptions
+
+
+def test_save_to_other_folder_switches_connection(tmp_path):
+    original = str(tmp_path / "original")
+    forked = str(tmp_path / "forked")
+    make_json_memory_folder(original)
+
+    memory = sqlite_memory.SQLiteAssociativeMemory(original)
+    add_event(memory, "brewing coffee")
+    memory.save(forked)
+    assert memory.f_saved == forked
+
+    # 保存之后新增的节点只写入复制后的数据库
+    add_event(memory, "serving customers")
+    memory.save(forked)
+    memory.conn.close()
+
+    assert node_descriptions(original) == ["Isabella is brewing coffee"]
+    assert node_descriptions(forked) == ["Isabella is brewing coffee",
+                                         "Isabella is serving customers"]